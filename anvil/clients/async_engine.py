@@ -0,0 +1,164 @@
+"""Fetch a search from many FHIR servers on one asyncio event loop, see DispatchingFHIRClient(engine='async')."""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from functools import partial
+from typing import List, Tuple
+from urllib.parse import urljoin
+
+from fhirclient.server import FHIRJSONMimeType
+
+from anvil.clients.connections import DEFAULT_TIMEOUT, httpx_client_kwargs
+from fhir_workshop.decoder import loads
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover, optional dependency
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDispatcher(object):
+    """Multiplexes every server and every page fetch on one event loop, at most max_concurrency requests in flight.
+
+    Uses httpx.AsyncClient when installed. Otherwise each server's own requests session (and its 401 hooks) is
+    called from a thread pool of max_concurrency threads, still scheduled and limited by the event loop.
+    The pool is created on first use and kept until `close()`.
+    Requests are signed by each server's auth, same as FHIRServer._get.
+
+    :param max_concurrency: Maximum number of requests in flight, across all servers.
+    :param retrieve_all: If True, follow `next` links until the last page.
+    :param http2: With httpx, multiplex requests to a host over HTTP/2, requires `pip install httpx[http2]`.
+    :param timeout: With httpx, seconds to connect or wait for the next bytes of a response before the search fails,
+    see anvil.clients.connections.httpx_client_kwargs.
+    """
+
+    def __init__(self, max_concurrency=32, retrieve_all=True, http2=False, timeout=DEFAULT_TIMEOUT):
+        """Nothing is opened until a search is run."""
+        assert max_concurrency > 0, "max_concurrency should be positive"
+        self.max_concurrency = max_concurrency
+        self.retrieve_all = retrieve_all
+        if http2 and httpx is None:
+            logger.warning("http2 requires `pip install httpx[http2]`, using each server's requests session")
+        self.http2 = http2
+        self.timeout = timeout
+        self._executor = None
+        # searches may run concurrently, only one of them creates the pool
+        self._executor_lock = threading.Lock()
+
+    @property
+    def executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        """Threads that make blocking requests when httpx is not installed, created on first use."""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                                       thread_name_prefix='fhir-async')
+            return self._executor
+
+    def close(self):
+        """Shut down the threads, if any."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def search(self, servers, path) -> List[Tuple[object, dict]]:
+        """Fetch path from each of servers. Return (server, page json) for every page, grouped by server.
+
+        Safe to call from a thread that is already running an event loop (e.g. a notebook),
+        the search then runs on its own loop in another thread.
+        """
+        return _run(self.search_async(servers, path))
+
+    async def search_async(self, servers, path) -> List[Tuple[object, dict]]:
+        """Coroutine of `search`."""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        if httpx is not None:
+            # one pool of kept alive connections for every server and page of the search
+            client_kwargs = httpx_client_kwargs(self.max_concurrency, http2=self.http2, timeout=self.timeout)
+            async with httpx.AsyncClient(**client_kwargs) as http_client:
+                # one re-authorization at a time, for every server of the search
+                get = partial(self._httpx_get, http_client, asyncio.Lock())
+                pages = await asyncio.gather(*[self._search_server(get, semaphore, server, path) for server in servers])
+        else:
+            get = partial(self._session_get, self.executor)
+            pages = await asyncio.gather(*[self._search_server(get, semaphore, server, path) for server in servers])
+        return [page for server_pages in pages for page in server_pages]
+
+    async def _search_server(self, get, semaphore, server, path) -> List[Tuple[object, dict]]:
+        """Fetch path from server, follow `next` links if retrieve_all."""
+        logger.debug(f"async search starting {server.base_uri}")
+        pages = []
+        url = urljoin(server.base_uri, path)
+        while url:
+            async with semaphore:
+                page = await get(server, url)
+            pages.append((server, page))
+            url = next_link(page) if self.retrieve_all else None
+        logger.debug(f"async search done {server.base_uri} {len(pages)} pages")
+        return pages
+
+    @staticmethod
+    async def _session_get(executor, server, url) -> dict:
+        """GET url with the server's requests session, on a thread of executor."""
+        response = await asyncio.get_running_loop().run_in_executor(executor, _session_get, server, url)
+        server.raise_for_status(response)
+        return loads(response.content)
+
+    @staticmethod
+    async def _httpx_get(http_client, reauthorize_lock: asyncio.Lock, server, url) -> dict:
+        """GET url with httpx, re-authorizes and retries once on 401 or 403, same as the auth's requests hook.
+
+        Signing and re-authorizing may block (e.g. run gcloud), they run on the loop's default executor.
+        Concurrent 401s wait for one re-authorization, the others retry with its token.
+        """
+        loop = asyncio.get_running_loop()
+        headers = await loop.run_in_executor(None, _headers, server)
+        response = await http_client.get(url, headers=headers)
+        if response.status_code in (401, 403) and hasattr(server.auth, 'handle_401'):
+            async with reauthorize_lock:
+                current_headers = await loop.run_in_executor(None, _headers, server)
+                if current_headers == headers:
+                    logger.debug(f"{response.status_code} from {url}, re-authorizing")
+                    await loop.run_in_executor(None, server.reauthorize)
+                    current_headers = await loop.run_in_executor(None, _headers, server)
+            response = await http_client.get(url, headers=current_headers)
+        server.raise_for_status(response)
+        return loads(response.content)
+
+
+def next_link(page: dict):
+    """Return the url of a Bundle's `next` link, None if it is the last page."""
+    for link in page.get('link') or []:
+        if link.get('relation') == 'next':
+            return link.get('url')
+    return None
+
+
+def _session_get(server, url):
+    """GET url with the server's requests session, signed on the calling thread."""
+    return server.session.get(url, headers=_headers(server))
+
+
+def _headers(server) -> dict:
+    """Return the headers FHIRServer._get would send, signed by server.auth."""
+    headers = {
+        'Accept': FHIRJSONMimeType,
+        'Accept-Charset': 'UTF-8',
+    }
+    if server.auth is not None and server.auth.can_sign_headers():
+        headers = server.auth.signed_headers(headers)
+    return headers
+
+
+def _run(coroutine):
+    """Run coroutine to completion, on a new thread if this thread's event loop is already running."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
@@ -0,0 +1,92 @@
+"""Connection pool settings shared by every client of a DispatchingFHIRClient, see DispatchingFHIRClient(pool_maxsize=)."""
+
+import importlib.util
+import logging
+from typing import Callable, ContextManager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# number of hosts a session keeps a pool for, Google Healthcare stores all share one host
+DEFAULT_POOL_CONNECTIONS = 10
+# minimum number of connections kept alive per host
+DEFAULT_POOL_MAXSIZE = 10
+# seconds to connect, or between bytes of a response, before an async request fails
+DEFAULT_TIMEOUT = 60
+
+
+class SlotAdapter(HTTPAdapter):
+    """HTTPAdapter that holds slot(url) while a request is sent and, unless streamed, its body is read.
+
+    Each request holds its slot on its own, a retry (e.g. the auth's 401 hook) or redirect takes it again,
+    so a thread never waits for a slot while holding one.
+    """
+
+    def __init__(self, slot: Callable[[str], ContextManager], **kwargs):
+        """:param slot: Returns the context to hold for a url, e.g. a semaphore."""
+        self._slot = slot
+        super(SlotAdapter, self).__init__(**kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        """Send request holding its slot."""
+        with self._slot(request.url):
+            response = super(SlotAdapter, self).send(request, stream=stream, **kwargs)
+            if not stream:
+                # read the body before another request may start
+                response.content
+        return response
+
+
+def pool_adapter(pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_connections=DEFAULT_POOL_CONNECTIONS, max_retries=0,
+                 slot: Callable[[str], ContextManager] = None) -> HTTPAdapter:
+    """Return an adapter that keeps up to pool_maxsize connections per host alive, see mount_pool.
+
+    :param pool_connections: Number of hosts to keep a pool for.
+    :param max_retries: Passed to HTTPAdapter, retries of failed connections (not failed responses).
+    :param slot: If set, every request holds slot(url), see SlotAdapter.
+    """
+    assert pool_maxsize > 0, "pool_maxsize should be positive"
+    kwargs = {'pool_connections': pool_connections, 'pool_maxsize': pool_maxsize, 'max_retries': max_retries}
+    return SlotAdapter(slot, **kwargs) if slot is not None else HTTPAdapter(**kwargs)
+
+
+def mount_pool(session: requests.Session, pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_connections=DEFAULT_POOL_CONNECTIONS,
+               max_retries=0, slot: Callable[[str], ContextManager] = None, adapter: HTTPAdapter = None) -> requests.Session:
+    """Mount http(s) adapters on session that keep up to pool_maxsize connections per host alive. Return session.
+
+    requests' default keeps 10, with more threads than that talking to one host the extra connections (and their
+    TLS handshakes) are thrown away after each request.
+    Sessions are not thread safe (cookies, auth and headers change per request), give each client its own session
+    and mount the same adapter on each to share the connections.
+
+    :param adapter: Mount this adapter, e.g. another session's from pool_adapter, instead of a new one.
+    Every other argument is passed to pool_adapter.
+    """
+    if adapter is None:
+        adapter = pool_adapter(pool_maxsize=pool_maxsize, pool_connections=pool_connections, max_retries=max_retries,
+                               slot=slot)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def httpx_client_kwargs(max_connections, http2=False, timeout=DEFAULT_TIMEOUT) -> dict:
+    """Return httpx.AsyncClient keyword arguments for a pool of max_connections kept alive connections.
+
+    :param http2: Multiplex requests to a host over one HTTP/2 connection, requires `pip install httpx[http2]`.
+    :param timeout: Seconds to connect, send or wait for the next bytes of a response, None to wait forever.
+    Waiting for a pooled connection is not limited, the caller bounds the requests in flight.
+    """
+    assert timeout is None or timeout > 0, "timeout should be positive or None"
+    # avoid import unless the async engine is used with httpx
+    import httpx
+    if http2 and importlib.util.find_spec('h2') is None:
+        logger.warning("http2 requires `pip install httpx[http2]`, using HTTP/1.1")
+        http2 = False
+    return {
+        'timeout': httpx.Timeout(timeout, pool=None),
+        'http2': http2,
+        'limits': httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+    }
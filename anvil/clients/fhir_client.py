@@ -3,17 +3,27 @@
 
 import logging
 import concurrent.futures
-from urllib.parse import urlparse
+from functools import partial
+import threading
+from contextlib import nullcontext
+from typing import Iterator, List
 from fhirclient import client, server as fhirclient_server
 from fhirclient.models.meta import Meta
 from fhirclient.models.bundle import Bundle
+from fhirclient.models.resource import Resource
 import resource
 
 from fhirclient.server import FHIRPermissionDeniedException
 import fhirclient.models.identifier as FHIRIdentifier
 
+from anvil.clients.connections import DEFAULT_POOL_CONNECTIONS, DEFAULT_POOL_MAXSIZE, DEFAULT_TIMEOUT, mount_pool, pool_adapter
+from anvil.clients.paging import iter_pages, merge_pages
+
 logger = logging.getLogger(__name__)
 
+# marks the threads of a DispatchingFHIRClient's executor
+_executor_thread = threading.local()
+
 
 class FHIRClient(client.FHIRClient):
     """Instances of this class handle authorizing and talking to Google Healthcare API FHIR Service.
@@ -70,6 +80,24 @@ class DispatchingFHIRClient(client.FHIRClient):
     :param auth: An instance of FHIRAuth that will authenticate each request.
     :param max_workers: Number of thread workers, if null will be set to the maximum of open files per process
     or the number of api bases, whichever is less.
+    :param engine: 'threads' (default), a thread per api base, each following `next` links in turn.
+    'async', every api base and page fetch is multiplexed on one event loop, see anvil.clients.async_engine.
+    :param max_concurrency: With engine='async', the maximum number of requests in flight across all api bases.
+    :param prefetch: With retrieve_all, the number of pages each api base's worker fetches ahead of building Bundles,
+    0 to fetch a page only after the previous Bundle is built.
+    :param pool_maxsize: Connections kept alive per host, shared by every api base (and its pages), defaults to
+    enough for every worker thread (or max_concurrency).
+    :param pool_connections: Number of hosts to keep a pool for, see anvil.clients.connections.mount_pool.
+    :param http2: With engine='async' and `pip install httpx[http2]`, multiplex requests to a host over HTTP/2.
+    :param timeout: With engine='async' and httpx, seconds to connect or wait for the next bytes of a response,
+    defaults to anvil.clients.connections.DEFAULT_TIMEOUT, None to wait forever.
+    :param max_per_store: If set, the maximum number of concurrent requests per api base, across every search and
+    dispatched callback (requests made with server.session) of this client. A request holds the slot while it is
+    sent and read, never while a callback runs, so callbacks may search. engine='async' with httpx fetches one page
+    at a time per api base.
+
+    The worker threads, and the threads prefetching their pages, are created once and shared by every search and
+    dispatch, call `close()`, or use the client as a context manager, to release them and the clients' connections.
 
     Returns:
         Instance of client, with injected authorization method
@@ -135,12 +163,47 @@ class DispatchingFHIRClient(client.FHIRClient):
             logger.debug(f"Setting number of threads to {max_workers}")
 
         self._max_workers = max_workers
+        # created on first use, see `executor` and `prefetch_executor`
+        self._executor = None
+        self._prefetch_executor = None
+        self._executor_lock = threading.Lock()
+
+        self._prefetch = kwargs.pop('prefetch', 2)
+        max_per_store = kwargs.pop('max_per_store', None)
+        assert max_per_store is None or max_per_store > 0, "max_per_store should be positive"
+        self._max_per_store = max_per_store
+        # base_uri -> semaphore, see _store_slot
+        self._store_semaphores = {}
+        # every request made through the shared adapter holds the slot of its api base
+        store_slot = self._store_slot if max_per_store else None
+
+        engine = kwargs.pop('engine', 'threads')
+        max_concurrency = kwargs.pop('max_concurrency', 32)
+        http2 = kwargs.pop('http2', False)
+        timeout = kwargs.pop('timeout', DEFAULT_TIMEOUT)
+        assert engine in ('threads', 'async'), f"Unknown engine {engine}"
+        self._engine = None
+        if engine == 'async':
+            from anvil.clients.async_engine import AsyncDispatcher
+            self._engine = AsyncDispatcher(max_concurrency=max_concurrency, retrieve_all=self._retrieve_all,
+                                           http2=http2, timeout=timeout)
+
+        # one connection pool for every api base, large enough for every thread that may request at once
+        pool_maxsize = kwargs.pop('pool_maxsize', None)
+        if not pool_maxsize:
+            pool_maxsize = max(max_workers, len(_settings['api_bases']) + 1, DEFAULT_POOL_MAXSIZE)
+            if engine == 'async':
+                pool_maxsize = max(pool_maxsize, max_concurrency)
+        pool_connections = kwargs.pop('pool_connections', DEFAULT_POOL_CONNECTIONS)
 
         # normal setup with our authenticator
         super(DispatchingFHIRClient, self).__init__(*args, **kwargs)
         client_major_version = int(client.__version__.split('.')[0])
         assert client_major_version >= 4, f"requires version >= 4.0.0 current version {client.__version__} `pip install -e git+https://github.com/smart-on-fhir/client-py#egg=fhirclient`"
 
+        # one pool of kept alive connections, mounted on every client's own session
+        adapter = pool_adapter(pool_maxsize=pool_maxsize, pool_connections=pool_connections, slot=store_slot)
+        mount_pool(self.server.session, adapter=adapter)
         if auth:
             self.server.auth = auth
             self.server.session.hooks['response'].append(self.server.auth.handle_401)
@@ -149,7 +212,7 @@ class DispatchingFHIRClient(client.FHIRClient):
         assert self.ready, "server should be ready"
 
         # set up an array of FHIRClients, including this instance, in self._clients
-        # re-use authenticator
+        # re-use authenticator and kept alive connections, each client has its own session (cookies, headers, hooks)
         self._clients = [self]
         self._api_bases = _settings['api_bases']
         for api_base in self._api_bases:
@@ -157,16 +220,20 @@ class DispatchingFHIRClient(client.FHIRClient):
             __settings['api_base'] = api_base
             _client = client.FHIRClient(settings=__settings)
             _client.server.auth = self.server.auth
-            _client.server.session.hooks['response'].append(self.server.auth.handle_401)
+            mount_pool(_client.server.session, adapter=adapter)
+            # e.g. the authenticator's 401 handler
+            _client.server.session.hooks['response'].extend(self.server.session.hooks['response'])
             _client.prepare()
             self._clients.append(_client)
+        if max_per_store:
+            self._store_semaphores = {_client.server.base_uri: threading.BoundedSemaphore(max_per_store)
+                                      for _client in self._clients}
 
         # monkey patch Search.perform if we haven't already
         from fhirclient.models.fhirsearch import FHIRSearch
         if not hasattr(FHIRSearch, '_anvil_patch'):
             FHIRSearch._anvil_patch = True
             original_perform = FHIRSearch.perform
-            me = self
 
             def _perform(self, server):
                 """Dispatch query to api_bases."""
@@ -175,6 +242,12 @@ class DispatchingFHIRClient(client.FHIRClient):
                     logger.debug(f"* * * * * * * original_perform {server.client.__class__.__name__}")
                     return original_perform(self, server)
 
+                dispatching_client = server.client
+                if dispatching_client._engine is not None:
+                    # one event loop for every api base and page
+                    pages = dispatching_client._engine.search([__client.server for __client in dispatching_client._clients], self.construct())
+                    return [_source_bundle(page, page_server) for page_server, page in pages]
+
                 def _worker(self, server):
                     """Dispatches request to underlying class, return an entry indexed by base uri.
 
@@ -186,55 +259,18 @@ class DispatchingFHIRClient(client.FHIRClient):
                     """
                     logger.debug(f"worker starting {server.base_uri}")
                     _worker_results = []
-                    _result = original_perform(self, server)
-                    logger.debug(f"worker got {_result}")
-
-                    while _result:
-
-                        # add source to meta if it doesn't already exist
-                        if not _result.meta:
-                            _result.meta = Meta()
-                        if not _result.meta.source:
-                            _result.meta.source = server.base_uri
-                        _worker_results.append(_result)
-                        if not me._retrieve_all:
-                            break
-
-                        # follow `next` link for pagination
-                        if hasattr(_result, 'link'):
-                            _next = next((lnk.as_json() for lnk in _result.link if lnk.relation == 'next'), None)
-                            _result = None
-                            if _next:
-                                logger.debug(f"has next {_next}")
-                                # request_json takes a full path & query (not host)
-                                parts = urlparse(_next['url'])
-                                assert len(parts.query) > 0, parts
-                                path = f"{parts.path}?{parts.query}"
-                                logger.debug(f"attempting next {path}")
-                                res = server.request_json(path)
-                                _result = Bundle(res)
-                                _result.origin_server = server
-                        else:
-                            _result = None
+                    # the next page is requested from the raw json, while this thread builds the Bundle
+                    for page in iter_pages(partial(dispatching_client._request_json, server), self.construct(),
+                                           retrieve_all=dispatching_client._retrieve_all,
+                                           prefetch=dispatching_client._prefetch,
+                                           submit=dispatching_client.prefetch_executor.submit):
+                        _worker_results.append(_source_bundle(page, server))
                     logger.debug(f"worker done {len(_worker_results)}")
                     return _worker_results
 
-                logger.debug("starting threads")
                 results = []
-                # We can use a with statement to ensure threads are cleaned up promptly
-                with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                    # Start the load operations and mark each future with its URL
-                    future_result = {executor.submit(_worker, self, __client.server, ): __client for __client
-                                     in server.client._clients}
-                    for future in concurrent.futures.as_completed(future_result):
-                        try:
-                            worker_results = future.result()
-                            results.extend(worker_results)
-                        except Exception as exc:
-                            if 'FHIRPermissionDeniedException' in exc.__class__.__name__:
-                                # requests.response embedded in exception
-                                logger.error(f"{str(exc)} {exc.args[0].url}")
-                            raise exc
+                for worker_results in dispatching_client._map_servers(partial(_worker, self)):
+                    results.extend(worker_results)
                 return results
 
             # monkey patch
@@ -257,54 +293,177 @@ class DispatchingFHIRClient(client.FHIRClient):
                     if not isinstance(bundles, list):
                         bundles = [bundles]
                     for bundle in bundles:
-                        if bundle.entry:
-                            for entry in bundle.entry:
-                                if not entry.resource.meta:
-                                    entry.resource.meta = Meta()
-
-                                # if not entry.resource.meta.source:
-                                #     assert bundle.meta, bundle.as_json()
-                                #     entry.resource.meta.source = bundle.meta.source
-
-                                # add tag for fullURL, allows caller
-                                # to disambiguate resources returned from different base URL
-                                if not entry.resource.meta.tag:
-                                    entry.resource.meta.tag = []
-                                entry.resource.meta.tag.append(
-                                    FHIRIdentifier.Identifier(
-                                        {
-                                            "system": "https://nih-ncpi.github.io/ncpi-fhir-ig/#fullUrl",
-                                            "value": entry.fullUrl
-                                        }
-                                    )
-                                )
-                                resources.append(entry.resource)
+                        resources.extend(_bundle_resources(bundle))
                 return resources
             FHIRSearch.perform_resources = _perform_resources
+
+            def _iter_resources(self, server, max_pages=8):
+                """Yield resources as pages arrive, see DispatchingFHIRClient.iter_resources.
+
+                For other clients, the resources of the first page.
+                """
+                if not server.client.__class__.__name__ == 'DispatchingFHIRClient':
+                    return iter(self.perform_resources(server))
+                return server.client.iter_resources(self, max_pages=max_pages)
+            FHIRSearch.iter_resources = _iter_resources
             logger.debug("Patched FHIRSearch")
 
+    def iter_resources(self, search, max_pages=8) -> Iterator[Resource]:
+        """Yield the resources of search as pages arrive from any api base, without waiting for every page.
+
+        Each resource is tagged with its fullUrl, same as perform_resources, and its origin_server is the server it
+        came from. No page is requested while max_pages pages are in memory, so a slow consumer slows fetching down.
+        Also available as `search.iter_resources(client.server)`. Pages are fetched on `prefetch_executor`,
+        following `next` links if retrieve_all, each request holds a max_per_store slot. The async engine is not
+        used, with engine='async' pages are fetched by the same threads.
+
+        :param search: A FHIRSearch, e.g. `ResearchSubject.where(struct={'_count': '1000'})`.
+        :param max_pages: Maximum number of fetched pages not yet consumed, across all api bases.
+        """
+        servers = [_client.server for _client in self._clients]
+        for server, page in merge_pages(self._request_json, servers, search.construct(), retrieve_all=self._retrieve_all,
+                                        max_pages=max_pages, submit=self.prefetch_executor.submit):
+            yield from _bundle_resources(_source_bundle(page, server))
+
+    @property
+    def engine(self):
+        """The AsyncDispatcher if engine='async', otherwise None."""
+        return self._engine
+
     @property
     def clients(self):
         """Expose list of clients instantiated from settings.api_bases."""
         return self._clients
 
-    def dispatch(self, _worker, *args, **kwargs):
-        """Execute callback(server) on thread for every server. """
-        logger.debug("starting threads")
+    @property
+    def executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        """The worker threads shared by every search and dispatch, created on first use."""
+        with self._executor_lock:
+            if self._executor is None:
+                logger.debug(f"starting {self._max_workers} threads")
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._max_workers, thread_name_prefix='fhir-dispatch', initializer=_mark_executor_thread
+                )
+            return self._executor
+
+    @property
+    def prefetch_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        """The threads that fetch pages ahead of the workers building Bundles (see `prefetch`) and for
+        `iter_resources`, created on first use.
+
+        A separate pool, a worker waits for its prefetcher, which must not queue behind the workers.
+        """
+        with self._executor_lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._max_workers, thread_name_prefix='fhir-prefetch'
+                )
+            return self._prefetch_executor
+
+    def close(self):
+        """Shut down the worker threads and the async engine, close every client's connections."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            if self._prefetch_executor is not None:
+                self._prefetch_executor.shutdown(wait=True)
+                self._prefetch_executor = None
+        if self._engine is not None:
+            self._engine.close()
+        for _client in self._clients:
+            _client.server.session.close()
+
+    def __enter__(self):
+        """Use as a context manager, `close()` on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Close."""
+        self.close()
+
+    def _store_slot(self, url):
+        """Return a context that holds one of max_per_store slots of url's api base, or does nothing if there is no cap.
+
+        Held by the shared adapter for a single request, see anvil.clients.connections.SlotAdapter.
+        """
+        for base_uri, semaphore in self._store_semaphores.items():
+            if url.startswith(base_uri):
+                return semaphore
+        return nullcontext()
+
+    def _request_json(self, server, path) -> dict:
+        """Return server.request_json(path), the shared adapter holds server's slot."""
+        return server.request_json(path)
+
+    def _map_servers(self, _worker, *args, **kwargs) -> list:
+        """Call _worker(server, *args, **kwargs) for every client's server on the shared executor.
+
+        Return the results in the order they complete. Called from one of the executor's own threads
+        (e.g. a search inside a dispatched callback), the calls are made in that thread, avoiding a deadlock
+        when every worker thread is waiting on the pool.
+        """
         results = []
-        # We can use a with statement to ensure threads are cleaned up promptly
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
-            # Start the load operations and mark each future with its URL
-            future_result = {executor.submit(_worker, _client.server, *args, **kwargs, ): _client for _client in self._clients}
-            for future in concurrent.futures.as_completed(future_result):
-                try:
-                    worker_results = future.result()
-                    results.append(worker_results)
-                except Exception as exc:
-                    if 'FHIRPermissionDeniedException' in exc.__class__.__name__:
-                        # requests.response embedded in exception
-                        logger.error(f"{str(exc)} {exc.args[0].url}")
+        if getattr(_executor_thread, 'active', False):
+            for _client in self._clients:
+                results.append(_worker(_client.server, *args, **kwargs))
+            return results
+        future_result = {self.executor.submit(_worker, _client.server, *args, **kwargs): _client for _client in self._clients}
+        for future in concurrent.futures.as_completed(future_result):
+            try:
+                results.append(future.result())
+            except Exception as exc:
+                if 'FHIRPermissionDeniedException' in exc.__class__.__name__:
+                    # requests.response embedded in exception
                     logger.error(f"{str(exc)} {exc.args[0].url}")
-                    raise exc
+                raise exc
         return results
 
+    def dispatch(self, _worker, *args, **kwargs):
+        """Execute callback(server) on thread for every server. """
+        return self._map_servers(_worker, *args, **kwargs)
+
+
+def _mark_executor_thread():
+    """Executor initializer, see DispatchingFHIRClient._map_servers."""
+    _executor_thread.active = True
+
+
+def _source_bundle(page: dict, server) -> Bundle:
+    """Return a Bundle of a search page fetched from server, with meta.source set to the server's base_uri."""
+    bundle = Bundle(page)
+    bundle.origin_server = server
+    if not bundle.meta:
+        bundle.meta = Meta()
+    if not bundle.meta.source:
+        bundle.meta.source = server.base_uri
+    return bundle
+
+
+def _bundle_resources(bundle) -> List[Resource]:
+    """Return the resources of bundle's entries, each tagged with its entry's fullUrl."""
+    resources = []
+    if not bundle.entry:
+        return resources
+    for entry in bundle.entry:
+        if not entry.resource.meta:
+            entry.resource.meta = Meta()
+
+        # if not entry.resource.meta.source:
+        #     assert bundle.meta, bundle.as_json()
+        #     entry.resource.meta.source = bundle.meta.source
+
+        # add tag for fullURL, allows caller
+        # to disambiguate resources returned from different base URL
+        if not entry.resource.meta.tag:
+            entry.resource.meta.tag = []
+        entry.resource.meta.tag.append(
+            FHIRIdentifier.Identifier(
+                {
+                    "system": "https://nih-ncpi.github.io/ncpi-fhir-ig/#fullUrl",
+                    "value": entry.fullUrl
+                }
+            )
+        )
+        resources.append(entry.resource)
+    return resources
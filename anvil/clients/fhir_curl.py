@@ -2,9 +2,9 @@
 
 """Send query to multiple FHIR endpoints, consume all pages, write results to stdout."""
 
-import json
 import logging
 import os
+import sys
 import urllib.parse as urlparse
 
 import click
@@ -13,6 +13,7 @@ from fhirclient.server import FHIRJSONMimeType
 
 from anvil.clients.fhir_client import DispatchingFHIRClient
 from anvil.clients.smart_auth import GoogleFHIRAuth
+from fhir_workshop.decoder import dumps, loads
 LOG_FORMAT = '%(asctime)s %(name)s %(levelname)-8s %(message)s'
 
 
@@ -42,7 +43,8 @@ def worker(server, path=None, no_sign=False, headers={}):
         # perform the request but intercept 401 responses, raising our own Exception
         res = server.session.get(url, headers=_headers)
         server.raise_for_status(res)
-        __json = res.json()
+        # decode the body's bytes directly, skips requests' text decode
+        __json = loads(res.content)
         __next = None
         if 'link' in __json:
             _links = {lnk['relation']: lnk['url'] for lnk in __json['link']}
@@ -58,7 +60,9 @@ def worker(server, path=None, no_sign=False, headers={}):
     _url = initial_url
     while _url:
         (_json, _url) = fetch(_url, _headers=headers)
-        print(json.dumps(_json, separators=(',', ':')), flush=True)
+        # one write per page, the buffered writer is shared by the worker threads
+        sys.stdout.buffer.write(dumps(_json) + b'\n')
+        sys.stdout.buffer.flush()
 
 
 def _dispatch(project, location, dataset, all_data_stores, requested_data_store, path, token):
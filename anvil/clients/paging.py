@@ -0,0 +1,178 @@
+"""Follow the `next` links of searches in background threads, bounding how far fetching runs ahead of the consumer."""
+
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks for an abandoned consumer, while waiting for room in the queue
+_POLL_INTERVAL = 0.1
+
+
+class _Failed(object):
+    """Carries the fetcher thread's exception to the consumer."""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_DONE = object()
+
+
+def next_path(page: dict):
+    """Return the path and query of a Bundle's `next` link, None if it is the last page.
+
+    FHIRServer.request_json takes a path & query relative to the server (not host).
+    """
+    for link in page.get('link') or []:
+        if link.get('relation') == 'next' and link.get('url'):
+            parts = urlparse(link['url'])
+            assert len(parts.query) > 0, parts
+            return f"{parts.path}?{parts.query}"
+    return None
+
+
+def iter_pages(fetch: Callable[[str], dict], path, retrieve_all=True, prefetch=2,
+               submit: Callable = None) -> Iterator[dict]:
+    """Yield the raw json of each page of a search.
+
+    With prefetch > 0 and retrieve_all, a thread requests the next page as soon as the `next` link is read from
+    the current page's raw json, while the consumer works on earlier pages (e.g. builds Bundle models).
+    At most prefetch pages wait for the consumer, the thread blocks until there is room.
+    Closing the generator early stops the thread.
+
+    :param fetch: Returns the decoded json of path, e.g. FHIRServer.request_json.
+    :param retrieve_all: If False, only the first page.
+    :param prefetch: Number of pages fetched ahead of the consumer, 0 fetches a page only when it is needed.
+    :param submit: Runs the prefetch loop, e.g. a persistent executor's submit (see DispatchingFHIRClient), by default
+     on a new 'fhir-prefetch' thread. It must not run on the consumer's own pool, the consumer waits for it.
+    """
+    if not retrieve_all or prefetch < 1:
+        return _fetch_pages(fetch, path, retrieve_all)
+    return _prefetch_pages(fetch, path, prefetch, submit)
+
+
+def _fetch_pages(fetch: Callable[[str], dict], path, retrieve_all) -> Iterator[dict]:
+    """Fetch each page when the consumer asks for it."""
+    while path:
+        page = fetch(path)
+        yield page
+        path = next_path(page) if retrieve_all else None
+
+
+def _prefetch_pages(fetch: Callable[[str], dict], path, prefetch, submit) -> Iterator[dict]:
+    """Fetch pages ahead of the consumer, see iter_pages."""
+    pages = _PageQueue(prefetch)
+    if submit is None:
+        threading.Thread(target=pages.fetch_all, args=(fetch, path), name='fhir-prefetch', daemon=True).start()
+    else:
+        submit(pages.fetch_all, fetch, path)
+    yield from pages
+
+
+class _PageQueue(object):
+    """Pages of one search fetched ahead of its consumer, at most maxsize waiting."""
+
+    def __init__(self, maxsize):
+        """Nothing is fetched until fetch_all runs."""
+        self._pages = queue.Queue(maxsize=maxsize)
+        # set when the consumer goes away
+        self._stopped = threading.Event()
+
+    def _put(self, item) -> bool:
+        """Wait for room in the queue, return False if the consumer went away."""
+        while not self._stopped.is_set():
+            try:
+                self._pages.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch_all(self, fetch: Callable[[str], dict], path):
+        """Follow `next` links from path, queue every page, the end of the search or the error that stopped it."""
+        try:
+            while path:
+                page = fetch(path)
+                path = next_path(page)
+                if not self._put(page):
+                    return
+            self._put(_DONE)
+        except Exception as e:
+            self._put(_Failed(e))
+
+    def __iter__(self) -> Iterator[dict]:
+        """Yield the queued pages, re-raise a fetch error. Closing the iterator stops fetch_all."""
+        try:
+            while True:
+                page = self._pages.get()
+                if page is _DONE:
+                    return
+                if isinstance(page, _Failed):
+                    raise page.exception
+                yield page
+        finally:
+            self._stopped.set()
+
+
+def merge_pages(fetch: Callable[[object, str], dict], servers: List, path, retrieve_all=True,
+                max_pages=8, submit: Callable = None) -> Iterator[Tuple[object, dict]]:
+    """Yield (server, page json) of a search of every server, in the order pages arrive.
+
+    Each server's `next` links are followed one page at a time, the next page is requested before a page is yielded,
+    so fetching overlaps consuming. A page is only requested while fewer than max_pages pages are requested,
+    fetched or yielded and not yet consumed, so slow consumers slow the fetching down.
+    Requests are submitted by the consumer and never wait for it, so they can share a pool with other work.
+    Closing the generator early stops requesting pages, the first fetch error is re-raised.
+
+    :param fetch: Returns the decoded json of (server, path), e.g. `lambda server, path: server.request_json(path)`.
+    :param max_pages: Maximum number of fetched pages not yet consumed, across all servers.
+    :param submit: Runs a fetch, e.g. a persistent executor's submit, by default a pool of this call's own.
+    """
+    assert max_pages > 0, "max_pages should be positive"
+    if submit is not None:
+        yield from _merge_pages(fetch, servers, path, retrieve_all, max_pages, submit)
+        return
+    with ThreadPoolExecutor(max_workers=max(min(len(servers), max_pages), 1), thread_name_prefix='fhir-merge') as executor:
+        yield from _merge_pages(fetch, servers, path, retrieve_all, max_pages, executor.submit)
+
+
+def _merge_pages(fetch, servers, path, retrieve_all, max_pages, submit) -> Iterator[Tuple[object, dict]]:
+    """See merge_pages."""
+    # (server, path) of the pages to request next, a server has at most one
+    ready = deque((server, path) for server in servers)
+    pages = queue.Queue()
+    requested = 0
+    while ready or requested:
+        requested = _submit_ready(fetch, pages, ready, requested, max_pages, submit)
+        server, page = pages.get()
+        requested -= 1
+        if isinstance(page, _Failed):
+            raise page.exception
+        next_page_path = next_path(page) if retrieve_all else None
+        if next_page_path:
+            ready.append((server, next_page_path))
+        # fetch the next page while this one is consumed, it counts against max_pages until then
+        requested = _submit_ready(fetch, pages, ready, requested, max_pages - 1, submit)
+        yield server, page
+
+
+def _submit_ready(fetch, pages: queue.Queue, ready: deque, requested, max_requested, submit) -> int:
+    """Request the ready pages while fewer than max_requested are requested. Return the number requested."""
+    while ready and requested < max_requested:
+        submit(_fetch_page, fetch, pages, *ready.popleft())
+        requested += 1
+    return requested
+
+
+def _fetch_page(fetch, pages: queue.Queue, server, path):
+    """Queue (server, page json) of path, or the error fetching it."""
+    try:
+        pages.put((server, fetch(server, path)))
+    except Exception as e:
+        pages.put((server, _Failed(e)))
@@ -88,8 +88,10 @@ class GoogleFHIRAuth(auth.FHIRAuth):
             - output - The launch context dictionary, or None on failure
         """
         logger.debug("SMART AUTH: Refreshing token")
+        # _get_auth_value only fetches a token when there is none
+        self.access_token = None
         self.access_token = self._get_auth_value()
-        return {'access_token': self._access_token}
+        return {'access_token': self.access_token}
 
     def handle_401(self, response, **kwargs):
         """Handle failed requests when authorization failed.
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+"""Benchmark reading, loading and querying the manifest datasets, compare against a baseline to flag regressions."""
+
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import click
+from click_loglevel import LogLevel
+
+import fhir_workshop.manifests
+from fhir_workshop.graph import load_graph, summarize_graph, find_by_resource_type, find_nearest
+from fhir_workshop.profiling import LoadProfile
+from fhir_workshop.resources import read_resources
+
+logger = logging.getLogger(__name__)
+
+# bump when the layout of the results changes
+RESULTS_VERSION = 1
+
+# name -> (manifest function, load_graph strict)
+DATASETS = {
+    'ncpi': (fhir_workshop.manifests.ncpi_file_paths, True),
+    'kf': (fhir_workshop.manifests.kf_file_paths, True),
+    'dbgap': (fhir_workshop.manifests.dbgap_file_paths, True),
+    'synthea': (fhir_workshop.manifests.synthea_file_paths, False),
+    'genomic_reporting': (fhir_workshop.manifests.genomic_reporting_file_paths, True),
+    'anvil': (fhir_workshop.manifests.anvil_file_paths, False),
+    'phs000424': (fhir_workshop.manifests.phs000424_file_paths, False),
+    'gtex_v8': (fhir_workshop.manifests.gtex_v8_file_paths, True),
+}
+
+# metrics where a larger value is a regression, all others are informational
+METRICS = (
+    'read_resources.seconds',
+    'load_graph.seconds',
+    'load_graph.peak_memory',
+    'summarize_graph.seconds',
+    'find_by_resource_type.seconds',
+    'find_nearest.seconds',
+)
+
+
+def benchmark_dataset(name, file_paths, strict=True, repeat=3, lazy=False, backend='networkx', samples=10) -> dict:
+    """Measure one dataset, timings are the best of repeat runs, query latencies the median of all calls.
+
+    :param strict: Passed to read_resources and load_graph.
+    :param lazy: Passed to load_graph.
+    :param backend: Passed to load_graph, 'sqlite' writes its database to a temporary directory.
+    :param samples: Number of nodes find_nearest starts from, per resourceType searched for.
+    """
+    assert repeat > 0, "repeat should be positive"
+    result = {'file_count': len(file_paths), 'metrics': {}}
+    _benchmark_read(result, file_paths, strict, repeat)
+    load = partial(_loaded_graph, name, file_paths, strict=strict, lazy=lazy, backend=backend)
+    _benchmark_load(result, load, repeat)
+    # peak memory in a separate run, tracemalloc slows allocation down, queries run on that graph
+    profile = LoadProfile(trace_memory=True)
+    with load(profile=profile) as graph:
+        result['metrics']['load_graph.peak_memory'] = profile.peak_memory
+        _benchmark_queries(result, graph, repeat, samples)
+    return result
+
+
+def _benchmark_read(result, file_paths, strict, repeat):
+    """Time read_resources, decode and build every model."""
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        resource_count = 0
+        for file_path in file_paths:
+            for _ in read_resources(file_path, strict=strict):
+                resource_count += 1
+        seconds.append(time.perf_counter() - started)
+    result['resource_count'] = resource_count
+    result['metrics']['read_resources.seconds'] = min(seconds)
+    result['read_resources.resources_per_second'] = resource_count / min(seconds) if min(seconds) else None
+
+
+@contextmanager
+def _loaded_graph(name, file_paths, strict=True, lazy=False, backend='networkx', profile=None):
+    """Yield the graph load_graph returns, the sqlite backend's database is removed on exit."""
+    if backend != 'sqlite':
+        yield load_graph(name, file_paths, expected_resource_count=1, strict=strict, lazy=lazy, backend=backend,
+                         profile=profile)
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        graph = load_graph(name, file_paths, expected_resource_count=1, strict=strict, backend=backend,
+                           database_path=os.path.join(directory, f"{name}.sqlite"), profile=profile)
+        try:
+            yield graph
+        finally:
+            graph.close()
+
+
+def _benchmark_load(result, load: Callable, repeat):
+    """Time load_graph, load(profile=) is a _loaded_graph."""
+    profiles = []
+    for _ in range(repeat):
+        profile = LoadProfile()
+        with load(profile=profile) as graph:
+            result['edge_count'] = graph.number_of_edges()
+        profiles.append(profile)
+    fastest = min(profiles, key=lambda profile_: profile_.wall_time)
+    result['metrics']['load_graph.seconds'] = fastest.wall_time
+    result['load_graph.phases'] = fastest.report()['phases']
+
+
+def _benchmark_queries(result, graph, repeat, samples):
+    """Time summarize_graph, find_by_resource_type and find_nearest from samples nodes of each resourceType."""
+    metrics = result['metrics']
+    metrics['summarize_graph.seconds'] = _best_of(repeat, lambda: summarize_graph(graph))
+    resource_types = list(summarize_graph(graph).nodes)
+    result['resource_types'] = len(resource_types)
+    metrics['find_by_resource_type.seconds'] = statistics.median(
+        _time_call(lambda: find_by_resource_type(graph, resource_type)) for resource_type in resource_types
+    ) if resource_types else None
+
+    latencies = []
+    for resource_type in resource_types:
+        from_nodes = [node_id for node_id, _ in find_by_resource_type(graph, resource_type)][:samples]
+        for target_type in resource_types:
+            if target_type == resource_type:
+                continue
+            for from_node in from_nodes:
+                latencies.append(_time_call(lambda: find_nearest(graph, from_node, target_type)))
+    result['find_nearest.calls'] = len(latencies)
+    metrics['find_nearest.seconds'] = statistics.median(latencies) if latencies else None
+
+
+def run_benchmarks(datasets: Dict[str, tuple], repeat=3, lazy=False, backend='networkx', samples=10) -> dict:
+    """Benchmark each of {name: (file_paths, strict)}, datasets without files (e.g. fixtures not downloaded) are skipped."""
+    results = {
+        'version': RESULTS_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'repeat': repeat, 'lazy': lazy, 'backend': backend, 'samples': samples},
+        'datasets': {},
+    }
+    for name, (file_paths, strict) in datasets.items():
+        file_paths = [file_path for file_path in file_paths if os.path.isfile(file_path)]
+        if not file_paths:
+            logger.warning(f"Skipping {name}, no files found")
+            continue
+        logger.info(f"Benchmarking {name} {len(file_paths)} files")
+        results['datasets'][name] = benchmark_dataset(name, file_paths, strict=strict, repeat=repeat, lazy=lazy,
+                                                      backend=backend, samples=samples)
+    return results
+
+
+def manifest_datasets(names: List[str] = None, fixtures_path=None) -> Dict[str, tuple]:
+    """Return {name: (file_paths, strict)} of the manifest datasets, all of them if names is not set."""
+    fixtures_path = fixtures_path or fhir_workshop.manifests.default_fixtures_path()
+    datasets = {}
+    for name in names or DATASETS:
+        assert name in DATASETS, f"Unknown dataset {name}, expected one of {list(DATASETS)}"
+        file_paths_function, strict = DATASETS[name]
+        datasets[name] = (file_paths_function(fixtures_path), strict)
+    return datasets
+
+
+def compare_results(results: dict, baseline: dict, tolerance=0.2, noise=0.001) -> List[str]:
+    """Return a message for each metric that is more than tolerance (a fraction) worse than the baseline.
+
+    Only datasets and metrics present in both are compared.
+
+    :param noise: Timings that differ from the baseline by less than this many seconds are not regressions.
+    """
+    regressions = []
+    for name, dataset in results['datasets'].items():
+        baseline_dataset = baseline.get('datasets', {}).get(name)
+        if baseline_dataset is None:
+            continue
+        for metric in METRICS:
+            value = dataset['metrics'].get(metric)
+            expected = baseline_dataset['metrics'].get(metric)
+            if not value or not expected:
+                continue
+            if metric.endswith('.seconds') and value - expected < noise:
+                continue
+            if value > expected * (1 + tolerance):
+                regressions.append(f"{name} {metric} {value:.6g} > {expected:.6g} (+{value / expected - 1:.0%})")
+    return regressions
+
+
+def save_results(results: dict, path):
+    """Write results as json."""
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2)
+
+
+def load_results(path) -> dict:
+    """Read results written by save_results."""
+    with open(path) as fp:
+        results = json.load(fp)
+    assert results.get('version') == RESULTS_VERSION, f"{path} version {results.get('version')} != {RESULTS_VERSION}"
+    return results
+
+
+def generate_synthetic_corpus(path, patients=100, studies=2, specimens_per_patient=2, observations_per_patient=3,
+                              seed=0) -> List[str]:
+    """Write a synthetic study as ndjson, one file per resourceType. Return the file paths.
+
+    Shaped like the AnVIL and Kids First fixtures: ResearchStudy, Patient, ResearchSubject, Specimen, Observation,
+    DocumentReference and Task resources, with literal references and some identifier based (conditional) references.
+    """
+    rng = random.Random(seed)
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    system = 'https://example.org/synthetic'
+    resources = {resource_type: [] for resource_type in
+                 ['ResearchStudy', 'Patient', 'ResearchSubject', 'Specimen', 'Observation', 'DocumentReference', 'Task']}
+
+    for study in range(studies):
+        resources['ResearchStudy'].append({'resourceType': 'ResearchStudy', 'id': f"study-{study}", 'status': 'completed',
+                                           'title': f"Synthetic study {study}"})
+    for patient in range(patients):
+        patient_id = f"patient-{patient}"
+        study_id = f"study-{rng.randrange(studies)}"
+        resources['Patient'].append({
+            'resourceType': 'Patient', 'id': patient_id, 'gender': rng.choice(['male', 'female', 'unknown']),
+            'identifier': [{'system': system, 'value': patient_id}],
+        })
+        resources['ResearchSubject'].append({
+            'resourceType': 'ResearchSubject', 'id': f"subject-{patient}", 'status': 'on-study',
+            'study': {'reference': f"ResearchStudy/{study_id}"}, 'individual': {'reference': f"Patient/{patient_id}"},
+        })
+        specimen_ids = []
+        for specimen in range(specimens_per_patient):
+            specimen_id = f"specimen-{patient}-{specimen}"
+            specimen_ids.append(specimen_id)
+            resources['Specimen'].append({
+                'resourceType': 'Specimen', 'id': specimen_id, 'subject': {'reference': f"Patient/{patient_id}"},
+                'type': {'text': rng.choice(['Blood', 'Saliva', 'Tissue'])},
+            })
+            resources['DocumentReference'].append({
+                'resourceType': 'DocumentReference', 'id': f"document-{patient}-{specimen}", 'status': 'current',
+                'subject': {'reference': f"Patient/{patient_id}"},
+                'context': {'related': [{'reference': f"Specimen/{specimen_id}"}]},
+                'content': [{'attachment': {'url': f"gs://synthetic/{specimen_id}.cram", 'size': rng.randrange(1, 2 ** 31)}}],
+            })
+            resources['Task'].append({
+                'resourceType': 'Task', 'id': f"task-{patient}-{specimen}", 'status': 'completed', 'intent': 'order',
+                'focus': {'reference': f"Specimen/{specimen_id}"}, 'for': {'reference': f"Patient/{patient_id}"},
+                'output': [{'type': {'text': 'cram'},
+                            'valueReference': {'reference': f"DocumentReference/document-{patient}-{specimen}"}}],
+            })
+        for observation in range(observations_per_patient):
+            # a third of the observations refer to their patient by identifier
+            if observation % 3 == 2:
+                subject = {'reference': f"Patient?identifier={system}|{patient_id}"}
+            else:
+                subject = {'reference': f"Patient/{patient_id}"}
+            resources['Observation'].append({
+                'resourceType': 'Observation', 'id': f"observation-{patient}-{observation}", 'status': 'final',
+                'code': {'text': rng.choice(['Height', 'Weight', 'Age at enrollment'])}, 'subject': subject,
+                'specimen': {'reference': f"Specimen/{rng.choice(specimen_ids)}"} if specimen_ids else None,
+                'valueQuantity': {'value': round(rng.uniform(1, 200), 1)},
+            })
+
+    file_paths = []
+    for resource_type, resource_dicts in resources.items():
+        file_path = path / f"{resource_type}.ndjson"
+        with open(file_path, 'w') as fp:
+            for resource_dict in resource_dicts:
+                fp.write(json.dumps({key: value for key, value in resource_dict.items() if value is not None}))
+                fp.write('\n')
+        file_paths.append(str(file_path))
+    return file_paths
+
+
+def _time_call(function: Callable) -> float:
+    """Return the seconds function takes."""
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+
+def _best_of(repeat, function: Callable) -> float:
+    """Return the fastest of repeat calls of function, in seconds."""
+    return min(_time_call(function) for _ in range(repeat))
+
+
+@click.command()
+@click.option('--dataset', 'dataset_names', multiple=True, help=f"Manifest dataset(s) to run, one of {list(DATASETS)} [default: all]")
+@click.option('--synthetic', type=int, default=None, help='Also run a synthetic corpus with this many patients.')
+@click.option('--synthetic-path', default=None, help='Where to write the synthetic corpus [default: a temporary directory]')
+@click.option('--fixtures-path', default=None, help='Fixtures directory [default: tests/fixtures]')
+@click.option('--repeat', default=3, show_default=True, help='Runs per measurement.')
+@click.option('--backend', default='networkx', show_default=True, type=click.Choice(['networkx', 'compact', 'sqlite']))
+@click.option('--lazy', is_flag=True, default=False, help='Load lazily.')
+@click.option('--output', default=None, help='Write results json here.')
+@click.option('--baseline', default=None, help='Compare against results json written by a previous run.')
+@click.option('--tolerance', default=0.2, show_default=True, help='Fraction a metric may exceed its baseline.')
+@click.option("-l", "--log-level", type=LogLevel(), default=logging.INFO)
+def cli(dataset_names, synthetic, synthetic_path, fixtures_path, repeat, backend, lazy, output, baseline, tolerance, log_level):
+    """Benchmark the manifest datasets, exit with status 1 if any metric regressed against the baseline."""
+    logging.basicConfig(level=log_level, force=True)
+    datasets = {}
+    if dataset_names or not synthetic:
+        datasets.update(manifest_datasets(list(dataset_names), fixtures_path))
+    if synthetic:
+        if not synthetic_path:
+            synthetic_path = tempfile.mkdtemp()
+        datasets[f"synthetic_{synthetic}"] = (generate_synthetic_corpus(synthetic_path, patients=synthetic), True)
+    results = run_benchmarks(datasets, repeat=repeat, lazy=lazy, backend=backend)
+    if output:
+        save_results(results, output)
+    click.echo(json.dumps(results['datasets'], indent=2))
+    if baseline:
+        regressions = compare_results(results, load_results(baseline), tolerance)
+        for regression in regressions:
+            logger.error(f"Regression {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,377 @@
+"""Compact, integer indexed resource graph, an alternative to a networkx MultiDiGraph for very large studies.
+
+Node ids are interned to integers, resource types and edge names are stored as integer codes in NumPy arrays and
+adjacency is held in compressed sparse row (CSR) form.  A node's raw json is kept as compact bytes in a single
+buffer, its model is only built when requested.
+"""
+
+import logging
+from array import array
+from typing import Iterable, Iterator, List, Tuple
+
+import networkx as nx
+import numpy as np
+from fhirclient.models.resource import Resource
+
+from fhir_workshop.decoder import dumps
+from fhir_workshop.graph import ResourceCache, ResourceGraph, ResourceRecord, _NodeAttributes, _node_json, _parent_path, _scan_fhir_files
+from fhir_workshop.identifiers import IdentifierIndex
+from fhir_workshop.snapshot import MappedResource
+
+logger = logging.getLogger(__name__)
+
+
+class _CompactResourceCache(ResourceCache):
+    """ResourceCache that resolves references against a CompactGraph."""
+
+    def resolve(self, ref_id) -> Resource:
+        """Return the model of the node ref_id points to (either a node id or an identifier alias), None if not found."""
+        index = self.graph.node_index(ref_id)
+        return self.graph.resource(self.graph.node_ids[index]) if index is not None else None
+
+
+class CompactGraph(object):
+    """Resource graph stored as CSR adjacency arrays over interned integer node ids.
+
+    Supports the operations used on a networkx graph returned by load_graph: find_by_resource_type, find_nearest,
+    summarize_graph and neighbor iteration, use `to_networkx()` for anything else.
+    """
+
+    def __init__(self, name, node_ids, resource_types, type_codes, edge_names, indptr, indices, edge_codes,
+                 aliases, payloads, payload_offsets, max_materialized=10000, strict=True):
+        """Use `CompactGraph.from_records` or `load_graph(..., backend='compact')`."""
+        self.graph = {'name': name, 'aliases': aliases}
+        self.node_ids = node_ids
+        self._node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+        self.resource_types = resource_types
+        self._resource_type_codes = {resource_type: i for i, resource_type in enumerate(resource_types)}
+        self.type_codes = type_codes
+        # nodes grouped by type code, a CSR style index: nodes of type t are _type_nodes[_type_indptr[t]:_type_indptr[t + 1]]
+        self._type_nodes = np.argsort(type_codes, kind='stable')
+        self._type_indptr = np.zeros(len(resource_types) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(type_codes, minlength=len(resource_types)), out=self._type_indptr[1:])
+        self.edge_names = edge_names
+        self.indptr = indptr
+        self.indices = indices
+        self.edge_codes = edge_codes
+        self._payloads = payloads
+        self._payload_offsets = payload_offsets
+        self._cache = _CompactResourceCache(self, max_materialized, strict)
+        # (indptr, indices, edge codes) of incoming edges, built on first use
+        self._reverse = None
+
+    @classmethod
+    def from_records(cls, name, records: Iterable[ResourceRecord], check_edges=False, max_materialized=10000,
+                     strict=True) -> 'CompactGraph':
+        """Build from ResourceRecords, without creating a networkx graph."""
+        node_ids = []
+        node_index = {}
+        aliases = IdentifierIndex()
+        resource_types = {}
+        type_codes = array('i')
+        payloads = bytearray()
+        payload_offsets = array('q', [0])
+        edge_names = {}
+        # references are resolved once every node is known
+        sources, destination_ids, name_codes = array('i'), [], array('i')
+        for record in records:
+            # check if already in graph
+            if record.node_id in node_index:
+                logger.warning(f"{record.node_id} already in graph?")
+                continue
+            index = len(node_ids)
+            node_index[record.node_id] = index
+            node_ids.append(record.node_id)
+            type_codes.append(resource_types.setdefault(record.resource_type, len(resource_types)))
+            payloads += dumps(record.resource)
+            payload_offsets.append(len(payloads))
+            aliases.add(record.node_id, record.aliases)
+            for edge in record.edges:
+                sources.append(index)
+                destination_ids.append(edge.destination_id)
+                name_codes.append(edge_names.setdefault(edge.name, len(edge_names)))
+
+        # resolve destinations, create bidirectional edges
+        names = list(edge_names)
+        reverse_codes = [edge_names.setdefault(f"{edge_name}_", len(edge_names)) for edge_name in names]
+        edge_sources, edge_destinations, edge_codes = array('i'), array('i'), array('i')
+        for source, destination_id, name_code in zip(sources, destination_ids, name_codes):
+            # only look at the identifier xxxxxx?identifier=XXXXX
+            destination = node_index.get(aliases.resolve(destination_id) or destination_id)
+            if destination is None:
+                if check_edges:
+                    logger.warning(f"No destination {names[name_code]} {destination_id} from {node_ids[source]}")
+                continue
+            edge_sources.extend((source, destination))
+            edge_destinations.extend((destination, source))
+            edge_codes.extend((name_code, reverse_codes[name_code]))
+        del sources, destination_ids, name_codes
+
+        indptr, indices, edge_codes = _csr(len(node_ids), np.frombuffer(edge_sources, dtype=np.int32),
+                                           np.frombuffer(edge_destinations, dtype=np.int32),
+                                           np.frombuffer(edge_codes, dtype=np.int32))
+        return cls(name, node_ids, list(resource_types), np.frombuffer(type_codes, dtype=np.int32), list(edge_names),
+                   indptr, indices, edge_codes, aliases, bytes(payloads), np.frombuffer(payload_offsets, dtype=np.int64),
+                   max_materialized=max_materialized, strict=strict)
+
+    @classmethod
+    def from_networkx(cls, graph, max_materialized=10000, strict=True) -> 'CompactGraph':
+        """Build from a graph returned by load_graph."""
+        node_ids = list(graph.nodes)
+        node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+        resource_types = {}
+        type_codes = array('i')
+        payloads = bytearray()
+        payload_offsets = array('q', [0])
+        for node_id, attributes in graph.nodes(data=True):
+            type_codes.append(resource_types.setdefault(attributes['resource_type'], len(resource_types)))
+            payloads += dumps(_node_json(attributes))
+            payload_offsets.append(len(payloads))
+        edge_names = {}
+        sources, destinations, edge_codes = array('i'), array('i'), array('i')
+        for source, destination, name in graph.edges(data='name'):
+            sources.append(node_index[source])
+            destinations.append(node_index[destination])
+            edge_codes.append(edge_names.setdefault(name, len(edge_names)))
+        indptr, indices, edge_codes = _csr(len(node_ids), np.frombuffer(sources, dtype=np.int32),
+                                           np.frombuffer(destinations, dtype=np.int32),
+                                           np.frombuffer(edge_codes, dtype=np.int32))
+        return cls(graph.graph.get('name'), node_ids, list(resource_types), np.frombuffer(type_codes, dtype=np.int32),
+                   list(edge_names), indptr, indices, edge_codes, IdentifierIndex(graph.graph.get('aliases', {})), bytes(payloads),
+                   np.frombuffer(payload_offsets, dtype=np.int64), max_materialized=max_materialized, strict=strict)
+
+    def __len__(self):
+        """Number of nodes."""
+        return len(self.node_ids)
+
+    def __contains__(self, node_id):
+        """True if node_id is in the graph."""
+        return node_id in self._node_index
+
+    def number_of_nodes(self) -> int:
+        """Number of nodes."""
+        return len(self.node_ids)
+
+    def number_of_edges(self) -> int:
+        """Number of (directed) edges, each reference is stored as two edges."""
+        return len(self.indices)
+
+    def node_index(self, node_id):
+        """Return the integer id of node_id, which may also be an identifier alias, None if not found."""
+        index = self._node_index.get(node_id)
+        if index is None:
+            index = self._node_index.get(self.graph['aliases'].resolve(node_id))
+        return index
+
+    def _lazy_resource(self, index) -> MappedResource:
+        """Placeholder for the resource of node index."""
+        start, end = self._payload_offsets[index], self._payload_offsets[index + 1]
+        return MappedResource(self.node_ids[index], self.resource_types[self.type_codes[index]], self._payloads,
+                              int(start), int(end - start), self._cache)
+
+    def resource(self, node_id) -> Resource:
+        """Return the model of node_id, built from its json the first time it is requested."""
+        return self._lazy_resource(self._node_index[node_id]).resource()
+
+    def resource_json(self, node_id) -> dict:
+        """Return the raw json of node_id."""
+        return self._lazy_resource(self._node_index[node_id]).resource_json()
+
+    def node_attributes(self, node_id) -> dict:
+        """Return the same attributes as a load_graph node, `resource` is built on access."""
+        index = self._node_index[node_id]
+        return _NodeAttributes(resource=self._lazy_resource(index), resource_type=self.resource_types[self.type_codes[index]])
+
+    def edges(self, node_id) -> Iterable[Tuple[str, str, str]]:
+        """Yield (node_id, neighbor, edge name) for every edge leaving node_id."""
+        index = self._node_index[node_id]
+        start, end = self.indptr[index], self.indptr[index + 1]
+        for neighbor, edge_code in zip(self.indices[start:end].tolist(), self.edge_codes[start:end].tolist()):
+            yield node_id, self.node_ids[neighbor], self.edge_names[edge_code]
+
+    def neighbors(self, node_id) -> Iterable[str]:
+        """Yield the nodes node_id has an edge to, in insertion order, once per edge."""
+        index = self._node_index[node_id]
+        for neighbor in self.indices[self.indptr[index]:self.indptr[index + 1]].tolist():
+            yield self.node_ids[neighbor]
+
+    def find_by_resource_type(self, resource_type) -> List[Tuple[str, dict]]:
+        """Return those nodes that match type = resource_type, as (node_id, attributes)."""
+        return [(node_id, self.node_attributes(node_id)) for node_id in self.nodes_by_resource_type(resource_type)]
+
+    def nodes_by_resource_type(self, resource_type) -> List[str]:
+        """Return the ids of nodes of resource_type, in insertion order."""
+        code = self._resource_type_codes.get(resource_type)
+        if code is None:
+            return []
+        indices = self._type_nodes[self._type_indptr[code]:self._type_indptr[code + 1]]
+        return [self.node_ids[index] for index in indices.tolist()]
+
+    def find_nearest(self, from_node, resource_type, max_depth=None, edge_names=None):
+        """Find the nearest node of resource_type connected to from_node, see fhir_workshop.graph.find_nearest.
+
+        :returns: (node_id, distance, path) or (None, None, None)
+        """
+        for nearest in self.nearest_of_type(from_node, resource_type, max_depth, edge_names):
+            return nearest
+        return None, None, None
+
+    def nearest_of_type(self, from_node, resource_type, max_depth=None, edge_names=None) -> Iterator[tuple]:
+        """Yield (node_id, distance, path) for nodes of resource_type reachable from from_node, nearest first."""
+        start = self._node_index.get(from_node)
+        if start is None:
+            raise nx.NodeNotFound(f"Source {from_node} is not in G")
+        code = self._resource_type_codes.get(resource_type)
+        if code is None:
+            return
+        allowed = self._allowed_edge_codes(edge_names)
+        type_codes = self.type_codes
+        # node -> the node it was discovered from
+        parents = {start: None}
+        if type_codes[start] == code:
+            yield from_node, 0, [from_node]
+        frontier = [start]
+        distance = 0
+        while frontier and (max_depth is None or distance < max_depth):
+            distance += 1
+            next_frontier = []
+            for neighbor in self._undiscovered(frontier, parents, allowed):
+                if type_codes[neighbor] == code:
+                    yield self.node_ids[neighbor], distance, [self.node_ids[index] for index in _parent_path(parents, neighbor)]
+                next_frontier.append(neighbor)
+            frontier = next_frontier
+
+    def _undiscovered(self, frontier, parents, allowed) -> Iterator[int]:
+        """Yield the neighbors of frontier's nodes not in parents, following edges whose code is allowed (if set).
+
+        Records the node each was discovered from, lazy, see fhir_workshop.graph._undiscovered.
+        """
+        for index in frontier:
+            neighbors = self.indices[self.indptr[index]:self.indptr[index + 1]]
+            if allowed is not None:
+                neighbors = neighbors[allowed[self.edge_codes[self.indptr[index]:self.indptr[index + 1]]]]
+            for neighbor in neighbors.tolist():
+                if neighbor in parents:
+                    continue
+                parents[neighbor] = index
+                yield neighbor
+
+    def find_nearest_batch(self, from_nodes, resource_type, max_depth=None, edge_names=None) -> dict:
+        """Find the nearest node of resource_type for each of from_nodes, see fhir_workshop.graph.find_nearest_batch.
+
+        :returns: {from_node: (node_id, distance, path) or (None, None, None)}
+        """
+        sources = dict.fromkeys(from_nodes)
+        source_indices = np.zeros(len(self.node_ids), dtype=bool)
+        for from_node in sources:
+            index = self._node_index.get(from_node)
+            if index is None:
+                raise nx.NodeNotFound(f"Source {from_node} is not in G")
+            source_indices[index] = True
+        allowed = self._allowed_edge_codes(edge_names)
+        indptr, indices, edge_codes = self._reverse_csr()
+        # node -> next node on its path to the nearest node of resource_type, -1 for targets, -2 if not reached
+        next_hops = np.full(len(self.node_ids), -2, dtype=np.int64)
+        frontier = np.array([self._node_index[node_id] for node_id in self.nodes_by_resource_type(resource_type)],
+                            dtype=np.int64)
+        next_hops[frontier] = -1
+        remaining = int(np.count_nonzero(source_indices & (next_hops == -2)))
+        distance = 0
+        while remaining and len(frontier) and (max_depth is None or distance < max_depth):
+            distance += 1
+            # incoming edges of every frontier node, as (predecessor, frontier node) pairs
+            counts = indptr[frontier + 1] - indptr[frontier]
+            positions = np.repeat(indptr[frontier] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            predecessors = indices[positions]
+            hops = np.repeat(frontier, counts)
+            keep = next_hops[predecessors] == -2
+            if allowed is not None:
+                keep &= allowed[edge_codes[positions]]
+            predecessors, hops = predecessors[keep], hops[keep]
+            # first discovery wins, same as a queue based search
+            predecessors, first = np.unique(predecessors, return_index=True)
+            next_hops[predecessors] = hops[first]
+            remaining -= int(np.count_nonzero(source_indices[predecessors]))
+            frontier = predecessors
+
+        nearest = {}
+        for from_node in sources:
+            index = self._node_index[from_node]
+            if next_hops[index] == -2:
+                nearest[from_node] = (None, None, None)
+                continue
+            path = [index]
+            while next_hops[path[-1]] != -1:
+                path.append(int(next_hops[path[-1]]))
+            nearest[from_node] = (self.node_ids[path[-1]], len(path) - 1, [self.node_ids[i] for i in path])
+        return nearest
+
+    def _allowed_edge_codes(self, edge_names):
+        """Return a boolean mask over edge codes, None if all edges are allowed."""
+        if edge_names is None:
+            return None
+        edge_names = set(edge_names)
+        return np.array([name in edge_names for name in self.edge_names] or [False], dtype=bool)
+
+    def _reverse_csr(self):
+        """Return indptr, indices and edge codes of incoming edges."""
+        if self._reverse is None:
+            sources = np.repeat(np.arange(len(self.node_ids), dtype=np.int32), np.diff(self.indptr))
+            self._reverse = _csr(len(self.node_ids), self.indices, sources, self.edge_codes)
+        return self._reverse
+
+    def summarize_graph(self) -> nx.Graph:
+        """Create a graph of node and edge counts, computed with bincount over the type and edge name codes."""
+        summary_graph = nx.MultiDiGraph(name=f"{self.graph['name']}-summary")
+        type_count = len(self.resource_types)
+        for code, count in enumerate(np.bincount(self.type_codes, minlength=type_count).tolist()):
+            if count:
+                summary_graph.add_node(self.resource_types[code], count=count)
+        source_types = np.repeat(self.type_codes, np.diff(self.indptr))
+        destination_types = self.type_codes[self.indices]
+        keys = (source_types.astype(np.int64) * type_count + destination_types) * len(self.edge_names) + self.edge_codes
+        keys, counts = np.unique(keys, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            key, edge_code = divmod(key, len(self.edge_names))
+            source_type, destination_type = divmod(key, type_count)
+            summary_graph.add_edge(self.resource_types[source_type], self.resource_types[destination_type],
+                                   name=self.edge_names[edge_code], count=count)
+        logger.debug(f"SummaryGraph {summary_graph.graph['name']} nodes: {summary_graph.number_of_nodes()} edges: {summary_graph.number_of_edges()}")
+        return summary_graph
+
+    def to_networkx(self) -> ResourceGraph:
+        """Return an equivalent, lazily loaded, networkx graph."""
+        graph = ResourceGraph(name=self.graph['name'], aliases=self.graph['aliases'].copy(), pending={})
+        cache = ResourceCache(graph, self._cache.max_size, self._cache.strict)
+        graph.resource_cache = cache
+        for index, node_id in enumerate(self.node_ids):
+            resource = self._lazy_resource(index)
+            resource.cache = cache
+            graph.add_node(node_id, resource=resource, resource_type=resource.resource_type)
+        sources = np.repeat(np.arange(len(self.node_ids)), np.diff(self.indptr))
+        graph.add_edges_from(
+            (self.node_ids[source], self.node_ids[destination], {'name': self.edge_names[edge_code]})
+            for source, destination, edge_code in zip(sources.tolist(), self.indices.tolist(), self.edge_codes.tolist())
+        )
+        return graph
+
+
+def _csr(node_count, sources, destinations, edge_codes):
+    """Return indptr, indices and edge codes sorted by source, edges of the same source keep their insertion order."""
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=node_count), out=indptr[1:])
+    return indptr, destinations[order], edge_codes[order]
+
+
+def load_compact_graph(name, file_paths, expected_resource_count, strict=True, check_edges=False, workers=None,
+                       max_materialized=10000, profile=None) -> CompactGraph:
+    """Same as load_graph, but returns a CompactGraph."""
+    graph = CompactGraph.from_records(
+        name, (record for records in _scan_fhir_files(file_paths, workers, profile) for record in records),
+        check_edges=check_edges, max_materialized=max_materialized, strict=strict
+    )
+    assert graph.number_of_nodes() >= expected_resource_count, f"! {graph.number_of_nodes()} >= {expected_resource_count}"
+    if profile is not None:
+        profile.finish(graph)
+    return graph
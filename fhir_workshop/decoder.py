@@ -0,0 +1,92 @@
+"""JSON decoding and encoding, uses orjson when installed, the standard library otherwise.
+
+Covers ndjson lines, single line documents and payloads. Multi-line (or minified) documents that are streamed,
+e.g. large Bundles, are always decoded by the standard library, see fhir_workshop.resources._DocumentStream.
+"""
+
+import json
+import logging
+import os
+from typing import Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover, optional dependency
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+DECODERS = ('orjson', 'json')
+
+
+def _json_loads(data: Union[bytes, str]):
+    """Decode with the standard library, bytes may be utf-8, utf-16 or utf-32."""
+    return json.loads(data)
+
+
+def _json_dumps(value) -> bytes:
+    """Encode compactly with the standard library, as utf-8."""
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _orjson_loads(data: Union[bytes, str]):
+    """Decode with orjson, fall back to the standard library for what orjson rejects, e.g. a BOM or a huge integer.
+
+    Raises json.JSONDecodeError if neither can decode data.
+    """
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+
+def _orjson_dumps(value) -> bytes:
+    """Encode compactly with orjson, as utf-8."""
+    try:
+        return orjson.dumps(value)
+    except TypeError:
+        # e.g. an integer larger than 64 bits
+        return _json_dumps(value)
+
+
+_loads = _json_loads
+_dumps = _json_dumps
+_decoder = 'json'
+
+
+def use_decoder(name: str = None) -> str:
+    """Select the decoder, 'orjson' or 'json'. Return the previous one.
+
+    :param name: If None, orjson if it is installed, unless the FHIR_WORKSHOP_JSON environment variable says otherwise.
+    """
+    global _loads, _dumps, _decoder
+    if name is None:
+        name = os.environ.get('FHIR_WORKSHOP_JSON', 'orjson' if orjson is not None else 'json')
+    assert name in DECODERS, f"Unknown decoder {name}, expected one of {DECODERS}"
+    assert name != 'orjson' or orjson is not None, "orjson is not installed"
+    previous = _decoder
+    if name == 'orjson':
+        _loads, _dumps = _orjson_loads, _orjson_dumps
+    else:
+        _loads, _dumps = _json_loads, _json_dumps
+    _decoder = name
+    logger.debug(f"Using {name} to decode json")
+    return previous
+
+
+def decoder() -> str:
+    """Return the name of the decoder in use."""
+    return _decoder
+
+
+def loads(data: Union[bytes, str]):
+    """Decode a json document, from utf-8 bytes (preferred, no intermediate str) or a str."""
+    return _loads(data)
+
+
+def dumps(value) -> bytes:
+    """Encode value as compact json, utf-8 bytes."""
+    return _dumps(value)
+
+
+use_decoder()
@@ -1,16 +1,29 @@
 import logging
-from collections import namedtuple, defaultdict
+import time
+from array import array
+from functools import partial
+from typing import Iterator, Iterable, List, Optional, Tuple
+from itertools import islice
+from collections import namedtuple, defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import networkx as nx
 from fhirclient.models.fhirreference import FHIRReference
 from fhirclient.models.resource import Resource
 
-from fhir_workshop.resources import read_resources
+from fhir_workshop.identifiers import IdentifierIndex, identifier_alias, resource_aliases
+from fhir_workshop.profiling import LoadProfile, phase
+from fhir_workshop.references import find_references
+from fhir_workshop.resources import _bounded_map, _is_ndjson, ndjson_chunks, read_chunk_dicts, read_resource_dicts, resource_class
 import matplotlib.pyplot as plt
 
 logger = logging.getLogger(__name__)
 
 EdgeInfo = namedtuple("EdgeInfo", "source_id destination_id name")
+# a resource's raw json and everything needed to link it into a graph
+ResourceRecord = namedtuple("ResourceRecord", "node_id resource_type resource aliases edges")
+# bytes of ndjson scanned per task when load_graph has workers
+_SCAN_CHUNK_SIZE = 4 * 1024 * 1024
 
 
 def _static_reference_resolved(self,  klass=None) -> Resource:
@@ -24,6 +37,12 @@ def _static_reference_resolved(self,  klass=None) -> Resource:
     resolved = owning_resource.resolvedReference(ref_id)
     if resolved is not None:
         return resolved
+    # lazily loaded graph?
+    resolver = getattr(owning_resource, '_graph_resolver', None)
+    if resolver is not None:
+        resolved = resolver(ref_id)
+        if resolved is not None:
+            return resolved
     logger.warning(f"Referenced resource {ref_id} not found")
     return None
 
@@ -31,137 +50,644 @@ def _static_reference_resolved(self,  klass=None) -> Resource:
 FHIRReference.resolved = _static_reference_resolved
 
 
-def load_graph(name, file_paths, expected_resource_count, strict=True, check_edges=False) -> nx.Graph:
+class LazyResource(object):
+    """Placeholder stored in a node instead of a resource model, holds the resource's raw json."""
+
+    __slots__ = ('node_id', 'resource_type', 'resource_dict', 'cache')
+
+    def __init__(self, node_id, resource_type, resource_dict, cache):
+        """Nothing is built until `resource()` is called."""
+        self.node_id = node_id
+        self.resource_type = resource_type
+        self.resource_dict = resource_dict
+        self.cache = cache
+
+    def resource(self) -> Resource:
+        """Return the model, building it if it isn't in the cache."""
+        return self.cache.materialize(self)
+
+    def resource_json(self) -> dict:
+        """Return the raw json."""
+        return self.resource_dict
+
+
+class ResourceCache(object):
+    """Least recently used cache of the models materialized from a lazily loaded graph's LazyResources.
+
+    :param graph: Graph used to resolve the references of materialized models.
+    :param max_size: Maximum number of models kept alive by the cache.
+    :param strict: Passed to the model constructor.
+    """
+
+    def __init__(self, graph, max_size, strict=True):
+        """Create an empty cache."""
+        self.graph = graph
+        self.max_size = max_size
+        self.strict = strict
+        self._models = OrderedDict()
+
+    def __len__(self):
+        """Number of models currently cached."""
+        return len(self._models)
+
+    def materialize(self, lazy_resource) -> Resource:
+        """Return the cached model for lazy_resource or build it, evicting the least recently used model."""
+        model = self._models.get(lazy_resource.node_id)
+        if model is not None:
+            self._models.move_to_end(lazy_resource.node_id)
+            return model
+        model = resource_class(lazy_resource.resource_type)(lazy_resource.resource_json(), strict=self.strict)
+        # references are resolved on demand, see _static_reference_resolved
+        model._graph_resolver = self.resolve
+        self._models[lazy_resource.node_id] = model
+        if len(self._models) > self.max_size:
+            self._models.popitem(last=False)
+        return model
+
+    def evict(self, node_id):
+        """Drop the model of node_id, if cached."""
+        self._models.pop(node_id, None)
+
+    def resolve(self, ref_id) -> Resource:
+        """Return the model of the node ref_id points to (either a node id or an identifier alias), None if not found."""
+        node = self.graph.nodes.get(ref_id)
+        if node is None:
+            alias_node_id = self.graph.graph['aliases'].resolve(ref_id)
+            node = self.graph.nodes.get(alias_node_id) if alias_node_id else None
+        return node['resource'] if node is not None else None
+
+
+class _NodeAttributes(dict):
+    """Node attribute dictionary, returns the model of a LazyResource rather than the placeholder."""
+
+    def __getitem__(self, key):
+        """Materialize LazyResource."""
+        value = dict.__getitem__(self, key)
+        if isinstance(value, LazyResource):
+            return value.resource()
+        return value
+
+    def get(self, key, default=None):
+        """Materialize LazyResource."""
+        return self[key] if key in self else default
+
+
+class ResourceGraph(nx.MultiDiGraph):
+    """MultiDiGraph of FHIR resources, the `resource` attribute of a lazily loaded node is built on first access.
+
+    Maintains a resourceType -> node id index as nodes are added and removed, see `nodes_by_resource_type`.
+    The index follows the `resource_type` passed to add_node/add_nodes_from, not later changes to the attribute.
+    Likewise edge counts by (source type, destination type, name) follow the `name` passed to add_edge/add_edges_from,
+    so summarize_graph doesn't need to visit every edge.
+    """
+
+    node_attr_dict_factory = _NodeAttributes
+    # ResourceCache of a lazily loaded graph, None if nodes hold models
+    resource_cache = None
+
+    def __init__(self, incoming_graph_data=None, **attr):
+        """Create the index before networkx adds any incoming nodes."""
+        # resource_type -> {node_id: None}, dict as an insertion ordered set
+        self._resource_type_index = defaultdict(dict)
+        # EdgeInfo(source type, destination type, name) -> number of edges
+        self._edge_counts = defaultdict(int)
+        super(ResourceGraph, self).__init__(incoming_graph_data, **attr)
+
+    def _index_node(self, node):
+        """Move node to the index entry of its current resource_type."""
+        self._unindex_node(node)
+        resource_type = self._node[node].get('resource_type')
+        if resource_type is not None:
+            self._resource_type_index[resource_type][node] = None
+
+    def _unindex_node(self, node):
+        """Remove node from the index."""
+        attributes = self._node.get(node)
+        if attributes is None:
+            return
+        nodes = self._resource_type_index.get(dict.get(attributes, 'resource_type'))
+        if nodes is not None:
+            nodes.pop(node, None)
+
+    def add_node(self, node_for_adding, **attr):
+        """Add node, index its resource_type."""
+        if 'resource_type' in attr:
+            self._unindex_node(node_for_adding)
+        super(ResourceGraph, self).add_node(node_for_adding, **attr)
+        self._index_node(node_for_adding)
+
+    def add_nodes_from(self, nodes_for_adding, **attr):
+        """Add nodes, index their resource_type."""
+        nodes_for_adding = list(nodes_for_adding)
+        for n in nodes_for_adding:
+            # same rule as networkx, an unhashable item is a (node, attributes) tuple
+            try:
+                self._unindex_node(n)
+            except TypeError:
+                self._unindex_node(n[0])
+        super(ResourceGraph, self).add_nodes_from(nodes_for_adding, **attr)
+        for n in nodes_for_adding:
+            try:
+                self._index_node(n)
+            except TypeError:
+                self._index_node(n[0])
+
+    def remove_node(self, n):
+        """Remove node, drop it and its edges from the index."""
+        if n in self._succ:
+            self._count_node_edges(n, -1)
+        self._unindex_node(n)
+        super(ResourceGraph, self).remove_node(n)
+
+    def remove_nodes_from(self, nodes):
+        """Remove nodes, drop them and their edges from the index."""
+        for n in list(nodes):
+            if n in self._succ:
+                self.remove_node(n)
+
+    def clear(self):
+        """Remove all nodes, edges and graph attributes, empty the index."""
+        super(ResourceGraph, self).clear()
+        self._resource_type_index.clear()
+        self._edge_counts.clear()
+
+    def clear_edges(self):
+        """Remove all edges, reset the edge counts."""
+        super(ResourceGraph, self).clear_edges()
+        self._edge_counts.clear()
+
+    def _count_edge(self, u, v, name, increment):
+        """Add increment to the count of edges like u -> v."""
+        key = EdgeInfo(str(u).split('/')[0], str(v).split('/')[0], name)
+        self._edge_counts[key] += increment
+        if not self._edge_counts[key]:
+            del self._edge_counts[key]
+
+    def _count_node_edges(self, n, increment):
+        """Add increment to the counts of every edge into or out of n."""
+        for u, v, name in self.out_edges(n, data='name'):
+            self._count_edge(u, v, name, increment)
+        for u, v, name in self.in_edges(n, data='name'):
+            # self loops were counted as out edges
+            if u != v:
+                self._count_edge(u, v, name, increment)
+
+    def add_edge(self, u_for_edge, v_for_edge, key=None, **attr):
+        """Add edge, count it."""
+        if key is not None and key in self._succ.get(u_for_edge, {}).get(v_for_edge, {}):
+            # updating an existing edge
+            self._count_edge(u_for_edge, v_for_edge, self._succ[u_for_edge][v_for_edge][key].get('name'), -1)
+        key = super(ResourceGraph, self).add_edge(u_for_edge, v_for_edge, key, **attr)
+        self._count_edge(u_for_edge, v_for_edge, self._succ[u_for_edge][v_for_edge][key].get('name'), 1)
+        return key
+
+    def add_edges_from(self, ebunch_to_add, **attr):
+        """Add edges, count them. networkx sets the attributes after add_edge, pass them to add_edge instead."""
+        keys = []
+        for e in ebunch_to_add:
+            # same rules as networkx
+            if len(e) == 4:
+                u, v, key, dd = e
+            elif len(e) == 3:
+                u, v, dd = e
+                key = None
+            elif len(e) == 2:
+                u, v = e
+                dd = {}
+                key = None
+            else:
+                raise nx.NetworkXError(f"Edge tuple {e} must be a 2-tuple, 3-tuple or 4-tuple.")
+            edge_attr = dict(attr)
+            try:
+                edge_attr.update(dd)
+            except (TypeError, ValueError):
+                if len(e) != 3:
+                    raise
+                # 3rd value not a dict, must be a key
+                key = dd
+            keys.append(self.add_edge(u, v, key, **edge_attr))
+        return keys
+
+    def remove_edge(self, u, v, key=None):
+        """Remove edge, uncount it."""
+        keydict = self._succ.get(u, {}).get(v) or {}
+        # networkx removes the most recently added edge if key is None
+        removed = keydict.get(key) if key is not None else keydict[next(reversed(keydict))] if keydict else None
+        # raises if there is no such edge
+        super(ResourceGraph, self).remove_edge(u, v, key)
+        self._count_edge(u, v, removed.get('name'), -1)
+
+    def resource_type_counts(self) -> dict:
+        """Return {resource_type: number of nodes}."""
+        return {resource_type: len(nodes) for resource_type, nodes in self._resource_type_index.items() if nodes}
+
+    def edge_counts(self) -> dict:
+        """Return {EdgeInfo(source type, destination type, name): number of edges}."""
+        return dict(self._edge_counts)
+
+    def nodes_by_resource_type(self, resource_type) -> List[str]:
+        """Return the ids of nodes of resource_type, in insertion order."""
+        return list(self._resource_type_index.get(resource_type, ()))
+
+
+def load_graph(name, file_paths, expected_resource_count, strict=True, check_edges=False, workers=None,
+               lazy=False, max_materialized=10000, snapshot_path=None, backend='networkx', database_path=None,
+               profile: LoadProfile = None) -> nx.Graph:
     """Inspect resource's references, load into a graph, create bidirectional links,
-     resolve resource's references, including extensions."""
-
-    # from datetime import datetime
-    # print('load_graph start', datetime.now().isoformat())
+     resolve resource's references, including extensions.
+
+    :param workers: If > 1, files are parsed and scanned for references in this many processes.
+    :param lazy: If True, nodes hold the raw json, the model is built (and validated) the first time
+     graph.nodes[n]['resource'] is accessed.
+    :param max_materialized: In lazy mode, the maximum number of built models kept alive.
+    :param snapshot_path: If set, open the graph from this snapshot when it is current (the graph is lazy),
+     otherwise load file_paths and save a snapshot there. See fhir_workshop.snapshot.
+    :param backend: 'networkx', 'compact' or 'sqlite'. 'compact' returns a fhir_workshop.compact.CompactGraph,
+     integer indexed arrays that use a fraction of the memory. Resources are always lazily built and
+     snapshot_path is ignored. 'sqlite' writes the graph to a SQLite database at database_path and returns a
+     fhir_workshop.sqlite_graph.SQLiteGraph, for studies that don't fit in memory.
+    :param database_path: Where the 'sqlite' backend writes its database.
+    :param profile: If set, a fhir_workshop.profiling.LoadProfile that collects phase timings, counts and peak memory.
+    """
+    assert backend in ('networkx', 'compact', 'sqlite'), f"Unknown backend {backend}"
+    if backend != 'networkx':
+        return _load_backend_graph(backend, name, file_paths, expected_resource_count, strict=strict,
+                                   check_edges=check_edges, workers=workers, max_materialized=max_materialized,
+                                   database_path=database_path, profile=profile)
+    if snapshot_path:
+        graph = _open_snapshot(snapshot_path, file_paths, expected_resource_count, max_materialized, strict, profile)
+        if graph is not None:
+            return graph
+
+    graph = ResourceGraph(name=name, aliases=IdentifierIndex(), pending={})
+    cache = ResourceCache(graph, max_materialized, strict) if lazy else None
+    graph.resource_cache = cache
+    # raw json of each node is written to the snapshot as it is loaded
+    snapshot_writer = None
+    if snapshot_path:
+        # avoid circular import
+        from fhir_workshop.snapshot import SnapshotWriter
+        snapshot_writer = SnapshotWriter(snapshot_path)
+    try:
+        resource_count, forward_references = _add_fhir_files(graph, file_paths, workers, strict, cache, profile,
+                                                             snapshot_writer)
+
+        # every node is known, resolve any aliases
+        _resolve_forward_references(graph, forward_references, check_edges, profile)
+        del forward_references
+
+        assert graph.number_of_nodes() == resource_count, f"{graph.number_of_nodes()} != {resource_count} ?"
+        assert resource_count >= expected_resource_count, f"! {resource_count} >= {expected_resource_count}"
+        # assert len(graph.edges) > 0
+
+        if snapshot_writer is not None:
+            with phase(profile, 'snapshot'):
+                snapshot_writer.close(graph, file_paths)
+    except BaseException:
+        # a failed load leaves no partial snapshot behind
+        if snapshot_writer is not None:
+            snapshot_writer.abort()
+        raise
+    if profile is not None:
+        profile.finish(graph)
+    return graph
 
-    graph = nx.MultiDiGraph(name=name, aliases={})
 
-    resource_count = 0
-    edges = []
-    for file_path in file_paths:
-        resource_count = _process_fhir_file(graph, edges, file_path, resource_count, strict)
-
-    # print('load_graph finished _process_fhir_file', datetime.now().isoformat())
-
-    # first validate node existence, resolve any aliases
-    to_ignore = {}
-    to_add = []
-    for edge in edges:
-        # the source must exist
-        if check_edges:
-            assert graph.nodes.get(edge.source_id)
-        # only look at the identifier xxxxxx?identifier=XXXXX
-        if 'identifier' in edge.destination_id:
-            alias_lookup = edge.destination_id.split('?')[-1]
-            if alias_lookup in graph.graph['aliases']:
-                to_add.append(edge._replace(destination_id=graph.graph['aliases'][alias_lookup]))
-                to_ignore[edge.destination_id] = None
-    edges.extend(to_add)
-
-    # print('load_graph finished alias check', datetime.now().isoformat())
-
-    # create bidirectional edges and fill in the source resource's resolvedReference
-    for edge in edges:
-        if edge.destination_id in to_ignore:
-            continue
-        if check_edges and not graph.nodes.get(edge.destination_id):
+def _resolve_forward_references(graph, forward_references, check_edges, profile):
+    """Link the references buffered while loading, the rest wait in graph.graph['pending']."""
+    for edge in forward_references:
+        if not _add_reference(graph, edge, profile) and check_edges:
             logger.warning(f"No destination {edge.name} {edge.destination_id} from {edge.source_id}")
-            continue
-        source_resource = graph.nodes.get(edge.source_id)['resource']
-        destination_resource = graph.nodes.get(edge.destination_id)['resource']
-        source_resource.didResolveReference(edge.destination_id, destination_resource)
-        graph.add_edge(edge.source_id, edge.destination_id, name=edge.name)
-        # add a reverse link back
-        graph.add_edge(edge.destination_id, edge.source_id, name=f"{edge.name}_")
-
-    assert graph.number_of_nodes() == resource_count, f"{graph.number_of_nodes()} != {resource_count} ?"
-    assert resource_count >= expected_resource_count, f"! {resource_count} >= {expected_resource_count}"
-    # assert len(graph.edges) > 0
-
-    # print('load_graph finished edge creation ', datetime.now().isoformat())
+    collisions = graph.graph['aliases'].collisions
+    if check_edges and collisions:
+        logger.warning(f"{len(collisions)} identifiers are shared by more than one resource")
+
+
+def _load_backend_graph(backend, name, file_paths, expected_resource_count, database_path=None, **kwargs):
+    """Load with the 'compact' or 'sqlite' backend, see load_graph."""
+    # avoid circular imports
+    if backend == 'compact':
+        from fhir_workshop.compact import load_compact_graph
+        return load_compact_graph(name, file_paths, expected_resource_count, **kwargs)
+    assert database_path, "The sqlite backend requires a database_path"
+    from fhir_workshop.sqlite_graph import load_sqlite_graph
+    return load_sqlite_graph(name, file_paths, expected_resource_count, database_path, **kwargs)
+
+
+def _open_snapshot(snapshot_path, file_paths, expected_resource_count, max_materialized, strict, profile) -> Optional[ResourceGraph]:
+    """Return the graph in the snapshot at snapshot_path if it is current for file_paths, otherwise None."""
+    # avoid circular import
+    from fhir_workshop.snapshot import open_graph
+    graph = open_graph(snapshot_path, file_paths, max_materialized=max_materialized, strict=strict)
+    if graph is None:
+        return None
+    assert graph.number_of_nodes() >= expected_resource_count, f"! {graph.number_of_nodes()} >= {expected_resource_count}"
+    if profile is not None:
+        profile.finish(graph)
     return graph
 
 
-def _process_fhir_file(graph, edges, file_path, resource_count, strict):
-    """Load file_path into graph, populate edges with EdgeInfo."""
-    for resource in read_resources(file_path, strict=strict):
-        # add node to graph
-        node_id = f"{resource.resource_type}/{resource.id}"
-        # check if already in graph
-        if graph.nodes.get(node_id):
-            logger.warning(f"{node_id} already in graph?")
-            continue
-        graph.add_node(node_id, resource=resource, resource_type=resource.resource_type)
-        # add aliases
-        if resource.identifier:
-            resource_identifiers = resource.identifier
-            if not isinstance(resource_identifiers, list):
-                resource_identifiers = [resource_identifiers]
-            for identifier in resource_identifiers:
-                graph.graph['aliases'][f"identifier={identifier.system}|{identifier.value}"] = node_id
-        # logger.debug(f"graph add node {node_id} {file_path}")
-        # inspect properties, look for references, xform to edges
-        has_variable_reference = _find_references_in_variables(edges, node_id, resource)
-        has_extension_reference = _find_references_in_extension(edges, node_id, resource)
-        if not (has_variable_reference or has_extension_reference):
-            logger.debug(f"No references found for node {node_id} {file_path}")
+def _add_fhir_files(graph, file_paths, workers, strict, cache, profile, snapshot_writer) -> Tuple[int, '_ForwardReferences']:
+    """Add the resources of file_paths to graph, link the references whose destination is already known.
+
+    Return the number of resources added and the references to resolve once every node is known.
+    """
+    resource_count = 0
+    # references whose destination was not loaded yet, and identifier based references
+    forward_references = _ForwardReferences()
+    for records in _scan_fhir_files(file_paths, workers, profile):
+        for record in records:
+            if not _add_record(graph, record, strict, cache, profile):
+                continue
+            resource_count += 1
+            if snapshot_writer is not None:
+                with phase(profile, 'snapshot'):
+                    snapshot_writer.write(record.node_id, record.resource)
+            # create bidirectional edges now if the destination is known
+            with phase(profile, 'edges'):
+                for edge in record.edges:
+                    # an identifier's node may change as more resources are added, resolve those last
+                    if edge.destination_id in graph and identifier_alias(edge.destination_id) is None:
+                        _link(graph, edge, edge.destination_id)
+                    else:
+                        forward_references.append(edge)
+    return resource_count, forward_references
+
+
+def _scan_fhir_files(file_paths, workers, profile=None) -> Iterator[Iterable[ResourceRecord]]:
+    """Yield the ResourceRecords of file_paths in batches, in file order.
+
+    With workers, each ndjson file is scanned in chunks of about _SCAN_CHUNK_SIZE bytes (other files whole),
+    at most 2 * workers batches are in flight, so scanning does not run ahead of adding records to the graph.
+    """
+    if not workers or workers < 2:
+        for file_path in file_paths:
+            yield _process_fhir_file(file_path, profile)
+        return
+    tasks = ((file_path, chunk) for file_path in file_paths for chunk in _scan_chunks(file_path))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # results are returned in submission order, so node order does not depend on which worker finishes first
+        worker = partial(_process_fhir_file_worker, profiled=profile is not None)
+        for records, worker_profile in _bounded_map(executor, worker, tasks, 2 * workers):
+            if worker_profile is not None:
+                profile.merge(worker_profile)
+            yield records
+
+
+def _scan_chunks(file_path) -> List[Optional[Tuple[int, int]]]:
+    """Return the byte ranges to scan file_path in, [None] to scan it whole."""
+    if not _is_ndjson(file_path):
+        return [None]
+    return ndjson_chunks(file_path, _SCAN_CHUNK_SIZE)
+
+
+def _process_fhir_file_worker(task, profiled=False) -> Tuple[List[ResourceRecord], Optional[LoadProfile]]:
+    """Process pool entry point, scan a (file_path, chunk). Return its records and, if profiled, the time it took."""
+    file_path, chunk = task
+    profile = LoadProfile() if profiled else None
+    return list(_process_fhir_file(file_path, profile, chunk)), profile
+
+
+def _process_fhir_file(file_path, profile=None, chunk=None) -> Iterator[ResourceRecord]:
+    """Load file_path, yield a ResourceRecord carrying the raw json for each resource, no models are built.
+
+    :param chunk: If set, only the ndjson lines in this [start, end) byte range.
+    """
+    resource_dicts = read_resource_dicts(file_path) if chunk is None else read_chunk_dicts(file_path, *chunk)
+    if profile is not None:
+        yield from _profile_fhir_file(file_path, resource_dicts, profile)
+        return
+    for resource_dict in resource_dicts:
+        record = _resource_record(resource_dict)
+        if not record.edges:
+            logger.debug(f"No references found for node {record.node_id} {file_path}")
+        yield record
+
+
+def _profile_fhir_file(file_path, resource_dicts, profile) -> Iterator[ResourceRecord]:
+    """Same as _process_fhir_file, timing reading and scanning in profile."""
+    resource_count = 0
+    seconds = 0.0
+    while True:
+        started = time.perf_counter()
+        resource_dict = next(resource_dicts, None)
+        decoded = time.perf_counter()
+        if resource_dict is None:
+            profile.phases['read_decode'] += decoded - started
+            seconds += decoded - started
+            break
+        record = _resource_record(resource_dict)
+        scanned = time.perf_counter()
+        profile.phases['read_decode'] += decoded - started
+        profile.phases['references'] += scanned - decoded
+        seconds += scanned - started
         resource_count += 1
-    return resource_count
-
-
-def _find_references_in_extension(edges, node_id, resource):
-    """Find any reference in extensions, populate edges with EdgeInfo."""
-    has_reference = False
-    if resource.extension:
-        for extension in resource.extension:
-            if extension.valueReference:
-                variable_name = extension.url.split('/')[-1]
-                ref_id = extension.valueReference.processedReferenceIdentifier()
-                edges.append(EdgeInfo(node_id, ref_id, variable_name))
-                has_reference = True
-    return has_reference
-
-
-def _find_references_in_variables(edges, node_id, resource):
-    """Find any reference in public variables, populate edges with EdgeInfo."""
-    has_reference = False
-    for variable_name, variable in vars(resource).items():
-        if not variable:
+        profile.add_resource(record.resource_type)
+        yield record
+    profile.add_file(file_path, resource_count, seconds)
+
+
+def _resource_record(resource_dict) -> ResourceRecord:
+    """Return the ResourceRecord of a resource's raw json."""
+    resource_type = resource_dict['resourceType']
+    node_id = f"{resource_type}/{resource_dict.get('id')}"
+    aliases = resource_aliases(resource_dict)
+    # inspect properties, look for references, xform to edges
+    edges = [EdgeInfo(node_id, ref_id, name) for ref_id, name in find_references(resource_dict)]
+    return ResourceRecord(node_id, resource_type, resource_dict, aliases, edges)
+
+
+def _add_record(graph, record, strict, cache=None, profile=None) -> bool:
+    """Add the record's resource to graph, its aliases to the graph's aliases. Return False if already in graph.
+
+    The resource is stored as a LazyResource if there is a cache, otherwise its model is built.
+    A model built with strict=False keeps the raw json, it may not be valid, see _node_json.
+    """
+    # check if already in graph
+    if record.node_id in graph:
+        logger.warning(f"{record.node_id} already in graph?")
+        return False
+    if cache is not None:
+        resource = LazyResource(record.node_id, record.resource_type, record.resource, cache)
+    else:
+        with phase(profile, 'models'):
+            resource = resource_class(record.resource_type)(record.resource, strict=strict)
+        if not strict:
+            resource._resource_json = record.resource
+    # add node to graph
+    graph.add_node(record.node_id, resource=resource, resource_type=record.resource_type)
+    # add aliases
+    graph.graph['aliases'].add(record.node_id, record.aliases)
+    return True
+
+
+class _ForwardReferences(object):
+    """References waiting to be resolved, stored as parallel lists instead of EdgeInfo tuples.
+
+    Source ids are the graph's own node id strings, edge names are interned as integer codes.
+    """
+
+    def __init__(self):
+        """Create an empty buffer."""
+        self._source_ids = []
+        self._destination_ids = []
+        self._name_codes = array('i')
+        self._names = {}
+
+    def __len__(self):
+        """Number of references."""
+        return len(self._source_ids)
+
+    def append(self, edge):
+        """Buffer edge."""
+        self._source_ids.append(edge.source_id)
+        self._destination_ids.append(edge.destination_id)
+        self._name_codes.append(self._names.setdefault(edge.name, len(self._names)))
+
+    def __iter__(self) -> Iterator[EdgeInfo]:
+        """Yield the buffered references as EdgeInfo, in the order they were added."""
+        names = list(self._names)
+        for source_id, destination_id, name_code in zip(self._source_ids, self._destination_ids, self._name_codes):
+            yield EdgeInfo(source_id, destination_id, names[name_code])
+
+
+def add_resources(graph_, resource_dicts: Iterable[dict], strict=True) -> List[str]:
+    """Add resources to a graph returned by load_graph, without reloading it.
+
+    References are resolved as each resource is added, references to resources that are not (yet) in the graph
+    wait in graph.graph['pending'] and are linked when their destination is added.
+
+    :param resource_dicts: Raw json of the resources, e.g. from fhir_workshop.resources.read_resource_dicts
+    :param strict: Passed to the model constructor, unless the graph is lazily loaded.
+    :returns: ids of the added nodes, resources already in the graph are skipped, see upsert_resource
+    """
+    added = []
+    for resource_dict in resource_dicts:
+        record = _resource_record(resource_dict)
+        if not _add_record(graph_, record, strict, graph_.resource_cache):
             continue
-        if isinstance(variable, list):
-            items = variable
-        else:
-            items = [variable]
-        for item in items:
-            if not isinstance(item, FHIRReference):
-                continue
-            ref_id = item.processedReferenceIdentifier()
-            edges.append(EdgeInfo(node_id, ref_id, variable_name))
-            has_reference = True
-        # special handling for Task.output
-        if resource.resource_type == 'Task' and resource.output:
-            for task_output in resource.output:
-                if task_output.valueReference:
-                    ref_id = task_output.valueReference.processedReferenceIdentifier()
-                    edges.append(EdgeInfo(node_id, ref_id, variable_name))
-                    has_reference = True
-    return has_reference
+        for edge in record.edges:
+            _add_reference(graph_, edge)
+        # references that were waiting for this resource
+        for key in [record.node_id] + record.aliases:
+            for edge in graph_.graph['pending'].pop(key, []):
+                _add_reference(graph_, edge)
+        added.append(record.node_id)
+    return added
+
+
+def remove_resource(graph_, node_id):
+    """Remove a resource and its edges from a graph returned by load_graph.
+
+    References to the resource go back to graph.graph['pending'], they are linked again if it is re-added.
+    """
+    if node_id not in graph_:
+        raise nx.NetworkXError(f"The node {node_id} is not in the graph.")
+    record = _resource_record(_node_json(graph_.nodes[node_id]))
+    # reverse edges make every neighbor a predecessor, keep those that reference this resource
+    # found before anything is changed, so a failure leaves the graph as it was
+    references = [
+        EdgeInfo(predecessor, ref_id, name)
+        for predecessor in set(graph_.predecessors(node_id)) - {node_id}
+        for ref_id, name in find_references(_node_json(graph_.nodes[predecessor]))
+        if _resolve_destination(graph_, ref_id) == node_id
+    ]
+    pending = graph_.graph['pending']
+    for edge in references:
+        pending.setdefault(_pending_key(edge.destination_id), []).append(edge)
+        predecessor_resource = dict.__getitem__(graph_.nodes[edge.source_id], 'resource')
+        if not isinstance(predecessor_resource, LazyResource) and predecessor_resource._resolved:
+            # forget the resolved model, see didResolveReference
+            predecessor_resource._resolved.pop(edge.destination_id, None)
+    # its own references no longer wait
+    for edge in record.edges:
+        key = _pending_key(edge.destination_id)
+        if key in pending:
+            pending[key] = [pending_edge for pending_edge in pending[key] if pending_edge.source_id != node_id]
+            if not pending[key]:
+                del pending[key]
+    graph_.graph['aliases'].remove(node_id, record.aliases)
+    if graph_.resource_cache is not None:
+        graph_.resource_cache.evict(node_id)
+    graph_.remove_node(node_id)
+
+
+def upsert_resource(graph_, resource_dict: dict, strict=True) -> str:
+    """Add a resource to a graph returned by load_graph, replacing the resource with the same id.
+
+    :returns: the node id
+    """
+    node_id = f"{resource_dict['resourceType']}/{resource_dict.get('id')}"
+    if node_id in graph_:
+        remove_resource(graph_, node_id)
+    add_resources(graph_, [resource_dict], strict=strict)
+    return node_id
+
+
+def _pending_key(destination_id) -> str:
+    """Key of a reference in graph.graph['pending'], the alias for xxxxxx?identifier=XXXXX, the node id otherwise."""
+    return identifier_alias(destination_id) or destination_id
+
+
+def _resolve_destination(graph_, destination_id):
+    """Return the id of the node destination_id refers to, None if it is not in graph_."""
+    # only look at the identifier xxxxxx?identifier=XXXXX
+    alias_node_id = graph_.graph['aliases'].resolve(destination_id)
+    if alias_node_id is not None:
+        return alias_node_id
+    return destination_id if destination_id in graph_ else None
+
+
+def _add_reference(graph_, edge, profile=None) -> bool:
+    """Create bidirectional edges for edge, or add it to graph.graph['pending']. Return True if linked."""
+    with phase(profile, 'aliases'):
+        destination_id = _resolve_destination(graph_, edge.destination_id)
+    if destination_id is None:
+        graph_.graph['pending'].setdefault(_pending_key(edge.destination_id), []).append(edge)
+        return False
+    with phase(profile, 'edges'):
+        _link(graph_, edge, destination_id)
+    return True
+
+
+def _link(graph_, edge, destination_id):
+    """Create bidirectional edges from edge's source to destination_id, fill in the source's resolvedReference."""
+    if graph_.resource_cache is None:
+        graph_.nodes[edge.source_id]['resource'].didResolveReference(edge.destination_id, graph_.nodes[destination_id]['resource'])
+    graph_.add_edge(edge.source_id, destination_id, name=edge.name)
+    # add a reverse link back
+    graph_.add_edge(destination_id, edge.source_id, name=f"{edge.name}_")
+
+
+def _node_json(attributes) -> dict:
+    """Return the raw json of a node, without building a model for lazily loaded nodes.
+
+    Models built with strict=False return the json they were built from, as_json() raises if they are not valid.
+    """
+    resource = dict.__getitem__(attributes, 'resource')
+    if isinstance(resource, LazyResource):
+        return resource.resource_json()
+    resource_json = getattr(resource, '_resource_json', None)
+    return resource_json if resource_json is not None else resource.as_json()
 
 
 def summarize_graph(graph) -> nx.Graph:
     """Create a graph of node and edge counts"""
+    if not isinstance(graph, nx.Graph):
+        # e.g. CompactGraph
+        return graph.summarize_graph()
     summary_graph = nx.MultiDiGraph(name=f"{graph.graph['name']}-summary")
-    node_counts = defaultdict(int)
-    edge_counts = defaultdict(int)
-    for node in graph.nodes:
-        resource = graph.nodes[node]['resource']
-        node_counts[resource.resource_type] += 1
-    for edge in graph.edges:
-        edge_counts[EdgeInfo(edge[0].split('/')[0], edge[1].split('/')[0], graph.edges[edge]['name'])] += 1
+    if isinstance(graph, ResourceGraph) and not nx.is_frozen(graph):
+        # counts are maintained as nodes and edges are added
+        node_counts = graph.resource_type_counts()
+        edge_counts = graph.edge_counts()
+    else:
+        node_counts = defaultdict(int)
+        edge_counts = defaultdict(int)
+        for node, resource_type in graph.nodes(data='resource_type'):
+            node_counts[resource_type] += 1
+        for edge in graph.edges:
+            edge_counts[EdgeInfo(edge[0].split('/')[0], edge[1].split('/')[0], graph.edges[edge]['name'])] += 1
     for resource_type, count in node_counts.items():
         summary_graph.add_node(resource_type, count=count)
         logger.debug(f"summary_graph add node {resource_type} {count}")
@@ -195,7 +721,12 @@ def draw_graph(graph, path=None, layout='planar_layout', title=None):
         edge_dict[edge] = ':'.join([str(v) for v in graph.nodes[node].values() if isinstance(v, (type(None), str, int, float, bool))])
 
     layout_func = getattr(nx, layout)
-    pos = layout_func(graph)
+    try:
+        pos = layout_func(graph)
+    except nx.NetworkXException as e:
+        # e.g. planar_layout of a graph that is not planar
+        logger.warning(f"{layout} failed for {title}, using spring_layout. {e}")
+        pos = nx.spring_layout(graph)
     fig, ax = plt.subplots(1, 1, figsize=(15, 15))
     nx.draw(graph, pos, ax=ax, with_labels=True, labels=node_dict, node_size=6000, node_color='w', alpha=0.9,
             edgecolors="black")
@@ -213,23 +744,135 @@ def draw_graph(graph, path=None, layout='planar_layout', title=None):
 
 def find_by_resource_type(graph_, resource_type):
     """Return those nodes in graph G that match type = resource_type."""
+    if not isinstance(graph_, nx.Graph):
+        return graph_.find_by_resource_type(resource_type)
+    if isinstance(graph_, ResourceGraph) and not nx.is_frozen(graph_):
+        # O(result), views (e.g. subgraphs) share the class but not the index
+        return [(name, graph_.nodes[name]) for name in graph_.nodes_by_resource_type(resource_type)]
     return [(name, d) for name, d in graph_.nodes(data=True)
             if 'resource_type' in d and (d['resource_type'] == resource_type)]
 
 
-def find_nearest(graph_, from_node, resource_type):
-    """Find all nodes of resource_type connected to from_node. """
-    # Calculate the length of paths from from_node to all other nodes
-    lengths = nx.single_source_dijkstra_path_length(graph_, from_node, weight='distance')
-    paths = nx.single_source_dijkstra_path(graph_, from_node)
+def find_nearest(graph_, from_node, resource_type, max_depth=None, edge_names=None):
+    """Find the nearest node of resource_type connected to from_node.
+
+    Breadth first search from from_node, stops at the first node of resource_type.
+
+    :param max_depth: If set, don't follow paths longer than this.
+    :param edge_names: If set, only follow edges with these names.
+    :returns: (node_id, distance, path) or (None, None, None)
+    """
+    for nearest in _nearest_of_type(graph_, from_node, resource_type, max_depth, edge_names):
+        return nearest
+    # not found, no path from source to typeofnode
+    return None, None, None
+
+
+def find_k_nearest(graph_, from_node, resource_type, k, max_depth=None, edge_names=None):
+    """Find the k nearest nodes of resource_type connected to from_node, see find_nearest.
+
+    :returns: [(node_id, distance, path)] ordered by distance, at most k
+    """
+    return list(islice(_nearest_of_type(graph_, from_node, resource_type, max_depth, edge_names), k))
+
+
+def _nearest_of_type(graph_, from_node, resource_type, max_depth=None, edge_names=None) -> Iterator[tuple]:
+    """Yield (node_id, distance, path) for nodes of resource_type reachable from from_node, nearest first."""
+    if not isinstance(graph_, nx.Graph):
+        # e.g. CompactGraph
+        yield from graph_.nearest_of_type(from_node, resource_type, max_depth, edge_names)
+        return
+    if from_node not in graph_:
+        raise nx.NodeNotFound(f"Source {from_node} is not in G")
+    nodes = graph_.nodes
+    adjacency = graph_.adj
+    is_multigraph = graph_.is_multigraph()
+    edge_names = set(edge_names) if edge_names is not None else None
+    # node -> the node it was discovered from
+    parents = {from_node: None}
+    if nodes[from_node].get('resource_type') == resource_type:
+        yield from_node, 0, [from_node]
+    frontier = [from_node]
+    distance = 0
+    while frontier and (max_depth is None or distance < max_depth):
+        distance += 1
+        next_frontier = []
+        for neighbor in _undiscovered(adjacency, frontier, parents, edge_names, is_multigraph):
+            if nodes[neighbor].get('resource_type') == resource_type:
+                yield neighbor, distance, _parent_path(parents, neighbor)
+            next_frontier.append(neighbor)
+        frontier = next_frontier
+
+
+def _undiscovered(adjacency, frontier, parents, edge_names, is_multigraph) -> Iterator:
+    """Yield the neighbors of frontier's nodes not in parents, in discovery order, record the node they came from.
+
+    Lazy, so a search that stops early does not expand the rest of the frontier.
+    """
+    for node in frontier:
+        for neighbor, edge_data in adjacency[node].items():
+            if neighbor in parents:
+                continue
+            if edge_names is not None and not _has_edge_name(edge_data, edge_names, is_multigraph):
+                continue
+            parents[neighbor] = node
+            yield neighbor
+
+
+def _parent_path(parents, node) -> list:
+    """Return the path from the search's start to node, following parents."""
+    path = []
+    while node is not None:
+        path.append(node)
+        node = parents[node]
+    return path[::-1]
+
+
+def find_nearest_batch(graph_, from_nodes, resource_type, max_depth=None, edge_names=None) -> dict:
+    """Find the nearest node of resource_type for each of from_nodes, in a single pass.
+
+    Breadth first search backwards from every node of resource_type at once, stops once all from_nodes are reached.
+    Distances are the same as find_nearest's, when several nodes of resource_type are equally near the one
+    returned may differ.
+
+    :param max_depth: If set, don't follow paths longer than this.
+    :param edge_names: If set, only follow edges with these names.
+    :returns: {from_node: (node_id, distance, path) or (None, None, None)}
+    """
+    if not isinstance(graph_, nx.Graph):
+        # e.g. CompactGraph
+        return graph_.find_nearest_batch(from_nodes, resource_type, max_depth, edge_names)
+    sources = dict.fromkeys(from_nodes)
+    for from_node in sources:
+        if from_node not in graph_:
+            raise nx.NodeNotFound(f"Source {from_node} is not in G")
+    predecessors = graph_.pred if graph_.is_directed() else graph_.adj
+    is_multigraph = graph_.is_multigraph()
+    edge_names = set(edge_names) if edge_names is not None else None
+    # node -> next node on its path to the nearest node of resource_type
+    next_hops = {name: None for name, _ in find_by_resource_type(graph_, resource_type)}
+    remaining = sum(1 for from_node in sources if from_node not in next_hops)
+    frontier = list(next_hops)
+    distance = 0
+    while remaining and frontier and (max_depth is None or distance < max_depth):
+        distance += 1
+        # the undiscovered predecessors of every frontier node at once, their next hop is the node they came from
+        frontier = list(_undiscovered(predecessors, frontier, next_hops, edge_names, is_multigraph))
+        remaining -= sum(1 for predecessor in frontier if predecessor in sources)
+
+    nearest = {}
+    for from_node in sources:
+        if from_node not in next_hops:
+            nearest[from_node] = (None, None, None)
+            continue
+        # next hops lead to the nearest node of resource_type, the reverse of a parent path
+        path = _parent_path(next_hops, from_node)[::-1]
+        nearest[from_node] = (path[-1], len(path) - 1, path)
+    return nearest
 
-    # We are only interested in a particular type of node
-    sub_nodes = [name for name, dict_ in find_by_resource_type(graph_, resource_type)]
-    sub_dict = {k: v for k, v in lengths.items() if k in sub_nodes}
 
-    # return the smallest of all lengths to get to resource_type
-    if sub_dict:  # dict of shortest paths
-        nearest = min(sub_dict, key=sub_dict.get)  # shortest value among all the keys
-        return nearest, sub_dict[nearest], paths[nearest]
-    else:  # not found, no path from source to typeofnode
-        return None, None, None
+def _has_edge_name(edge_data, edge_names, is_multigraph) -> bool:
+    """True if any of the edges in edge_data (a key dict for multigraphs) is named one of edge_names."""
+    if is_multigraph:
+        return any(d.get('name') in edge_names for d in edge_data.values())
+    return edge_data.get('name') in edge_names
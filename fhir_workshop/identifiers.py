@@ -0,0 +1,146 @@
+"""Index of resource identifiers, resolves identifier based (conditional) references."""
+
+import logging
+from collections.abc import Mapping
+from typing import Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class IdentifierIndex(Mapping):
+    """Maps `identifier={system}|{value}` to the id of the node with that identifier.
+
+    A resource may have any number of identifiers. When several resources share an identifier (a collision) all of
+    them are kept, the most recently added one is returned by a plain lookup, see `resolve` for lookups scoped
+    by resourceType.
+    """
+
+    def __init__(self, aliases: Mapping = None):
+        """Create an index, optionally from an {alias: node_id} mapping."""
+        # alias -> node id, the most recently added
+        self._node_ids = {}
+        # alias -> [node id], only for aliases shared by more than one node, in the order they were added
+        self._collisions = {}
+        if isinstance(aliases, IdentifierIndex):
+            self._node_ids = dict(aliases._node_ids)
+            self._collisions = {alias: list(node_ids) for alias, node_ids in aliases._collisions.items()}
+            return
+        for alias, node_id in (aliases or {}).items():
+            self.add(node_id, [alias])
+
+    def __getitem__(self, alias) -> str:
+        """Return the most recently added node id with alias."""
+        return self._node_ids[alias]
+
+    def __iter__(self):
+        """Iterate over aliases."""
+        return iter(self._node_ids)
+
+    def __len__(self):
+        """Number of aliases."""
+        return len(self._node_ids)
+
+    def __repr__(self):
+        """Show the mapping."""
+        return f"IdentifierIndex({self._node_ids!r})"
+
+    def copy(self) -> 'IdentifierIndex':
+        """Return a copy, including collisions."""
+        return IdentifierIndex(self)
+
+    def as_json(self) -> dict:
+        """Return a json serializable copy, including collisions, see `from_json`."""
+        return {'node_ids': dict(self._node_ids), 'collisions': self.collisions}
+
+    @classmethod
+    def from_json(cls, value: dict) -> 'IdentifierIndex':
+        """Return the index `as_json` returned value for."""
+        index = cls()
+        index._node_ids = dict(value['node_ids'])
+        index._collisions = {alias: list(node_ids) for alias, node_ids in value['collisions'].items()}
+        return index
+
+    @property
+    def collisions(self) -> dict:
+        """Return {alias: [node id]} for aliases shared by more than one node."""
+        return {alias: list(node_ids) for alias, node_ids in self._collisions.items()}
+
+    def add(self, node_id, aliases: Iterable[str]):
+        """Index node_id under each of aliases."""
+        for alias in aliases:
+            existing = self._node_ids.get(alias)
+            self._node_ids[alias] = node_id
+            if existing is None or existing == node_id:
+                continue
+            logger.debug(f"{alias} shared by {existing} and {node_id}")
+            node_ids = self._collisions.setdefault(alias, [existing])
+            if node_id in node_ids:
+                node_ids.remove(node_id)
+            node_ids.append(node_id)
+
+    def remove(self, node_id, aliases: Iterable[str]):
+        """Remove node_id from each of aliases, a shared alias falls back to the previously added node."""
+        for alias in aliases:
+            node_ids = self._collisions.get(alias)
+            if node_ids is None:
+                if self._node_ids.get(alias) == node_id:
+                    del self._node_ids[alias]
+                continue
+            if node_id in node_ids:
+                node_ids.remove(node_id)
+            self._node_ids[alias] = node_ids[-1]
+            if len(node_ids) == 1:
+                del self._collisions[alias]
+
+    def lookup(self, alias, resource_type: str = None) -> Optional[str]:
+        """Return the id of the node with alias, if resource_type is set it must be of that type. None if not found."""
+        node_id = self._node_ids.get(alias)
+        if node_id is None or not resource_type or _resource_type(node_id) == resource_type:
+            return node_id
+        for node_id in reversed(self._collisions.get(alias, [])):
+            if _resource_type(node_id) == resource_type:
+                return node_id
+        return None
+
+    def resolve(self, reference: str) -> Optional[str]:
+        """Return the id of the node an identifier based reference refers to, None if not found.
+
+        Handles `identifier={system}|{value}` (FHIRReference.processedReferenceIdentifier of a reference with only
+        an identifier) and conditional references `[base/]{resourceType}?identifier={system}|{value}`,
+        the latter only resolve to a node of resourceType.
+        """
+        alias = identifier_alias(reference)
+        if alias is None:
+            return None
+        return self.lookup(alias, identifier_resource_type(reference))
+
+
+def identifier_alias(reference: str) -> Optional[str]:
+    """Return the `identifier={system}|{value}` part of an identifier based reference, None for other references."""
+    if 'identifier=' not in reference:
+        return None
+    for parameter in reference.rpartition('?')[-1].split('&'):
+        if parameter.startswith('identifier='):
+            return parameter
+    return None
+
+
+def identifier_resource_type(reference: str) -> Optional[str]:
+    """Return the resourceType a conditional reference `[base/]{resourceType}?identifier=...` is scoped to, or None."""
+    return reference.rpartition('?')[0].split('/')[-1] or None
+
+
+def resource_aliases(resource_dict: dict) -> List[str]:
+    """Return an alias for each of the resource's identifiers."""
+    aliases = []
+    resource_identifiers = resource_dict.get('identifier') or []
+    if not isinstance(resource_identifiers, list):
+        resource_identifiers = [resource_identifiers]
+    for identifier in resource_identifiers:
+        aliases.append(f"identifier={identifier.get('system')}|{identifier.get('value')}")
+    return aliases
+
+
+def _resource_type(node_id) -> str:
+    """Return the resourceType of a `{resourceType}/{id}` node id."""
+    return node_id.split('/')[0]
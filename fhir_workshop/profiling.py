@@ -0,0 +1,173 @@
+"""Where does load time go? Phase timings, counts and peak memory of a load_graph call."""
+
+import logging
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # pragma: no cover, not available on windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# phases of a load, in the order they happen
+PHASES = ('read_decode', 'references', 'models', 'aliases', 'edges', 'snapshot')
+
+
+class LoadProfile(object):
+    """Collects timings and counts while a graph is loaded, pass to `load_graph(..., profile=)`.
+
+    Phases:
+    * read_decode: reading the files and decoding json, these are interleaved when a file is streamed
+    * references: extracting references and identifiers from the raw json
+    * models: building fhirclient models (not done by lazy loads)
+    * aliases: resolving references, including identifier based references, to node ids
+    * edges: creating bidirectional edges
+    * snapshot: writing the snapshot, if requested
+
+    With workers, read_decode and references are measured in each worker process and summed.
+    resource_count and resource_types count every resource read, including duplicates that are skipped.
+
+    Memory:
+    * peak_memory: with trace_memory, the peak of memory allocated by python during this load (not by workers)
+    * process_peak_memory: the peak resident set size of the whole process so far, it includes earlier loads
+
+    :param log_level: If set, `finish` logs the report at this level.
+    :param trace_memory: If True, measure peak_memory with tracemalloc, which slows allocation down.
+    """
+
+    def __init__(self, log_level=None, trace_memory=False):
+        """Start the clock, and tracing memory allocations if trace_memory."""
+        self.log_level = log_level
+        self.peak_memory = None
+        self._trace_memory = trace_memory
+        # tracemalloc was started by this profile, stop it in finish
+        self._tracing = False
+        self._traced_at_start = 0
+        if trace_memory:
+            self._tracing = not tracemalloc.is_tracing()
+            if self._tracing:
+                tracemalloc.start()
+            else:
+                tracemalloc.reset_peak()
+            self._traced_at_start = tracemalloc.get_traced_memory()[0]
+        self.phases = defaultdict(float)
+        # file_path -> [number of resources, seconds reading and scanning it]
+        self.files = {}
+        self.resource_types = defaultdict(int)
+        self.resource_count = 0
+        self.edge_count = 0
+        self.pending_count = 0
+        self._started = time.perf_counter()
+        self.wall_time = None
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the with block to phase name."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - started
+
+    def add_file(self, file_path, resource_count, seconds):
+        """Add the number of resources read from file_path, or a chunk of it, and the time it took."""
+        counts = self.files.setdefault(file_path, [0, 0.0])
+        counts[0] += resource_count
+        counts[1] += seconds
+
+    def add_resource(self, resource_type):
+        """Count a resource read."""
+        self.resource_count += 1
+        self.resource_types[resource_type] += 1
+
+    def merge(self, other: 'LoadProfile'):
+        """Add the timings and counts of a profile measured elsewhere, e.g. in a worker process."""
+        for name, seconds in other.phases.items():
+            self.phases[name] += seconds
+        for file_path, (resource_count, seconds) in other.files.items():
+            self.add_file(file_path, resource_count, seconds)
+        for resource_type, count in other.resource_types.items():
+            self.resource_types[resource_type] += count
+        self.resource_count += other.resource_count
+
+    def finish(self, graph=None):
+        """Stop the clock, count the graph's edges and pending references, log the report if log_level is set."""
+        self.wall_time = time.perf_counter() - self._started
+        if self._trace_memory and tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1] - self._traced_at_start
+            if self._tracing:
+                tracemalloc.stop()
+            self._trace_memory = self._tracing = False
+        if graph is not None:
+            self.edge_count = graph.number_of_edges()
+            self.pending_count = pending_count(graph)
+        if self.log_level is not None:
+            self.log(self.log_level)
+
+    def report(self) -> dict:
+        """Return the profile as a dict of plain values, suitable for json."""
+        wall_time = self.wall_time if self.wall_time is not None else time.perf_counter() - self._started
+        return {
+            'wall_time': wall_time,
+            'phases': {name: self.phases[name] for name in PHASES if name in self.phases},
+            'resource_count': self.resource_count,
+            'edge_count': self.edge_count,
+            'pending_count': self.pending_count,
+            'resources_per_second': self.resource_count / wall_time if wall_time else None,
+            'resource_types': dict(sorted(self.resource_types.items(), key=lambda item: -item[1])),
+            'files': {
+                file_path: {
+                    'resource_count': resource_count,
+                    'seconds': seconds,
+                    'resources_per_second': resource_count / seconds if seconds else None,
+                }
+                for file_path, (resource_count, seconds) in self.files.items()
+            },
+            'peak_memory': self.peak_memory,
+            'process_peak_memory': peak_memory(),
+            'process_peak_memory_children': peak_memory(children=True),
+        }
+
+    def log(self, level=logging.INFO):
+        """Log the report, one line per phase and resourceType."""
+        report = self.report()
+        if report['peak_memory'] is not None:
+            memory = f"peak memory {report['peak_memory'] / 2 ** 20:.0f} MiB"
+        else:
+            memory = f"process peak memory {(report['process_peak_memory'] or 0) / 2 ** 20:.0f} MiB"
+        logger.log(level, f"load {report['resource_count']} resources {report['edge_count']} edges "
+                          f"in {report['wall_time']:.2f}s ({report['resources_per_second'] or 0:.0f} resources/s) {memory}")
+        for name, seconds in report['phases'].items():
+            logger.log(level, f"  phase {name} {seconds:.2f}s")
+        for resource_type, count in report['resource_types'].items():
+            logger.log(level, f"  {resource_type} {count}")
+        slowest = sorted(report['files'].items(), key=lambda item: -item[1]['seconds'])[:10]
+        for file_path, file_report in slowest:
+            logger.log(level, f"  file {file_path} {file_report['resource_count']} resources in {file_report['seconds']:.2f}s")
+
+
+def phase(profile, name):
+    """Return profile.phase(name), or a context that does nothing if profile is None."""
+    return profile.phase(name) if profile is not None else nullcontext()
+
+
+def pending_count(graph) -> int:
+    """Return the number of references of graph waiting for their destination, counted by the backend if it can."""
+    if hasattr(graph, 'pending_count'):
+        # e.g. SQLiteGraph, the pending table
+        return graph.pending_count()
+    return sum(len(edges) for edges in graph.graph.get('pending', {}).values())
+
+
+def peak_memory(children=False):
+    """Return the peak resident set size in bytes of this process (or its largest child), None if not available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,100 @@
+"""Find references in a resource's raw json, without building fhirclient models."""
+
+from typing import List, Tuple
+
+from fhirclient.models.fhirabstractbase import FHIRAbstractBase
+from fhirclient.models.fhirabstractresource import FHIRAbstractResource
+from fhirclient.models.fhirreference import FHIRReference
+
+from fhir_workshop.resources import resource_class
+
+# properties handled outside of the reference paths
+_EXTENSIONS = ('extension', 'modifierExtension')
+_SKIPPED = _EXTENSIONS + ('contained',)
+
+# fhirclient.models class -> reference paths, see _reference_paths
+_REFERENCE_PATHS = {}
+
+
+def _reference_paths(clazz) -> dict:
+    """Return {json name: (attribute name, child paths)} for clazz's properties that are, or may contain, references.
+
+    Child paths are None for a reference, otherwise the paths of the property's element type.
+    Computed once per class by inspecting elementProperties(), recursive element types share the same dict.
+    """
+    paths = _REFERENCE_PATHS.get(clazz)
+    if paths is not None:
+        return paths
+    paths = {}
+    # register before recursing, handles elements that contain themselves e.g. QuestionnaireResponse.item.item
+    _REFERENCE_PATHS[clazz] = paths
+    for name, jsname, typ, *_ in clazz().elementProperties():
+        if jsname in _SKIPPED or not isinstance(typ, type):
+            continue
+        if issubclass(typ, FHIRReference):
+            paths[jsname] = (name, None)
+        elif issubclass(typ, FHIRAbstractBase) and not issubclass(typ, FHIRAbstractResource):
+            # an element may carry extensions, so descend into every element
+            paths[jsname] = (name, _reference_paths(typ))
+    return paths
+
+
+def reference_id(reference: dict) -> str:
+    """Normalize a raw json reference, same as FHIRReference.processedReferenceIdentifier."""
+    ref = reference.get('reference')
+    if not ref and reference.get('identifier'):
+        identifier = reference['identifier']
+        return f"identifier={identifier.get('system')}|{identifier.get('value')}"
+    if ref and '#' == ref[0]:
+        return ref[1:]
+    return ref
+
+
+def find_references(resource_dict: dict) -> List[Tuple[str, str]]:
+    """Return (reference id, name) for every reference in the resource's raw json.
+
+    Single pass over the json, guided by the precomputed reference paths of its resourceType, includes references in
+    nested backbone elements and `valueReference`s of extensions at any depth.
+    A reference is named by its attribute path e.g. `subject`, `participant.individual`,
+    an extension's reference is named by the last segment of the extension's url.
+    """
+    references = []
+    _find_references(references, resource_dict, _reference_paths(resource_class(resource_dict['resourceType'])), '')
+    return references
+
+
+def _find_references(references, element, paths, prefix):
+    """Append (reference id, name) for references in element."""
+    for jsname, value in element.items():
+        if jsname in _EXTENSIONS:
+            _find_references_in_extensions(references, value)
+            continue
+        path = paths.get(jsname)
+        if path is None:
+            continue
+        name, child_paths = path
+        for item in (value if isinstance(value, list) else [value]):
+            if not isinstance(item, dict):
+                continue
+            if child_paths is None:
+                ref_id = reference_id(item)
+                if ref_id:
+                    references.append((ref_id, prefix + name))
+                if 'extension' in item:
+                    _find_references_in_extensions(references, item['extension'])
+            else:
+                _find_references(references, item, child_paths, f"{prefix}{name}.")
+
+
+def _find_references_in_extensions(references, extensions):
+    """Append (reference id, name) for the valueReference of extensions, including nested extensions."""
+    for extension in (extensions if isinstance(extensions, list) else [extensions]):
+        if not isinstance(extension, dict):
+            continue
+        value_reference = extension.get('valueReference')
+        if isinstance(value_reference, dict):
+            ref_id = reference_id(value_reference)
+            if ref_id:
+                references.append((ref_id, extension.get('url', '').split('/')[-1]))
+        if 'extension' in extension:
+            _find_references_in_extensions(references, extension['extension'])
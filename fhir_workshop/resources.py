@@ -1,50 +1,484 @@
-from typing import Iterator, Iterable
+from typing import Iterator, Iterable, List, Tuple, Union
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+import io
 import json
 import importlib
 import logging
+import os
 
 from fhirclient.models.domainresource import DomainResource
+from fhirclient.models.fhirabstractbase import FHIRValidationError
+from fhirclient.models.resource import Resource
+
+from fhir_workshop.decoder import loads
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(filename)s %(levelname)-8s %(message)s')
 logger = logging.getLogger(__name__)
 
+# initial number of characters read when more of a streamed document is needed
+_CHUNK_SIZE = 64 * 1024
+_WHITESPACE = ' \t\n\r'
+# bytes of ndjson decoded and marshalled per task by read_resources_parallel
+_PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
 
-def _sniff(file_path) -> Iterator[dict]:
-    """Sniff json or ndjson, yield json raw dictionary."""
-    with open(file_path, "r") as fhir_resource_file:
-        try:
-            # see if this file, in its entirety is json
-            fhir_resources = json.load(fhir_resource_file)
-            if isinstance(fhir_resources, dict) and 'entry' in fhir_resources:
+# resourceType -> fhirclient.models class, populated on first use
+_RESOURCE_CLASSES = {}
+# resources per task of validate_resources
+_VALIDATION_BATCH_SIZE = 1000
+
+# a resource that could not be marshalled into a fhirclient model
+ValidationFailure = namedtuple("ValidationFailure", "node_id error")
+
+
+class UnknownResourceType(Exception):
+    """Reports a resourceType that has no corresponding fhirclient.models class."""
+
+    pass
+
+
+class ResourceView(object):
+    """Lightweight, read only view of a resource's raw json, no fhirclient model is built.
+
+    See `read_resources(..., shallow=True)`, `model()` builds the model and `validate_resources` checks many at once.
+    """
+
+    __slots__ = ('resource_type', 'id', 'resource_dict', '_references')
+
+    def __init__(self, resource_dict: dict):
+        """Wrap resource_dict, references are found on first access."""
+        self.resource_type = resource_dict['resourceType']
+        self.id = resource_dict.get('id')
+        self.resource_dict = resource_dict
+        self._references = None
+
+    def __repr__(self):
+        """Show the node id."""
+        return f"ResourceView({self.node_id})"
+
+    @property
+    def node_id(self) -> str:
+        """Return `{resourceType}/{id}`, the id of the resource's graph node."""
+        return f"{self.resource_type}/{self.id}"
+
+    @property
+    def meta(self) -> dict:
+        """Return the raw meta element, None if not set."""
+        return self.resource_dict.get('meta')
+
+    @property
+    def identifier(self) -> list:
+        """Return the raw identifiers, always a list."""
+        identifiers = self.resource_dict.get('identifier') or []
+        return identifiers if isinstance(identifiers, list) else [identifiers]
+
+    @property
+    def references(self) -> List[Tuple[str, str]]:
+        """Return (reference id, name) for every reference, see fhir_workshop.references.find_references."""
+        if self._references is None:
+            # avoid circular import
+            from fhir_workshop.references import find_references
+            self._references = find_references(self.resource_dict)
+        return self._references
+
+    def as_json(self) -> dict:
+        """Return the raw json, same as a model's as_json."""
+        return self.resource_dict
+
+    def model(self, strict=True) -> DomainResource:
+        """Build the fhirclient model, raises FHIRValidationError if strict and the resource is not valid."""
+        return resource_class(self.resource_type)(self.resource_dict, strict=strict)
+
+
+class _DocumentStream(object):
+    """Incrementally decode a (possibly very large) json document from an open file.
+
+    Only the value currently being decoded is held in memory, so a Bundle's `entry` array
+    or a top level list can be consumed one element at a time.
+    Values are always decoded by the standard library's raw_decode, not by fhir_workshop.decoder: orjson can't
+    find where a value ends, and scanning for it in python is several times slower than raw_decode.
+    """
+
+    def __init__(self, file, chunk_size=_CHUNK_SIZE):
+        """Wrap file, nothing is read until needed."""
+        self._file = file
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size) -> bool:
+        """Append up to size characters to the buffer, discard consumed characters. Return False at EOF."""
+        if self._eof:
+            return False
+        chunk = self._file.read(size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Skip whitespace, return the next character without consuming it, '' at EOF."""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill(self._chunk_size):
+                return ''
+
+    def expect(self, character):
+        """Consume character, raise if it is not next."""
+        if self.peek() != character:
+            raise json.decoder.JSONDecodeError(f"Expecting '{character}'", self._buffer, self._pos)
+        self._pos += 1
+
+    def value(self):
+        """Decode the next json value, reading more of the file until it is complete."""
+        self.peek()
+        size = self._chunk_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # a number at the very end of the buffer may be truncated, make sure it is complete
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.decoder.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill(size)
+            # grow the read size, avoids re-decoding large values many times
+            size *= 2
+
+    def items(self) -> Iterator:
+        """Decode an array, yield one element at a time."""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self._pos += 1
+                continue
+            self.expect(']')
+            return
+
+    def resources(self) -> Iterator[dict]:
+        """Yield the resource(s) in a Bundle, a list or a single resource, or in each of a sequence of them (ndjson)."""
+        while self.peek():
+            yield from self._document_resources()
+
+    def _document_resources(self) -> Iterator[dict]:
+        """Yield the resource(s) in the next Bundle, list or single resource."""
+        if self.peek() == '[':
+            # it's a list
+            yield from self.items()
+            return
+        # decode the object one property at a time, streaming a Bundle's entries
+        self.expect('{')
+        document = {}
+        is_bundle = False
+        while self.peek() != '}':
+            key = self.value()
+            self.expect(':')
+            if key == 'entry' and self.peek() == '[':
                 # this looks like a bundle
-                for entry in fhir_resources['entry']:
+                is_bundle = True
+                for entry in self.items():
                     yield entry['resource']
-                return
-            if isinstance(fhir_resources, dict):
-                # it's a single dict
-                yield fhir_resources
-                return
-            for fhir_resource in fhir_resources:
-                # it's a list
-                yield fhir_resource
-                return
+            else:
+                document[key] = self.value()
+            if self.peek() == ',':
+                self._pos += 1
+        self._pos += 1
+        if not is_bundle:
+            # it's a single dict
+            yield document
+
+
+def _resources_from_document(fhir_resources) -> Iterator[dict]:
+    """Yield the resource(s) in an already decoded Bundle, list or single resource."""
+    if isinstance(fhir_resources, dict) and 'entry' in fhir_resources:
+        # this looks like a bundle
+        for entry in fhir_resources['entry']:
+            yield entry['resource']
+    elif isinstance(fhir_resources, dict):
+        # it's a single dict
+        yield fhir_resources
+    else:
+        # it's a list
+        yield from fhir_resources
+
+
+def _first_line(fhir_resource_file) -> Tuple[bytes, bool]:
+    """Return the first line that is not blank, b'' if there is none, and whether it is complete.
+
+    At most _CHUNK_SIZE bytes are read, a longer line (e.g. a minified Bundle) is returned incomplete.
+    """
+    line = fhir_resource_file.readline(_CHUNK_SIZE)
+    while line and not line.strip():
+        line = fhir_resource_file.readline(_CHUNK_SIZE)
+    return line, len(line) < _CHUNK_SIZE or line.endswith(b'\n')
+
+
+def _stream_document(fhir_resource_file) -> Iterator[dict]:
+    """Yield the resources of the open file from its start, see _DocumentStream."""
+    fhir_resource_file.seek(0)
+    yield from _DocumentStream(io.TextIOWrapper(fhir_resource_file, encoding='utf-8-sig')).resources()
+
+
+def _sniff(file_path) -> Iterator[dict]:
+    """Sniff json or ndjson, yield json raw dictionary.
+
+    Peeks at (up to _CHUNK_SIZE bytes of) the first line to decide the format, never holds more than one resource
+    (or one short line) in memory:
+    * a first line that is a complete json value followed by more lines is ndjson, parsed line by line
+    * a short first line that is the entire file is a Bundle, list or single resource
+    * anything else, e.g. a multi-line or minified json document, is decoded incrementally
+
+    Lines are decoded from bytes by fhir_workshop.decoder, without an intermediate str. Streamed documents are
+    decoded by the standard library, whichever decoder is selected, see _DocumentStream.
+    """
+    with open(file_path, "rb") as fhir_resource_file:
+        first_line, complete = _first_line(fhir_resource_file)
+        if not first_line:
+            return
+        if not complete:
+            # minified json document (or ndjson of a very large resource), stream it
+            yield from _stream_document(fhir_resource_file)
+            return
+        try:
+            first_value = loads(first_line)
         except json.decoder.JSONDecodeError:
-            # re-try,  assume this is ndjson
-            fhir_resource_file.seek(0)
-            for line in fhir_resource_file:
-                yield json.loads(line)
+            # multi-line json document, stream it
+            yield from _stream_document(fhir_resource_file)
+            return
+        second_line = fhir_resource_file.readline()
+        while second_line and not second_line.strip():
+            second_line = fhir_resource_file.readline()
+        if not second_line:
+            # the entire file is on a single line
+            yield from _resources_from_document(first_value)
+            return
+        # assume this is ndjson
+        yield first_value
+        yield loads(second_line)
+        for line in fhir_resource_file:
+            if line.strip():
+                yield loads(line)
 
 
-def read_resources(file_path: str, strict=True) -> Iterable[DomainResource]:
-    """Read a json payload from path, marshall into fhirclient.models FHIR resource."""
-    for resource_dict in _sniff(file_path):
+def resource_class(resource_type: str) -> type:
+    """Return the fhirclient.models class for resource_type, the module is only imported the first time."""
+    clazz = _RESOURCE_CLASSES.get(resource_type)
+    if clazz is not None:
+        return clazz
+    if not isinstance(resource_type, str) or not resource_type.isalnum():
+        raise UnknownResourceType(f"Invalid resourceType {resource_type!r}")
+    try:
         # dynamically import model
-        assert 'resourceType' in resource_dict
-        resource_type = resource_dict['resourceType']
-        module_name = f"fhirclient.models.{resource_type.lower()}"
-        module = importlib.import_module(module_name)
-        assert module
+        module = importlib.import_module(f"fhirclient.models.{resource_type.lower()}")
         clazz = getattr(module, resource_type)
-        assert clazz
+    except (ImportError, AttributeError):
+        raise UnknownResourceType(f"No fhirclient.models class for resourceType {resource_type}") from None
+    if not (isinstance(clazz, type) and issubclass(clazz, Resource)):
+        raise UnknownResourceType(f"{resource_type} is not a FHIR resource")
+    _RESOURCE_CLASSES[resource_type] = clazz
+    return clazz
+
+
+def warm_resource_classes(resource_types: Iterable[str]):
+    """Resolve the classes for resource_types ahead of time, raises UnknownResourceType."""
+    for resource_type in resource_types:
+        resource_class(resource_type)
+
+
+def read_resource_dicts(file_path: str) -> Iterator[dict]:
+    """Read a json payload from path, yield raw dictionaries of known resourceTypes without building models."""
+    for resource_dict in _sniff(file_path):
+        try:
+            resource_class(resource_dict.get('resourceType'))
+        except UnknownResourceType as e:
+            raise UnknownResourceType(f"{e} in {file_path}") from None
+        yield resource_dict
+
+
+def read_resources(file_path: str, strict=True, shallow=False) -> Iterable[Union[DomainResource, ResourceView]]:
+    """Read a json payload from path, marshall into fhirclient.models FHIR resource.
+
+    :param shallow: If True, yield a ResourceView of each resource instead of a model, nothing is validated,
+     see validate_resources.
+    """
+    if shallow:
+        for resource_dict in read_resource_dicts(file_path):
+            yield ResourceView(resource_dict)
+        return
+    for resource_dict in read_resource_dicts(file_path):
         # create instance
-        yield clazz(resource_dict, strict=strict)
+        yield resource_class(resource_dict['resourceType'])(resource_dict, strict=strict)
+
+
+def ndjson_chunks(file_path: str, chunk_size=_PARALLEL_CHUNK_SIZE) -> List[Tuple[int, int]]:
+    """Split an ndjson file into [start, end) byte ranges of about chunk_size, each ending on a newline."""
+    assert chunk_size > 0, "chunk_size should be positive"
+    size = os.path.getsize(file_path)
+    chunks = []
+    start = 0
+    with open(file_path, "rb") as fhir_resource_file:
+        while start < size:
+            fhir_resource_file.seek(min(start + chunk_size, size) - 1)
+            # finish the line the boundary falls in
+            fhir_resource_file.readline()
+            end = fhir_resource_file.tell()
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def _is_ndjson(file_path) -> bool:
+    """Return True if the first non blank line is a complete resource followed by more lines.
+
+    A first line longer than _CHUNK_SIZE is not read whole, the file is not split.
+    """
+    with open(file_path, "rb") as fhir_resource_file:
+        first_line, complete = _first_line(fhir_resource_file)
+        if not complete:
+            return False
+        try:
+            first_value = loads(first_line)
+        except json.decoder.JSONDecodeError:
+            return False
+        if not isinstance(first_value, dict) or 'resourceType' not in first_value or first_value['resourceType'] == 'Bundle':
+            return False
+        return any(line.strip() for line in fhir_resource_file)
+
+
+def read_chunk_dicts(file_path: str, start: int, end: int) -> Iterator[dict]:
+    """Yield raw dictionaries of the ndjson lines in [start, end) of file_path, see ndjson_chunks."""
+    with open(file_path, "rb") as fhir_resource_file:
+        fhir_resource_file.seek(start)
+        lines = fhir_resource_file.read(end - start).splitlines()
+    for line in lines:
+        if not line.strip():
+            continue
+        resource_dict = loads(line)
+        try:
+            resource_class(resource_dict.get('resourceType'))
+        except UnknownResourceType as e:
+            raise UnknownResourceType(f"{e} in {file_path}") from None
+        yield resource_dict
+
+
+def _read_chunk(file_path, start, end, strict=True, shallow=False) -> List[Union[DomainResource, ResourceView]]:
+    """Process pool entry point, decode and marshall the ndjson lines in [start, end) of file_path."""
+    if shallow:
+        return [ResourceView(resource_dict) for resource_dict in read_chunk_dicts(file_path, start, end)]
+    return [resource_class(resource_dict['resourceType'])(resource_dict, strict=strict)
+            for resource_dict in read_chunk_dicts(file_path, start, end)]
+
+
+def read_resources_parallel(file_path: str, strict=True, workers=None, ordered=True, chunk_size=_PARALLEL_CHUNK_SIZE,
+                            shallow=False) -> Iterator[Union[DomainResource, ResourceView]]:
+    """Same as read_resources, a large ndjson file is split into chunks decoded and marshalled by a process pool.
+
+    At most 2 * workers chunks are in flight, results are not read ahead of the caller.
+    Files that are not ndjson, or that fit in one chunk, are read by read_resources.
+
+    :param workers: Number of processes, defaults to os.cpu_count().
+    :param ordered: If False, yield each chunk's resources as soon as it is done, otherwise in file order.
+    :param chunk_size: Approximate number of bytes per chunk.
+    :param shallow: If True, yield ResourceViews, see read_resources.
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = ndjson_chunks(file_path, chunk_size) if _is_ndjson(file_path) else []
+    if workers < 2 or len(chunks) < 2:
+        yield from read_resources(file_path, strict=strict, shallow=shallow)
+        return
+    chunks = iter(chunks)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+
+        def _submit():
+            """Keep the pool busy, at most 2 * workers chunks outstanding."""
+            while len(in_flight) < 2 * workers:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                in_flight.append(executor.submit(_read_chunk, file_path, *chunk, strict=strict, shallow=shallow))
+
+        _submit()
+        while in_flight:
+            if ordered:
+                future = in_flight.popleft()
+            else:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                in_flight.remove(future)
+            resources = future.result()
+            _submit()
+            yield from resources
+
+
+def validate_resources(resources: Iterable[Union[ResourceView, dict]], workers=None,
+                       batch_size=_VALIDATION_BATCH_SIZE) -> List[ValidationFailure]:
+    """Build a strict model of each resource, return a ValidationFailure for each one that can't be built.
+
+    Meant to be run after (or alongside) a shallow read, models are discarded.
+
+    :param resources: ResourceViews or raw json.
+    :param workers: If > 1, batches are validated in this many processes, at most 2 * workers batches in flight.
+    :param batch_size: Number of resources per task.
+    """
+    resource_dicts = (resource.resource_dict if isinstance(resource, ResourceView) else resource for resource in resources)
+    batches = _batches(resource_dicts, batch_size)
+    failures = []
+    if not workers or workers < 2:
+        for batch in batches:
+            failures.extend(_validate_batch(batch))
+        return failures
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch_failures in _bounded_map(executor, _validate_batch, batches, 2 * workers):
+            failures.extend(batch_failures)
+    return failures
+
+
+def _bounded_map(executor, function, items: Iterable, max_in_flight) -> Iterator:
+    """Same as executor.map, but items are only taken from the iterable while fewer than max_in_flight are pending."""
+    items = iter(items)
+    in_flight = deque(executor.submit(function, item) for item in islice(items, max_in_flight))
+    while in_flight:
+        result = in_flight.popleft().result()
+        for item in islice(items, 1):
+            in_flight.append(executor.submit(function, item))
+        yield result
+
+
+def _batches(items: Iterable, batch_size) -> Iterator[list]:
+    """Yield lists of up to batch_size items."""
+    assert batch_size > 0, "batch_size should be positive"
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _validate_batch(resource_dicts: List[dict]) -> List[ValidationFailure]:
+    """Process pool entry point, return a ValidationFailure for each resource that can't be built strictly."""
+    failures = []
+    for resource_dict in resource_dicts:
+        node_id = f"{resource_dict.get('resourceType')}/{resource_dict.get('id')}"
+        try:
+            resource_class(resource_dict.get('resourceType'))(resource_dict, strict=True)
+        except (FHIRValidationError, UnknownResourceType) as e:
+            failures.append(ValidationFailure(node_id, str(e)))
+    return failures
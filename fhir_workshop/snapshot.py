@@ -0,0 +1,191 @@
+"""Persist a resource graph to a compact binary snapshot, re-open it without re-parsing the FHIR files.
+
+Layout of a snapshot file:
+
+* MAGIC
+* offset of the header, 8 bytes little endian
+* payloads, the compact json of every node, written as the nodes are loaded
+* header, a json object: key, graph name, node ids, resource type codes, payload offsets and lengths,
+  edges as (source index, destination index, name code) lists, the alias and pending reference tables
+
+The header is plain json, opening a snapshot never runs code from the file.
+The payloads are memory mapped when the snapshot is opened, a node's json is only decoded when its resource is accessed.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+from typing import List, Optional
+
+from fhir_workshop.decoder import dumps, loads
+from fhir_workshop.graph import EdgeInfo, LazyResource, ResourceCache, ResourceGraph, _node_json
+from fhir_workshop.identifiers import IdentifierIndex
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'FHIRGRF2'
+_HEADER_OFFSET_SIZE = 8
+
+
+class MappedResource(LazyResource):
+    """LazyResource whose raw json is a slice of a memory mapped snapshot."""
+
+    __slots__ = ('buffer', 'offset', 'length')
+
+    def __init__(self, node_id, resource_type, buffer, offset, length, cache):
+        """Nothing is decoded until `resource()` or `resource_json()` is called."""
+        super(MappedResource, self).__init__(node_id, resource_type, None, cache)
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+
+    def resource_json(self) -> dict:
+        """Decode the raw json from the snapshot."""
+        return loads(self.buffer[self.offset:self.offset + self.length])
+
+
+def snapshot_key(file_paths: List[str]) -> str:
+    """Return a hash of file_paths, their modification times and sizes; changes when any input changes."""
+    key = hashlib.sha256(MAGIC)
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        key.update(f"{os.path.abspath(file_path)}\t{stat.st_mtime_ns}\t{stat.st_size}\n".encode())
+    return key.hexdigest()
+
+
+class SnapshotWriter(object):
+    """Writes each node's payload to a temporary snapshot file as it is loaded, the header once the graph is complete.
+
+    Nothing but the offset of each payload is kept in memory. The snapshot replaces path on `close()`,
+    a reader never sees a partial snapshot.
+    """
+
+    def __init__(self, path):
+        """Open a temporary file next to path."""
+        self.path = path
+        self._tmp_path = f"{path}.tmp"
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(MAGIC)
+        # placeholder, see close
+        self._file.write((0).to_bytes(_HEADER_OFFSET_SIZE, 'little'))
+        self._position = 0
+        # node id -> (offset, length) of its payload, the last one written wins
+        self._payloads = {}
+
+    def write(self, node_id, resource_json: dict):
+        """Append the node's raw json."""
+        payload = dumps(resource_json)
+        self._file.write(payload)
+        self._payloads[node_id] = (self._position, len(payload))
+        self._position += len(payload)
+
+    def close(self, graph, file_paths: List[str]):
+        """Write the header of graph, keyed by file_paths. Nodes whose payload was not written are written now."""
+        for node_id, attributes in graph.nodes(data=True):
+            if node_id not in self._payloads:
+                self.write(node_id, _node_json(attributes))
+        header = dumps(_header(graph, file_paths, self._payloads))
+        header_offset = len(MAGIC) + _HEADER_OFFSET_SIZE + self._position
+        self._file.write(header)
+        self._file.seek(len(MAGIC))
+        self._file.write(header_offset.to_bytes(_HEADER_OFFSET_SIZE, 'little'))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+        logger.debug(f"Wrote snapshot {self.path} nodes: {graph.number_of_nodes()} edges: {graph.number_of_edges()}")
+
+    def abort(self):
+        """Discard the temporary file, unless close already moved it into place."""
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def save_graph(graph, path, file_paths: List[str]):
+    """Write graph to a snapshot at path, keyed by file_paths.
+
+    Payloads are taken from the graph's nodes (calls as_json() on models built with strict=True, see _node_json),
+    use a SnapshotWriter to write the raw json while loading instead.
+    """
+    writer = SnapshotWriter(path)
+    try:
+        writer.close(graph, file_paths)
+    except Exception:
+        writer.abort()
+        raise
+
+
+def _header(graph, file_paths: List[str], payloads: dict) -> dict:
+    """Return the json header of graph, payloads maps node id to (offset, length)."""
+    node_ids = list(graph.nodes)
+    node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+    resource_types = {}
+    type_codes = [resource_types.setdefault(resource_type, len(resource_types))
+                  for _, resource_type in graph.nodes(data='resource_type')]
+    edge_names = {}
+    sources, destinations, name_codes = [], [], []
+    for source, destination, name in graph.edges(data='name'):
+        sources.append(node_index[source])
+        destinations.append(node_index[destination])
+        name_codes.append(edge_names.setdefault(name, len(edge_names)))
+    aliases = graph.graph.get('aliases', {})
+    if not isinstance(aliases, IdentifierIndex):
+        aliases = IdentifierIndex(aliases)
+    return {
+        'key': snapshot_key(file_paths),
+        'name': graph.graph.get('name'),
+        'node_ids': node_ids,
+        'resource_types': list(resource_types),
+        'type_codes': type_codes,
+        'offsets': [payloads[node_id][0] for node_id in node_ids],
+        'lengths': [payloads[node_id][1] for node_id in node_ids],
+        'edge_names': list(edge_names),
+        'sources': sources,
+        'destinations': destinations,
+        'name_codes': name_codes,
+        'aliases': aliases.as_json(),
+        'pending': {key: [list(edge) for edge in edges] for key, edges in graph.graph.get('pending', {}).items()},
+    }
+
+
+def open_graph(path, file_paths: List[str] = None, max_materialized=10000, strict=True) -> Optional[ResourceGraph]:
+    """Open the snapshot at path as a lazily loaded graph.
+
+    :param file_paths: If passed, return None when the snapshot is missing or was not created from these files
+     as they are now.
+    :param max_materialized: Maximum number of built models kept alive, see ResourceCache.
+    :param strict: Passed to the model constructor.
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as snapshot_file:
+        if snapshot_file.read(len(MAGIC)) != MAGIC:
+            logger.warning(f"{path} is not a graph snapshot")
+            return None
+        header_offset = int.from_bytes(snapshot_file.read(_HEADER_OFFSET_SIZE), 'little')
+        snapshot_file.seek(header_offset)
+        header = loads(snapshot_file.read())
+        if file_paths is not None and header['key'] != snapshot_key(file_paths):
+            logger.info(f"Snapshot {path} is stale")
+            return None
+        buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    payload_start = len(MAGIC) + _HEADER_OFFSET_SIZE
+
+    pending = {key: [EdgeInfo(*edge) for edge in edges] for key, edges in header['pending'].items()}
+    graph = ResourceGraph(name=header['name'], aliases=IdentifierIndex.from_json(header['aliases']), pending=pending)
+    cache = ResourceCache(graph, max_materialized, strict)
+    graph.resource_cache = cache
+    node_ids = header['node_ids']
+    resource_types = header['resource_types']
+    for node_id, type_code, offset, length in zip(node_ids, header['type_codes'], header['offsets'], header['lengths']):
+        resource_type = resource_types[type_code]
+        resource = MappedResource(node_id, resource_type, buffer, payload_start + offset, length, cache)
+        graph.add_node(node_id, resource=resource, resource_type=resource_type)
+    edge_names = header['edge_names']
+    graph.add_edges_from(
+        (node_ids[source], node_ids[destination], {'name': edge_names[name_code]})
+        for source, destination, name_code in zip(header['sources'], header['destinations'], header['name_codes'])
+    )
+    return graph
@@ -0,0 +1,411 @@
+"""Resource graph stored in a SQLite database, for studies that do not fit in memory.
+
+Nodes (id, resourceType, raw json), references and identifier aliases are written to indexed tables as the FHIR
+files are read, nothing but the current batch is held in memory.  Each reference is stored once, queries follow it
+in both directions, as the edge `name` and the reverse edge `{name}_` that load_graph creates.  Searches expand
+one level at a time with a set based INSERT ... SELECT and paths are read back with a recursive CTE.
+"""
+
+import itertools
+import logging
+import os
+import sqlite3
+from typing import Iterable, Iterator, List, Tuple
+
+import networkx as nx
+from fhirclient.models.resource import Resource
+
+from fhir_workshop.decoder import dumps, loads
+from fhir_workshop.graph import LazyResource, ResourceCache, _NodeAttributes, _scan_fhir_files
+from fhir_workshop.identifiers import identifier_alias, identifier_resource_type
+from fhir_workshop.profiling import phase
+
+logger = logging.getLogger(__name__)
+
+# rows written per executemany
+_BATCH_SIZE = 10000
+
+_SCHEMA = """
+CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE nodes (id INTEGER PRIMARY KEY, node_id TEXT NOT NULL UNIQUE, resource_type TEXT NOT NULL, resource TEXT NOT NULL);
+CREATE TABLE aliases (alias TEXT NOT NULL, node INTEGER NOT NULL);
+CREATE TABLE edges (source INTEGER NOT NULL, destination INTEGER NOT NULL, name TEXT NOT NULL);
+CREATE TABLE pending (key TEXT NOT NULL, source_id TEXT NOT NULL, destination_id TEXT NOT NULL, name TEXT NOT NULL);
+-- references as read, resolved to edges once every node is known
+CREATE TEMP TABLE refs (source INTEGER, destination_id TEXT, name TEXT, alias TEXT, alias_type TEXT, destination INTEGER);
+"""
+
+# created after the bulk insert, cheaper than maintaining them row by row
+_INDEXES = """
+CREATE INDEX nodes_resource_type ON nodes (resource_type);
+CREATE INDEX edges_source ON edges (source);
+CREATE INDEX edges_destination ON edges (destination);
+CREATE INDEX pending_key ON pending (key);
+"""
+
+# a search's visited nodes, node -> the node it was reached from
+_VISITED = "CREATE TEMP TABLE {table} (node INTEGER PRIMARY KEY, parent INTEGER, depth INTEGER NOT NULL)"
+_VISITED_DEPTH = "CREATE INDEX {table}_depth ON {table} (depth)"
+
+_ALIAS_RESOLVE = """
+SELECT a.node FROM aliases a JOIN nodes n ON n.id = a.node
+WHERE a.alias = ? AND (? IS NULL OR n.resource_type = ?) ORDER BY a.rowid DESC LIMIT 1
+"""
+
+
+class _StoredResource(LazyResource):
+    """LazyResource whose raw json is read from the database when needed."""
+
+    __slots__ = ()
+
+    def resource_json(self) -> dict:
+        """Read the raw json."""
+        return self.cache.graph.resource_json(self.node_id)
+
+
+class _SQLiteResourceCache(ResourceCache):
+    """ResourceCache that resolves references against a SQLiteGraph."""
+
+    def resolve(self, ref_id) -> Resource:
+        """Return the model of the node ref_id points to (either a node id or an identifier alias), None if not found."""
+        node_id = self.graph.resolve_node_id(ref_id)
+        return self.graph.resource(node_id) if node_id is not None else None
+
+
+class SQLiteGraph(object):
+    """Resource graph stored in a SQLite database, see `load_sqlite_graph`.
+
+    Supports the operations used on a networkx graph returned by load_graph: find_by_resource_type, find_nearest,
+    find_nearest_batch, summarize_graph and neighbor iteration.
+    """
+
+    def __init__(self, database_path, max_materialized=10000, strict=True):
+        """Open the graph in database_path."""
+        self.database_path = database_path
+        self._connection = sqlite3.connect(database_path)
+        name, = self._connection.execute("SELECT value FROM metadata WHERE key = 'name'").fetchone()
+        self.graph = {'name': name}
+        self._cache = _SQLiteResourceCache(self, max_materialized, strict)
+        self._searches = itertools.count()
+
+    def close(self):
+        """Close the database connection."""
+        self._connection.close()
+
+    def __enter__(self):
+        """Use as a context manager, the connection is closed on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the database connection."""
+        self.close()
+
+    def __len__(self):
+        """Number of nodes."""
+        return self.number_of_nodes()
+
+    def __contains__(self, node_id):
+        """True if node_id is in the graph."""
+        return self._node_rowid(node_id) is not None
+
+    def number_of_nodes(self) -> int:
+        """Number of nodes."""
+        return self._connection.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+
+    def number_of_edges(self) -> int:
+        """Number of (directed) edges, each reference counts as two edges."""
+        return 2 * self._connection.execute("SELECT COUNT(*) FROM edges").fetchone()[0]
+
+    def pending_count(self) -> int:
+        """Number of references whose destination is not in the graph."""
+        return self._connection.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    def _node_rowid(self, node_id):
+        """Return the integer id of node_id, None if not found."""
+        row = self._connection.execute("SELECT id FROM nodes WHERE node_id = ?", (node_id,)).fetchone()
+        return row[0] if row else None
+
+    def _node_id(self, rowid) -> str:
+        """Return the node id of an integer id."""
+        return self._connection.execute("SELECT node_id FROM nodes WHERE id = ?", (rowid,)).fetchone()[0]
+
+    def resolve_node_id(self, ref_id):
+        """Return the id of the node ref_id refers to (either a node id or an identifier alias), None if not found."""
+        alias = identifier_alias(ref_id)
+        if alias is not None:
+            resource_type = identifier_resource_type(ref_id)
+            row = self._connection.execute(_ALIAS_RESOLVE, (alias, resource_type, resource_type)).fetchone()
+            if row:
+                return self._node_id(row[0])
+        return ref_id if ref_id in self else None
+
+    def resource(self, node_id) -> Resource:
+        """Return the model of node_id, built from its json the first time it is requested."""
+        return self.node_attributes(node_id)['resource']
+
+    def resource_json(self, node_id) -> dict:
+        """Return the raw json of node_id."""
+        row = self._connection.execute("SELECT resource FROM nodes WHERE node_id = ?", (node_id,)).fetchone()
+        if row is None:
+            raise KeyError(node_id)
+        return loads(row[0])
+
+    def node_attributes(self, node_id) -> dict:
+        """Return the same attributes as a load_graph node, `resource` is read and built on access."""
+        row = self._connection.execute("SELECT resource_type FROM nodes WHERE node_id = ?", (node_id,)).fetchone()
+        if row is None:
+            raise KeyError(node_id)
+        return _NodeAttributes(resource=_StoredResource(node_id, row[0], None, self._cache), resource_type=row[0])
+
+    def edges(self, node_id=None) -> Iterator[Tuple[str, str, str]]:
+        """Yield (source, destination, edge name) for every edge leaving node_id, or every edge in the graph."""
+        if node_id is None:
+            yield from self._connection.execute("""
+                SELECT s.node_id, d.node_id, e.name FROM edges e
+                JOIN nodes s ON s.id = e.source JOIN nodes d ON d.id = e.destination
+                UNION ALL
+                SELECT d.node_id, s.node_id, e.name || '_' FROM edges e
+                JOIN nodes s ON s.id = e.source JOIN nodes d ON d.id = e.destination
+            """)
+            return
+        rowid = self._node_rowid(node_id)
+        if rowid is None:
+            raise KeyError(node_id)
+        for neighbor, name in self._connection.execute("""
+            SELECT n.node_id, e.name FROM edges e JOIN nodes n ON n.id = e.destination WHERE e.source = ?
+            UNION ALL
+            SELECT n.node_id, e.name || '_' FROM edges e JOIN nodes n ON n.id = e.source WHERE e.destination = ?
+        """, (rowid, rowid)):
+            yield node_id, neighbor, name
+
+    def neighbors(self, node_id) -> Iterator[str]:
+        """Yield the nodes node_id has an edge to, once per edge."""
+        for _, neighbor, _ in self.edges(node_id):
+            yield neighbor
+
+    def nodes_by_resource_type(self, resource_type) -> List[str]:
+        """Return the ids of nodes of resource_type, in insertion order."""
+        return [node_id for node_id, in self._connection.execute(
+            "SELECT node_id FROM nodes WHERE resource_type = ? ORDER BY id", (resource_type,))]
+
+    def find_by_resource_type(self, resource_type) -> List[Tuple[str, dict]]:
+        """Return those nodes that match type = resource_type, as (node_id, attributes)."""
+        return [(node_id, _NodeAttributes(resource=_StoredResource(node_id, resource_type, None, self._cache),
+                                          resource_type=resource_type))
+                for node_id in self.nodes_by_resource_type(resource_type)]
+
+    def find_nearest(self, from_node, resource_type, max_depth=None, edge_names=None):
+        """Find the nearest node of resource_type connected to from_node, see fhir_workshop.graph.find_nearest.
+
+        :returns: (node_id, distance, path) or (None, None, None)
+        """
+        for nearest in self.nearest_of_type(from_node, resource_type, max_depth, edge_names):
+            return nearest
+        return None, None, None
+
+    def nearest_of_type(self, from_node, resource_type, max_depth=None, edge_names=None) -> Iterator[tuple]:
+        """Yield (node_id, distance, path) for nodes of resource_type reachable from from_node, nearest first."""
+        start = self._node_rowid(from_node)
+        if start is None:
+            raise nx.NodeNotFound(f"Source {from_node} is not in G")
+        table = self._create_visited()
+        try:
+            self._connection.execute(f"INSERT INTO {table} (node, parent, depth) VALUES (?, NULL, 0)", (start,))
+            depth = 0
+            while True:
+                for rowid, in self._connection.execute(f"""
+                    SELECT v.node FROM {table} v JOIN nodes n ON n.id = v.node
+                    WHERE v.depth = ? AND n.resource_type = ? ORDER BY v.rowid
+                """, (depth, resource_type)).fetchall():
+                    path = self._path(table, rowid)
+                    yield path[-1], depth, path
+                if max_depth is not None and depth >= max_depth:
+                    return
+                if not self._expand(table, depth, edge_names, forward=True):
+                    return
+                depth += 1
+        finally:
+            self._connection.execute(f"DROP TABLE IF EXISTS {table}")
+
+    def find_nearest_batch(self, from_nodes, resource_type, max_depth=None, edge_names=None) -> dict:
+        """Find the nearest node of resource_type for each of from_nodes, see fhir_workshop.graph.find_nearest_batch.
+
+        :returns: {from_node: (node_id, distance, path) or (None, None, None)}
+        """
+        sources = {}
+        for from_node in from_nodes:
+            rowid = self._node_rowid(from_node)
+            if rowid is None:
+                raise nx.NodeNotFound(f"Source {from_node} is not in G")
+            sources[from_node] = rowid
+        table = self._create_visited()
+        try:
+            self._connection.execute(f"""
+                INSERT INTO {table} (node, parent, depth) SELECT id, NULL, 0 FROM nodes WHERE resource_type = ?
+            """, (resource_type,))
+            depth = 0
+            remaining = set(sources.values())
+            while remaining and (max_depth is None or depth < max_depth):
+                # walk edges backwards, parent is the next node on the path to the nearest node of resource_type
+                if not self._expand(table, depth, edge_names, forward=False):
+                    break
+                depth += 1
+                remaining.difference_update(rowid for rowid, in self._connection.execute(
+                    f"SELECT node FROM {table} WHERE depth = ?", (depth,)))
+            nearest = {}
+            for from_node, rowid in sources.items():
+                if not self._connection.execute(f"SELECT 1 FROM {table} WHERE node = ?", (rowid,)).fetchone():
+                    nearest[from_node] = (None, None, None)
+                    continue
+                path = self._path(table, rowid)[::-1]
+                nearest[from_node] = (path[-1], len(path) - 1, path)
+            return nearest
+        finally:
+            self._connection.execute(f"DROP TABLE IF EXISTS {table}")
+
+    def _create_visited(self) -> str:
+        """Create a temporary table for a search, return its name."""
+        table = f"visited_{next(self._searches)}"
+        self._connection.execute(_VISITED.format(table=table))
+        self._connection.execute(_VISITED_DEPTH.format(table=table))
+        return table
+
+    def _expand(self, table, depth, edge_names, forward) -> bool:
+        """Add the unvisited neighbors of the nodes visited at depth, return False if there were none.
+
+        Follows edges leaving the visited nodes if forward, otherwise edges into them.
+        Each stored reference is an edge `name` from source to destination and an edge `name_` back.
+        """
+        names = list(edge_names) if edge_names is not None else None
+        name_filter = f"AND e.name IN ({','.join('?' * len(names))})" if names is not None else ""
+        reverse_filter = f"AND e.name || '_' IN ({','.join('?' * len(names))})" if names is not None else ""
+        parameters = (depth + 1, depth) + tuple(names or ())
+        # forward: follow source -> destination (name), destination -> source (name_)
+        # backward: the same edges, arriving at the visited node
+        first, second = ('source', 'destination') if forward else ('destination', 'source')
+        added = 0
+        for join, select, filter_ in [(first, second, name_filter), (second, first, reverse_filter)]:
+            added += self._connection.execute(f"""
+                INSERT OR IGNORE INTO {table} (node, parent, depth)
+                SELECT e.{select}, v.node, ? FROM {table} v JOIN edges e ON e.{join} = v.node
+                WHERE v.depth = ? {filter_} ORDER BY v.rowid, e.rowid
+            """, parameters).rowcount
+        return added > 0
+
+    def _path(self, table, rowid) -> List[str]:
+        """Return the node ids from the search's start to rowid, following parents with a recursive CTE."""
+        return [node_id for node_id, in self._connection.execute(f"""
+            WITH RECURSIVE path (node, parent, depth) AS (
+                SELECT node, parent, depth FROM {table} WHERE node = ?
+                UNION ALL
+                SELECT v.node, v.parent, v.depth FROM {table} v JOIN path p ON v.node = p.parent
+            )
+            SELECT n.node_id FROM path JOIN nodes n ON n.id = path.node ORDER BY path.depth
+        """, (rowid,))]
+
+    def summarize_graph(self) -> nx.Graph:
+        """Create a graph of node and edge counts, computed with GROUP BY queries."""
+        summary_graph = nx.MultiDiGraph(name=f"{self.graph['name']}-summary")
+        for resource_type, count in self._connection.execute(
+                "SELECT resource_type, COUNT(*) FROM nodes GROUP BY resource_type ORDER BY MIN(id)"):
+            summary_graph.add_node(resource_type, count=count)
+        edge_counts = self._connection.execute("""
+            SELECT s.resource_type, d.resource_type, e.name, COUNT(*) FROM edges e
+            JOIN nodes s ON s.id = e.source JOIN nodes d ON d.id = e.destination
+            GROUP BY s.resource_type, d.resource_type, e.name
+        """).fetchall()
+        for source_type, destination_type, name, count in edge_counts:
+            summary_graph.add_edge(source_type, destination_type, name=name, count=count)
+        for source_type, destination_type, name, count in edge_counts:
+            summary_graph.add_edge(destination_type, source_type, name=f"{name}_", count=count)
+        logger.debug(f"SummaryGraph {summary_graph.graph['name']} nodes: {summary_graph.number_of_nodes()} edges: {summary_graph.number_of_edges()}")
+        return summary_graph
+
+
+def load_sqlite_graph(name, file_paths, expected_resource_count, database_path, strict=True, check_edges=False,
+                      workers=None, max_materialized=10000, profile=None) -> SQLiteGraph:
+    """Same as load_graph, but writes the graph to a new SQLite database at database_path (replacing any file there)."""
+    if os.path.exists(database_path):
+        os.unlink(database_path)
+    connection = sqlite3.connect(database_path)
+    try:
+        # the database is rebuilt from the FHIR files if anything goes wrong, don't pay for durability
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.executescript(_SCHEMA)
+        connection.execute("INSERT INTO metadata (key, value) VALUES ('name', ?)", (name,))
+        _insert_records(connection, (record for records in _scan_fhir_files(file_paths, workers, profile)
+                                     for record in records))
+        with phase(profile, 'aliases'):
+            _resolve_references(connection, check_edges)
+        with phase(profile, 'edges'):
+            connection.executescript(_INDEXES)
+            connection.commit()
+    finally:
+        connection.close()
+    graph = SQLiteGraph(database_path, max_materialized=max_materialized, strict=strict)
+    assert graph.number_of_nodes() >= expected_resource_count, f"! {graph.number_of_nodes()} >= {expected_resource_count}"
+    if profile is not None:
+        profile.finish(graph)
+    return graph
+
+
+def _insert_records(connection, records: Iterable):
+    """Insert each record's node and aliases, its references into the refs table."""
+    aliases, references = [], []
+    for record in records:
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO nodes (node_id, resource_type, resource) VALUES (?, ?, ?)",
+            (record.node_id, record.resource_type, dumps(record.resource).decode('utf-8'))
+        )
+        # check if already in graph
+        if not cursor.rowcount:
+            logger.warning(f"{record.node_id} already in graph?")
+            continue
+        rowid = cursor.lastrowid
+        aliases.extend((alias, rowid) for alias in record.aliases)
+        for edge in record.edges:
+            references.append((rowid, edge.destination_id, edge.name, identifier_alias(edge.destination_id),
+                               identifier_resource_type(edge.destination_id)))
+        if len(references) >= _BATCH_SIZE or len(aliases) >= _BATCH_SIZE:
+            _flush(connection, aliases, references)
+    _flush(connection, aliases, references)
+
+
+def _flush(connection, aliases, references):
+    """Write and clear the batches."""
+    connection.executemany("INSERT INTO aliases (alias, node) VALUES (?, ?)", aliases)
+    connection.executemany(
+        "INSERT INTO refs (source, destination_id, name, alias, alias_type) VALUES (?, ?, ?, ?, ?)", references)
+    aliases.clear()
+    references.clear()
+
+
+def _resolve_references(connection, check_edges):
+    """Resolve the refs table to edges, same rules as load_graph, unresolved references go to the pending table."""
+    connection.execute("CREATE INDEX aliases_alias ON aliases (alias)")
+    # only look at the identifier xxxxxx?identifier=XXXXX
+    connection.execute("""
+        UPDATE refs SET destination = (
+            SELECT a.node FROM aliases a JOIN nodes n ON n.id = a.node
+            WHERE a.alias = refs.alias AND (refs.alias_type IS NULL OR n.resource_type = refs.alias_type)
+            ORDER BY a.rowid DESC LIMIT 1
+        ) WHERE alias IS NOT NULL
+    """)
+    connection.execute("""
+        UPDATE refs SET destination = (SELECT id FROM nodes WHERE node_id = refs.destination_id)
+        WHERE destination IS NULL
+    """)
+    connection.execute("""
+        INSERT INTO edges (source, destination, name)
+        SELECT source, destination, name FROM refs WHERE destination IS NOT NULL ORDER BY rowid
+    """)
+    connection.execute("""
+        INSERT INTO pending (key, source_id, destination_id, name)
+        SELECT COALESCE(r.alias, r.destination_id), n.node_id, r.destination_id, r.name
+        FROM refs r JOIN nodes n ON n.id = r.source WHERE r.destination IS NULL ORDER BY r.rowid
+    """)
+    if check_edges:
+        for source_id, destination_id, name in connection.execute("SELECT source_id, destination_id, name FROM pending"):
+            logger.warning(f"No destination {name} {destination_id} from {source_id}")
+    connection.execute("DROP TABLE refs")
@@ -109,6 +109,12 @@ setup(
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=requirements,
 
+    # Optional dependencies, e.g. `pip install -e .[async]`
+    # async: DispatchingFHIRClient(engine='async') uses httpx instead of a thread per request
+    extras_require={
+        'async': ['httpx'],
+    },
+
     # If there are data files included in your packages that need to be
     # installed, specify them here.
     #
@@ -125,6 +131,7 @@ setup(
         'console_scripts': [
             'anvil_curl = anvil.clients.fhir_curl:cli',
             'kf_curl = anvil.clients.kf_curl:cli',
+            'fhir_benchmark = fhir_workshop.benchmark:cli',
         ],
     },
 
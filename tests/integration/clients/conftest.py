@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from pytest import fixture
+
+CAPABILITY_STATEMENT = {
+    'resourceType': 'CapabilityStatement', 'status': 'active', 'date': '2022-06-01', 'kind': 'instance',
+    'fhirVersion': '4.0.1', 'format': ['json'],
+}
+
+
+class FakeFHIRServer(object):
+    """Local FHIR servers at /store{n}/fhir, each returns `pages` pages of `page_size` Patients per search."""
+
+    def __init__(self, stores=3, pages=4, page_size=5, delay=0.01):
+        self.stores = stores
+        self.pages = pages
+        self.page_size = page_size
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # store -> [in flight, max in flight]
+        self.store_in_flight = {}
+        self.requests = []
+        # client (host, port) of every connection that made a request, kept alive with HTTP/1.1
+        self.connections = set()
+        self._lock = threading.Lock()
+        self._http_server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f"http://127.0.0.1:{self._http_server.server_address[1]}"
+        self._thread = threading.Thread(target=self._http_server.serve_forever, daemon=True)
+
+    @property
+    def api_bases(self):
+        return [f"{self.url}/store{store}/fhir" for store in range(self.stores)]
+
+    def page(self, store, resource_type, page):
+        """Return a searchset Bundle, with a next link unless it is the last page."""
+        base = f"{self.url}/store{store}/fhir"
+        bundle = {
+            'resourceType': 'Bundle', 'type': 'searchset', 'total': self.pages * self.page_size,
+            'link': [{'relation': 'self', 'url': f"{base}/{resource_type}?page={page}"}],
+            'entry': [
+                {'fullUrl': f"{base}/{resource_type}/{store}-{page}-{i}",
+                 'resource': {'resourceType': resource_type, 'id': f"{store}-{page}-{i}"}}
+                for i in range(self.page_size)
+            ],
+        }
+        if page + 1 < self.pages:
+            bundle['link'].append({'relation': 'next', 'url': f"{base}/{resource_type}?page={page + 1}"})
+        return bundle
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are separate writes, avoid waiting for the client's delayed ack on kept alive connections
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                store_name = self.path.split('/')[1]
+                with fake._lock:
+                    fake.connections.add(self.client_address)
+                    fake.in_flight += 1
+                    fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+                    fake.requests.append(self.path)
+                    store = fake.store_in_flight.setdefault(store_name, [0, 0])
+                    store[0] += 1
+                    store[1] = max(store[1], store[0])
+                try:
+                    time.sleep(fake.delay)
+                    parts = urlparse(self.path)
+                    _, store, _, resource_type = parts.path.split('/')[:4]
+                    if resource_type == 'metadata':
+                        body = CAPABILITY_STATEMENT
+                    else:
+                        page = int(parse_qs(parts.query).get('page', ['0'])[0])
+                        body = fake.page(int(store[len('store'):]), resource_type, page)
+                    payload = json.dumps(body).encode()
+                finally:
+                    # done before the response is sent, the client may send its next request as soon as it arrives
+                    with fake._lock:
+                        fake.in_flight -= 1
+                        fake.store_in_flight[store_name][0] -= 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/fhir+json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._http_server.shutdown()
+        self._http_server.server_close()
+
+
+@fixture
+def fhir_server():
+    """Local FHIR servers, no network or credentials needed."""
+    with FakeFHIRServer() as server:
+        yield server
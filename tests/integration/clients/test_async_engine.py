@@ -0,0 +1,147 @@
+from fhirclient.models.patient import Patient
+
+from anvil.clients.async_engine import AsyncDispatcher
+from anvil.clients.fhir_client import DispatchingFHIRClient
+from anvil.clients.smart_auth import GoogleFHIRAuth
+
+
+def _client(fhir_server, **kwargs):
+    settings = {'app_id': 'my_web_app', 'api_bases': fhir_server.api_bases, 'retrieve_all': True}
+    return DispatchingFHIRClient(settings=settings, auth=GoogleFHIRAuth(access_token='test-token'), **kwargs)
+
+
+def test_async_perform_resources(fhir_server):
+    """Ensure the async engine retrieves every page of every store, same as the thread engine."""
+    client = _client(fhir_server, engine='async', max_concurrency=4)
+    assert client.engine is not None
+    resources = Patient.where(struct={'_count': '5'}).perform_resources(client.server)
+    assert len(resources) == fhir_server.stores * fhir_server.pages * fhir_server.page_size
+    assert len({resource.id for resource in resources}) == len(resources)
+    assert {tag.value.split('/Patient/')[0] for resource in resources for tag in resource.meta.tag} == set(fhir_server.api_bases)
+
+    bundles = Patient.where(struct={'_count': '5'}).perform(client.server)
+    assert {bundle.meta.source for bundle in bundles} == {f"{api_base}/" for api_base in fhir_server.api_bases}
+
+    threaded = _client(fhir_server)
+    assert threaded.engine is None
+    expected = Patient.where(struct={'_count': '5'}).perform_resources(threaded.server)
+    assert sorted(resource.id for resource in resources) == sorted(resource.id for resource in expected)
+
+
+def test_async_concurrency_limit(fhir_server):
+    """Ensure requests across all stores never exceed max_concurrency, and are signed."""
+    client = _client(fhir_server, engine='async')
+    servers = [_client.server for _client in client.clients]
+    fhir_server.max_in_flight = 0
+    pages = AsyncDispatcher(max_concurrency=2).search(servers, 'Patient?_count=5')
+    assert len(pages) == fhir_server.stores * fhir_server.pages
+    assert fhir_server.max_in_flight <= 2
+    assert [page['link'][0]['url'].rsplit('=', 1)[-1] for server, page in pages if server is servers[0]] == ['0', '1', '2', '3']
+
+    fhir_server.max_in_flight = 0
+    pages = AsyncDispatcher(max_concurrency=16, retrieve_all=False).search(servers, 'Patient?_count=5')
+    assert len(pages) == fhir_server.stores
+    assert fhir_server.max_in_flight > 1
+
+
+def test_async_concurrent_searches(fhir_server, monkeypatch):
+    """Ensure searches started from many threads at once share one fallback thread pool."""
+    import threading
+    import anvil.clients.async_engine
+
+    monkeypatch.setattr(anvil.clients.async_engine, 'httpx', None)
+    client = _client(fhir_server)
+    servers = [_client.server for _client in client.clients]
+    dispatcher = AsyncDispatcher(max_concurrency=4)
+    created = []
+    monkeypatch.setattr(anvil.clients.async_engine.concurrent.futures, 'ThreadPoolExecutor',
+                        _counting(anvil.clients.async_engine.concurrent.futures.ThreadPoolExecutor, created))
+    barrier = threading.Barrier(8)
+    counts = []
+
+    def _search():
+        barrier.wait()
+        counts.append(len(dispatcher.search(servers, 'Patient?_count=5')))
+
+    threads = [threading.Thread(target=_search) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    dispatcher.close()
+    assert counts == [fhir_server.stores * fhir_server.pages] * 8
+    assert len(created) == 1
+
+
+def _counting(clazz, created):
+    """Return a subclass of clazz that appends each instance to created, slowly, widening any race."""
+    import time
+
+    class _Counting(clazz):
+        def __init__(self, *args, **kwargs):
+            time.sleep(0.05)
+            created.append(self)
+            super(_Counting, self).__init__(*args, **kwargs)
+    return _Counting
+
+
+def test_async_httpx(fhir_server):
+    """Ensure the httpx client retrieves every page of every store, same as the requests fallback."""
+    import pytest
+    pytest.importorskip('httpx')
+    client = _client(fhir_server, engine='async', max_concurrency=4)
+    servers = [_client.server for _client in client.clients]
+    pages = AsyncDispatcher(max_concurrency=4).search(servers, 'Patient?_count=5')
+    assert len(pages) == fhir_server.stores * fhir_server.pages
+    assert fhir_server.max_in_flight <= 4
+    assert all(request.startswith('/store') for request in fhir_server.requests)
+
+
+def test_async_timeout(fhir_server):
+    """Ensure a stalled store fails the httpx search after timeout, instead of hanging it."""
+    import pytest
+    client = _client(fhir_server, engine='async', timeout=0.2)
+    assert client.engine.timeout == 0.2
+    httpx = pytest.importorskip('httpx')
+    fhir_server.delay = 1
+    servers = [_client.server for _client in client.clients]
+    with pytest.raises(httpx.TimeoutException):
+        client.engine.search(servers, 'Patient?_count=5')
+
+
+def test_async_reauthorize_once(fhir_server):
+    """Ensure concurrent 401s re-authorize once, off the event loop, and every request is retried with the new token."""
+    import asyncio
+    import threading
+    from types import SimpleNamespace
+    from anvil.clients.async_engine import _run
+
+    client = _client(fhir_server)
+    server = client.server
+    loop_threads, reauthorize_threads = set(), []
+
+    def _reauthorize():
+        reauthorize_threads.append(threading.current_thread())
+        server.auth.access_token = 'new-token'
+
+    class _HttpClient(object):
+        """Answers 401 to the old token."""
+
+        async def get(self, url, headers):
+            loop_threads.add(threading.current_thread())
+            await asyncio.sleep(0.01)
+            if headers['Authorization'] != 'Bearer new-token':
+                return SimpleNamespace(status_code=401, content=b'{}')
+            return SimpleNamespace(status_code=200, content=b'{"resourceType": "Bundle"}')
+
+    server.reauthorize = _reauthorize
+    server.raise_for_status = lambda response: None
+
+    async def _gets():
+        lock = asyncio.Lock()
+        return await asyncio.gather(*[AsyncDispatcher._httpx_get(_HttpClient(), lock, server, f"{fhir_server.url}/{i}")
+                                      for i in range(10)])
+
+    assert _run(_gets()) == [{'resourceType': 'Bundle'}] * 10
+    assert len(reauthorize_threads) == 1
+    assert reauthorize_threads[0] not in loop_threads
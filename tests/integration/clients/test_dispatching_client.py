@@ -0,0 +1,132 @@
+import threading
+import time
+
+from fhirclient.models.patient import Patient
+
+from anvil.clients.fhir_client import DispatchingFHIRClient
+from anvil.clients.smart_auth import GoogleFHIRAuth
+
+
+def _client(fhir_server, **kwargs):
+    settings = {'app_id': 'my_web_app', 'api_bases': fhir_server.api_bases, 'retrieve_all': True}
+    return DispatchingFHIRClient(settings=settings, auth=GoogleFHIRAuth(access_token='test-token'), **kwargs)
+
+
+def test_shared_executor(fhir_server):
+    """Ensure searches and dispatches share one executor, released by close."""
+    with _client(fhir_server) as client:
+        Patient.where(struct={'_count': '5'}).perform_resources(client.server)
+        executor = client.executor
+        Patient.where(struct={'_count': '5'}).perform_resources(client.server)
+        assert client.executor is executor
+        thread_names = client.dispatch(lambda server: threading.current_thread().name)
+        assert len(thread_names) == fhir_server.stores
+        assert all(name.startswith('fhir-dispatch') for name in thread_names)
+        # pages are prefetched on a persistent pool, not a new thread per search
+        prefetch_executor = client.prefetch_executor
+        Patient.where(struct={'_count': '5'}).perform_resources(client.server)
+        assert client.prefetch_executor is prefetch_executor
+        assert not [thread for thread in threading.enumerate() if thread.name == 'fhir-prefetch']
+
+        # a search from a dispatched callback runs in the callback's thread
+        def _search(server):
+            return len(Patient.where(struct={'_count': '5'}).perform_resources(client.server))
+        assert client.dispatch(_search) == [fhir_server.stores * fhir_server.pages * fhir_server.page_size] * fhir_server.stores
+    assert client._executor is None and executor._shutdown
+    assert client._prefetch_executor is None and prefetch_executor._shutdown
+
+
+def test_max_per_store(fhir_server):
+    """Ensure concurrent searches never have more than max_per_store requests in flight per store."""
+    with _client(fhir_server, max_workers=8, max_per_store=1) as client:
+        searches = [threading.Thread(target=Patient.where(struct={'_count': '5'}).perform_resources, args=(client.server,))
+                    for _ in range(4)]
+        for search in searches:
+            search.start()
+        for search in searches:
+            search.join()
+    assert len(fhir_server.requests) >= 4 * fhir_server.stores * fhir_server.pages
+    assert all(max_in_flight == 1 for _, max_in_flight in fhir_server.store_in_flight.values())
+
+
+def test_max_per_store_nested(fhir_server):
+    """Ensure a search inside a dispatched callback completes under max_per_store, one request per store at a time."""
+    expected = fhir_server.stores * fhir_server.pages * fhir_server.page_size
+    client = _client(fhir_server, max_per_store=1)
+
+    def _search(server):
+        response = server.session.get(f"{server.base_uri}metadata")
+        assert response.status_code == 200
+        return len(Patient.where(struct={'_count': '5'}).perform_resources(client.server))
+    counts = []
+    dispatch = threading.Thread(target=lambda: counts.extend(client.dispatch(_search)), daemon=True)
+    dispatch.start()
+    dispatch.join(timeout=30)
+    # not closed otherwise, close waits for the worker threads
+    assert not dispatch.is_alive(), "dispatched searches should not deadlock"
+    client.close()
+    assert counts == [expected] * fhir_server.stores
+    assert all(max_in_flight == 1 for _, max_in_flight in fhir_server.store_in_flight.values())
+
+
+def test_iter_resources(fhir_server):
+    """Ensure resources stream from every store, tagged with their source, with at most max_pages pages fetched ahead."""
+    with _client(fhir_server) as client:
+        search = Patient.where(struct={'_count': '5'})
+        expected = sorted(resource.id for resource in search.perform_resources(client.server))
+        requests = len(fhir_server.requests)
+
+        resources = search.iter_resources(client.server, max_pages=2)
+        first = next(resources)
+        assert first.origin_server.base_uri in {f"{api_base}/" for api_base in fhir_server.api_bases}
+        assert first.meta.tag[-1].value.startswith(first.origin_server.base_uri)
+        time.sleep(0.3)
+        # the consumed page and one more
+        assert len(fhir_server.requests) - requests <= 2
+        assert sorted([first.id] + [resource.id for resource in resources]) == expected
+
+        # closed early, the fetchers stop
+        resources = client.iter_resources(search, max_pages=1)
+        next(resources)
+        resources.close()
+        requests = len(fhir_server.requests)
+        time.sleep(0.3)
+        assert len(fhir_server.requests) - requests <= fhir_server.stores
+
+
+def test_iter_resources_nested(fhir_server):
+    """Ensure a consumer of iter_resources can search, pages are fetched on the client's persistent threads."""
+    client = _client(fhir_server, max_workers=1)
+    search = Patient.where(struct={'_count': '5'})
+    expected = len(search.perform_resources(client.server))
+    counts = []
+
+    def _consume():
+        for _ in client.iter_resources(search, max_pages=2):
+            counts.append(len(search.perform_resources(client.server)))
+
+    consumer = threading.Thread(target=_consume, daemon=True)
+    consumer.start()
+    consumer.join(timeout=30)
+    # not closed otherwise, close waits for the worker threads
+    assert not consumer.is_alive(), "searches while iterating should not deadlock"
+    assert not any(thread.name.startswith('fhir-merge') for thread in threading.enumerate())
+    client.close()
+    assert counts == [expected] * expected
+
+
+def test_shared_connections(fhir_server):
+    """Ensure every store's client has its own session, all sharing one adapter whose connections are re-used across searches."""
+    with _client(fhir_server, max_workers=2, pool_maxsize=2) as client:
+        sessions = [_client.server.session for _client in client.clients]
+        assert len(set(map(id, sessions))) == len(sessions)
+        adapter = client.server.session.get_adapter(fhir_server.url)
+        assert adapter._pool_maxsize == 2
+        for session in sessions:
+            assert session.get_adapter(fhir_server.url) is adapter
+            assert session.hooks['response'].count(client.server.auth.handle_401) == 1
+        for _ in range(3):
+            Patient.where(struct={'_count': '5'}).perform_resources(client.server)
+    # 3 searches of every store's pages over the pool's connections, not one (or more) per store
+    assert len(fhir_server.requests) >= 3 * fhir_server.stores * fhir_server.pages
+    assert len(fhir_server.connections) < fhir_server.stores
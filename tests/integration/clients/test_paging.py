@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from anvil.clients.paging import iter_pages, merge_pages
+
+
+def _pages(count):
+    """Return fetch(path) for a search of count pages, and the list of paths it was called with."""
+    fetched = []
+
+    def fetch(path):
+        fetched.append(path)
+        page = int(path.rsplit('=', 1)[-1])
+        if page == 2 and 'fail' in path:
+            raise ValueError(path)
+        links = [{'relation': 'next', 'url': f"https://example.org/fhir/Patient?{'fail&' if 'fail' in path else ''}page={page + 1}"}] if page + 1 < count else []
+        return {'resourceType': 'Bundle', 'type': 'searchset', 'link': links, 'id': str(page)}
+    return fetch, fetched
+
+
+@pytest.mark.parametrize('prefetch', [0, 1, 3])
+def test_iter_pages(prefetch):
+    """Ensure every page is yielded in order, and retrieve_all=False stops after the first."""
+    fetch, fetched = _pages(5)
+    assert [page['id'] for page in iter_pages(fetch, 'Patient?page=0', prefetch=prefetch)] == ['0', '1', '2', '3', '4']
+    assert fetched[1] == '/fhir/Patient?page=1'
+    fetch, fetched = _pages(5)
+    assert [page['id'] for page in iter_pages(fetch, 'Patient?page=0', retrieve_all=False, prefetch=prefetch)] == ['0']
+    assert fetched == ['Patient?page=0']
+
+
+def test_prefetch_bounded():
+    """Ensure the fetcher stays at most prefetch pages ahead, stops when the consumer does, and reports errors."""
+    fetch, fetched = _pages(100)
+    pages = iter_pages(fetch, 'Patient?page=0', prefetch=2)
+    next(pages)
+    time.sleep(0.2)
+    # one yielded, two queued, one waiting for room
+    assert len(fetched) == 4
+    pages.close()
+    time.sleep(0.3)
+    assert len(fetched) == 4
+    assert not [thread for thread in threading.enumerate() if thread.name == 'fhir-prefetch']
+
+    fetch, fetched = _pages(5)
+    with pytest.raises(ValueError):
+        list(iter_pages(fetch, 'Patient?fail&page=0', prefetch=2))
+
+
+def test_merge_pages_pipelined():
+    """Ensure a server's next page is in flight while the consumer still holds the current one."""
+    fetch, fetched = _pages(3)
+    requested = threading.Event()
+
+    def _fetch(server, path):
+        if path.endswith('page=1'):
+            requested.set()
+        return fetch(path)
+
+    pages = merge_pages(_fetch, ['server'], 'Patient?page=0', max_pages=2)
+    server, page = next(pages)
+    assert page['id'] == '0'
+    assert requested.wait(timeout=5), "the next page should be requested before the consumer asks for it"
+    assert [page['id'] for _, page in pages] == ['1', '2']
+
+    # the page being consumed counts against max_pages
+    fetch, fetched = _pages(3)
+    pages = merge_pages(lambda server, path: fetch(path), ['server'], 'Patient?page=0', max_pages=1)
+    next(pages)
+    time.sleep(0.2)
+    assert len(fetched) == 1
+    pages.close()
@@ -0,0 +1,43 @@
+from fhir_workshop.benchmark import generate_synthetic_corpus, run_benchmarks, compare_results, save_results, \
+    load_results, METRICS
+from fhir_workshop.graph import load_graph
+
+
+def test_synthetic_corpus(tmp_path):
+    """Ensure the synthetic corpus loads, including its identifier based references."""
+    file_paths = generate_synthetic_corpus(tmp_path, patients=20, specimens_per_patient=2, observations_per_patient=3)
+    graph = load_graph('synthetic', file_paths, expected_resource_count=2 + 20 * (1 + 1 + 2 * 3 + 3))
+    # a conditional reference
+    assert 'Patient/patient-0' in graph.successors('Observation/observation-0-2')
+    assert not graph.graph['pending']
+
+
+def test_benchmark(tmp_path):
+    """Ensure every metric is measured and regressions against a baseline are flagged."""
+    file_paths = generate_synthetic_corpus(tmp_path / 'corpus', patients=10)
+    results = run_benchmarks({'synthetic': (file_paths, True), 'missing': ([str(tmp_path / 'missing.ndjson')], True)},
+                             repeat=1, samples=2)
+    assert list(results['datasets']) == ['synthetic']
+    dataset = results['datasets']['synthetic']
+    assert set(dataset['metrics']) == set(METRICS)
+    assert all(value > 0 for value in dataset['metrics'].values())
+    assert dataset['resource_count'] == 2 + 10 * 11
+
+    save_results(results, tmp_path / 'results.json')
+    baseline = load_results(tmp_path / 'results.json')
+    assert compare_results(results, baseline) == []
+    baseline['datasets']['synthetic']['metrics']['load_graph.seconds'] /= 2
+    regressions = compare_results(results, baseline, noise=0)
+    assert len(regressions) == 1 and 'load_graph.seconds' in regressions[0]
+
+
+def test_benchmark_sqlite(tmp_path, monkeypatch):
+    """Ensure the sqlite backend's databases are removed after each run."""
+    import tempfile
+    file_paths = generate_synthetic_corpus(tmp_path / 'corpus', patients=5)
+    temporary_path = tmp_path / 'tmp'
+    temporary_path.mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(temporary_path))
+    results = run_benchmarks({'synthetic': (file_paths, True)}, repeat=2, backend='sqlite', samples=1)
+    assert set(results['datasets']['synthetic']['metrics']) == set(METRICS)
+    assert list(temporary_path.iterdir()) == []
@@ -0,0 +1,64 @@
+from fhir_workshop.compact import CompactGraph
+from fhir_workshop.graph import load_graph, summarize_graph, find_by_resource_type, find_nearest
+
+
+def _edge_set(graph):
+    """Return {(source, destination, name): count} of a networkx graph."""
+    edges = {}
+    for edge in graph.edges(data='name'):
+        edges[edge] = edges.get(edge, 0) + 1
+    return edges
+
+
+def test_compact_ncpi(ncpi_file_paths):
+    """Ensure the compact backend matches the networkx graph."""
+    graph = load_graph('ncpi', ncpi_file_paths, expected_resource_count=12)
+    compact = load_graph('ncpi', ncpi_file_paths, expected_resource_count=12, backend='compact')
+    assert isinstance(compact, CompactGraph)
+    assert compact.number_of_nodes() == graph.number_of_nodes()
+    assert compact.number_of_edges() == graph.number_of_edges()
+    assert _edge_set(compact.to_networkx()) == _edge_set(graph)
+
+    # navigation
+    assert [name for name, _ in find_by_resource_type(compact, 'Patient')] == [name for name, _ in find_by_resource_type(graph, 'Patient')]
+    research_study = compact.resource('ResearchStudy/research-study-example-1')
+    assert research_study.principalInvestigator.resolved().id == 'practitioner-role-example-1'
+    nearest, distance, path = find_nearest(compact, 'Patient/patient-example-1', 'ResearchStudy')
+    _, expected_distance, _ = find_nearest(graph, 'Patient/patient-example-1', 'ResearchStudy')
+    assert distance == expected_distance
+    assert path[0] == 'Patient/patient-example-1' and path[-1] == nearest
+    assert find_nearest(compact, 'Patient/patient-example-1', 'ResearchStudy', max_depth=distance - 1) == (None, None, None)
+    edge_names = {compact.to_networkx().edges[edge]['name'] for edge in zip(path, path[1:], [0] * distance)}
+    assert find_nearest(compact, 'Patient/patient-example-1', 'ResearchStudy', edge_names=edge_names)[1] == distance
+
+    # summary
+    summary, expected_summary = summarize_graph(compact), summarize_graph(graph)
+    assert dict(summary.nodes(data='count')) == dict(expected_summary.nodes(data='count'))
+    assert sorted(summary.edges(data=True), key=str) == sorted(expected_summary.edges(data=True), key=str)
+
+
+def test_compact_from_networkx(anvil_file_paths):
+    """Ensure a networkx graph round trips through the compact backend."""
+    graph = load_graph('anvil', anvil_file_paths, expected_resource_count=1, lazy=True)
+    compact = CompactGraph.from_networkx(graph)
+    assert list(compact.node_ids) == list(graph.nodes)
+    assert _edge_set(compact.to_networkx()) == _edge_set(graph)
+
+
+def test_compact_find_nearest_batch(anvil_file_paths):
+    """Ensure the compact batched find_nearest matches the networkx graph."""
+    from fhir_workshop.graph import find_nearest_batch
+
+    graph = load_graph('anvil', anvil_file_paths, expected_resource_count=1, lazy=True)
+    compact = CompactGraph.from_networkx(graph)
+    patient_ids = graph.nodes_by_resource_type('Patient')
+    for resource_type in ['ResearchStudy', 'Task']:
+        expected = find_nearest_batch(graph, patient_ids, resource_type)
+        nearest = find_nearest_batch(compact, patient_ids, resource_type)
+        assert [distance for _, distance, _ in nearest.values()] == [distance for _, distance, _ in expected.values()]
+        for patient_id, (target, distance, path) in nearest.items():
+            assert path[0] == patient_id and path[-1] == target
+            assert all(graph.has_edge(source, destination) for source, destination in zip(path, path[1:]))
+    expected = find_nearest_batch(graph, patient_ids, 'Specimen', edge_names=['subject_'])
+    nearest = find_nearest_batch(compact, patient_ids, 'Specimen', edge_names=['subject_'])
+    assert [distance for _, distance, _ in nearest.values()] == [distance for _, distance, _ in expected.values()]
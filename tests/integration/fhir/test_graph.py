@@ -146,11 +146,12 @@ def test_genomics_reporting(genomic_reporting_file_paths, tmp_dir, manual_inspec
 def test_synthea(synthea_file_paths, tmp_dir, manual_inspect):
     """Ensure that genomics_reporting examples are marshalled into FHIR resources"""
     from datetime import datetime
+    from fhir_workshop.profiling import LoadProfile
 
     # details
-    print('start', datetime.now().isoformat())
-    graph = load_graph('synthea', synthea_file_paths, expected_resource_count=104000, strict=False, check_edges=False)
-    print('finished load', datetime.now().isoformat())
+    profile = LoadProfile(log_level=logging.INFO)
+    graph = load_graph('synthea', synthea_file_paths, expected_resource_count=104000, strict=False, check_edges=False,
+                       profile=profile)
 
     # path = os.path.join(tmp_dir, 'synthea.png')
     # draw_graph(graph, path=path, layout='spring_layout')
@@ -260,3 +261,258 @@ def test_gtex_v8(gtex_v8_file_paths, tmp_dir, manual_inspect):
     observations = find_nearest(graph, patient_id, 'Observation')
 
     f"{patient_id} belongs to ResearchStudy {research_study.identifier[0].value}, and has {len(observations)} observations"
+
+
+def test_workers(anvil_file_paths, monkeypatch):
+    """Ensure loading files in worker processes creates the same graph as loading serially."""
+    import fhir_workshop.graph
+    from fhir_workshop.graph import _scan_chunks
+
+    graph = load_graph('1000G', anvil_file_paths, expected_resource_count=12528, strict=False)
+    # ndjson files are split into chunks, each scanned by a worker
+    monkeypatch.setattr(fhir_workshop.graph, '_SCAN_CHUNK_SIZE', 64 * 1024)
+    assert any(len(_scan_chunks(file_path)) > 1 for file_path in anvil_file_paths)
+    parallel_graph = load_graph('1000G', anvil_file_paths, expected_resource_count=12528, strict=False, workers=2)
+    assert list(graph.nodes) == list(parallel_graph.nodes), "node order should not depend on workers"
+    assert sorted(graph.edges(data='name')) == sorted(parallel_graph.edges(data='name'))
+    assert graph.graph['aliases'] == parallel_graph.graph['aliases']
+    research_study = parallel_graph.nodes['ResearchStudy/1000G-high-coverage-2019-DEV-ONLY']['resource']
+    assert research_study.__class__.__name__ == 'ResearchStudy'
+
+
+def test_lazy(ncpi_file_paths):
+    """Ensure lazily loaded nodes build their models on demand, and references still resolve."""
+    graph = load_graph('ncpi', ncpi_file_paths, expected_resource_count=12, lazy=True, max_materialized=2)
+    research_study = graph.nodes['ResearchStudy/research-study-example-1']['resource']
+    assert research_study.__class__.__name__ == 'ResearchStudy'
+    assert research_study is graph.nodes['ResearchStudy/research-study-example-1']['resource'], "should be cached"
+
+    principal_investigator = research_study.principalInvestigator.resolved()
+    assert principal_investigator
+    assert principal_investigator.resource_type == 'PractitionerRole'
+    assert principal_investigator.id == 'practitioner-role-example-1'
+
+    patients = find_by_resource_type(graph, 'Patient')
+    assert [dict_['resource'].resource_type for name, dict_ in patients] == ['Patient', 'Patient']
+    cache = dict.__getitem__(graph.nodes['Patient/patient-example-1'], 'resource').cache
+    assert len(cache) == 2, "should not keep more than max_materialized models"
+
+    edges = graph.edges('ResearchStudy/research-study-example-1')
+    assert 'ResearchSubject/research-subject-example-3' in [destination for source, destination in edges]
+
+
+def test_snapshot(ncpi_file_paths, tmp_path):
+    """Ensure a graph re-opened from a snapshot matches the original, and that changed inputs invalidate it."""
+    import shutil
+    from fhir_workshop.snapshot import open_graph
+
+    file_paths = [shutil.copy(file_path, tmp_path) for file_path in ncpi_file_paths]
+    snapshot_path = str(tmp_path / 'ncpi.snapshot')
+    graph = load_graph('ncpi', file_paths, expected_resource_count=12, snapshot_path=snapshot_path)
+    snapshot = open_graph(snapshot_path, file_paths)
+    assert snapshot is not None, "snapshot should be current"
+    assert list(snapshot.nodes) == list(graph.nodes)
+    assert list(snapshot.edges(data='name')) == list(graph.edges(data='name'))
+    assert snapshot.graph['aliases'] == graph.graph['aliases']
+    assert snapshot.graph['aliases'].collisions == graph.graph['aliases'].collisions
+    assert snapshot.graph['pending'] == graph.graph['pending']
+
+    research_study = snapshot.nodes['ResearchStudy/research-study-example-1']['resource']
+    assert research_study.as_json() == graph.nodes['ResearchStudy/research-study-example-1']['resource'].as_json()
+    assert research_study.principalInvestigator.resolved().id == 'practitioner-role-example-1'
+
+    # any change to the inputs invalidates the snapshot
+    with open(file_paths[0], 'a') as file:
+        file.write('\n')
+    assert open_graph(snapshot_path, file_paths) is None, "snapshot should be stale"
+    assert open_graph(snapshot_path, file_paths[1:]) is None, "snapshot should be stale"
+
+    # the header is json, a pickled header from an older (or planted) snapshot is never loaded
+    import pickle
+    with open(snapshot_path, 'wb') as file:
+        file.write(b'FHIRGRF1' + pickle.dumps({'key': None}))
+    assert open_graph(snapshot_path) is None
+    assert not os.path.exists(f"{snapshot_path}.tmp")
+
+    # a load that fails after every file is read leaves no temporary snapshot either
+    import pytest
+    failed_path = str(tmp_path / 'failed.snapshot')
+    with pytest.raises(AssertionError):
+        load_graph('ncpi', file_paths, expected_resource_count=1000, snapshot_path=failed_path)
+    assert not os.path.exists(failed_path)
+    assert not os.path.exists(f"{failed_path}.tmp")
+
+
+def test_resource_type_index(ncpi_file_paths):
+    """Ensure the resourceType index follows added and removed nodes."""
+    graph = load_graph('ncpi', ncpi_file_paths, expected_resource_count=12)
+    for resource_type in set(resource_type for _, resource_type in graph.nodes(data='resource_type')):
+        assert graph.nodes_by_resource_type(resource_type) == [
+            name for name, type_ in graph.nodes(data='resource_type') if type_ == resource_type
+        ]
+
+    graph.remove_node('Patient/patient-example-1')
+    assert 'Patient/patient-example-1' not in [name for name, _ in find_by_resource_type(graph, 'Patient')]
+    graph.add_nodes_from([('Patient/new', {'resource_type': 'Patient'})])
+    assert graph.nodes_by_resource_type('Patient')[-1] == 'Patient/new'
+    graph.add_node('Patient/new', resource_type='Group')
+    assert 'Patient/new' not in graph.nodes_by_resource_type('Patient')
+    assert graph.nodes_by_resource_type('Group') == ['Patient/new']
+
+
+def test_find_nearest(anvil_file_paths):
+    """Ensure the breadth first find_nearest matches the shortest paths, honors k, max_depth and edge_names."""
+    import networkx as nx
+    from fhir_workshop.graph import find_k_nearest
+
+    graph = load_graph('anvil', anvil_file_paths, expected_resource_count=1, lazy=True)
+    patient_id = graph.nodes_by_resource_type('Patient')[0]
+    lengths = nx.single_source_shortest_path_length(graph, patient_id)
+    for resource_type in ['ResearchStudy', 'Specimen', 'Task', 'DocumentReference']:
+        nearest, distance, path = find_nearest(graph, patient_id, resource_type)
+        expected = min(length for node, length in lengths.items() if graph.nodes[node]['resource_type'] == resource_type)
+        assert distance == expected
+        assert path[0] == patient_id and path[-1] == nearest and len(path) == distance + 1
+
+    k_nearest = find_k_nearest(graph, patient_id, 'DocumentReference', 3)
+    assert len(k_nearest) == 3
+    assert [distance for _, distance, _ in k_nearest] == sorted(distance for _, distance, _ in k_nearest)
+
+    assert find_nearest(graph, patient_id, 'ResearchStudy', max_depth=1) == (None, None, None)
+    assert find_nearest(graph, patient_id, 'ResearchStudy', edge_names=['no-such-edge']) == (None, None, None)
+
+
+def test_find_nearest_batch(anvil_file_paths):
+    """Ensure the batched find_nearest matches find_nearest for every patient."""
+    from fhir_workshop.graph import find_nearest_batch
+
+    graph = load_graph('anvil', anvil_file_paths, expected_resource_count=1, lazy=True)
+    patient_ids = graph.nodes_by_resource_type('Patient')
+    for resource_type in ['ResearchStudy', 'Specimen']:
+        nearest = find_nearest_batch(graph, patient_ids, resource_type)
+        assert list(nearest) == patient_ids
+        for patient_id, (target, distance, path) in nearest.items():
+            assert distance == find_nearest(graph, patient_id, resource_type)[1]
+            assert graph.nodes[target]['resource_type'] == resource_type
+            assert path[0] == patient_id and path[-1] == target and len(path) == distance + 1
+            assert all(graph.has_edge(source, destination) for source, destination in zip(path, path[1:]))
+
+    assert set(find_nearest_batch(graph, patient_ids, 'ResearchStudy', max_depth=1).values()) == {(None, None, None)}
+
+
+def test_summary_counts(ncpi_file_paths):
+    """Ensure the maintained summary counts match a count of every node and edge."""
+    from collections import Counter
+
+    def _counts(graph_):
+        summary = summarize_graph(graph_)
+        return dict(summary.nodes(data='count')), Counter((u, v, d['name'], d['count']) for u, v, d in summary.edges(data=True))
+
+    graph = load_graph('ncpi', ncpi_file_paths, expected_resource_count=12)
+    assert _counts(graph) == _counts(graph.subgraph(graph.nodes))
+    graph.remove_node('Patient/patient-example-1')
+    graph.remove_edge(*next(iter(graph.edges())))
+    graph.add_edges_from([('Patient/patient-example-3', 'ResearchStudy/research-study-example-1', {'name': 'test'})])
+    assert _counts(graph) == _counts(graph.subgraph(graph.nodes))
+    graph.remove_edges_from(list(graph.edges(keys=True))[:3])
+    graph.update(edges=[('Patient/patient-example-3', 'Patient/patient-example-3', {'name': 'self'})])
+    assert _counts(graph) == _counts(graph.subgraph(graph.nodes))
+    graph.clear_edges()
+    assert graph.edge_counts() == {}
+    assert _counts(graph) == _counts(graph.subgraph(graph.nodes))
+
+
+def _edge_counts(graph_):
+    """Return {(source, destination, name): count}."""
+    from collections import Counter
+    return Counter(graph_.edges(data='name'))
+
+
+def test_incremental(ncpi_file_paths, anvil_file_paths):
+    """Ensure a graph built with add_resources, remove_resource and upsert_resource matches a full load."""
+    from fhir_workshop.graph import add_resources, remove_resource, upsert_resource
+    from fhir_workshop.resources import read_resource_dicts
+
+    for name, file_paths, lazy in [('ncpi', ncpi_file_paths, False), ('anvil', anvil_file_paths, True)]:
+        expected = load_graph(name, file_paths, expected_resource_count=1, lazy=lazy)
+        half = len(file_paths) // 2
+        # load the second half first, references to the first half wait until it is added
+        graph = load_graph(name, file_paths[half:], expected_resource_count=1, lazy=lazy)
+        assert graph.graph['pending']
+        for file_path in file_paths[:half]:
+            add_resources(graph, read_resource_dicts(file_path))
+        assert _edge_counts(graph) == _edge_counts(expected)
+        assert graph.graph['pending'] == expected.graph['pending']
+
+    research_study_id = 'ResearchStudy/research-study-example-1'
+    graph = load_graph('ncpi', ncpi_file_paths, expected_resource_count=12)
+    expected = _edge_counts(graph)
+    research_study_json = graph.nodes[research_study_id]['resource'].as_json()
+    remove_resource(graph, research_study_id)
+    assert research_study_id not in graph
+    assert not [edge for edge in graph.edges if research_study_id in edge[:2]]
+    assert research_study_id in graph.graph['pending']
+    upsert_resource(graph, research_study_json)
+    assert _edge_counts(graph) == expected
+    # references are resolved to the new model
+    research_subject = graph.nodes['ResearchSubject/research-subject-example-3']['resource']
+    assert research_subject.study.resolved() is graph.nodes[research_study_id]['resource']
+
+
+def test_incremental_not_strict(tmp_path):
+    """Ensure resources that are not valid can be removed and upserted in a graph loaded with strict=False."""
+    import json
+    import pytest
+    from fhirclient.models.fhirabstractbase import FHIRValidationError
+    from fhir_workshop.graph import remove_resource, upsert_resource
+
+    patient = {'resourceType': 'Patient', 'id': 'p1'}
+    # no status, not valid
+    observation = {'resourceType': 'Observation', 'id': 'o1', 'code': {'text': 'height'},
+                   'subject': {'reference': 'Patient/p1'}}
+    path = tmp_path / 'resources.ndjson'
+    path.write_text('\n'.join(json.dumps(resource) for resource in [patient, observation]) + '\n')
+    graph = load_graph('invalid', [str(path)], expected_resource_count=2, strict=False)
+    with pytest.raises(FHIRValidationError):
+        graph.nodes['Observation/o1']['resource'].as_json()
+    expected = _edge_counts(graph)
+
+    # the invalid observation references the removed patient
+    remove_resource(graph, 'Patient/p1')
+    assert [edge.source_id for edge in graph.graph['pending']['Patient/p1']] == ['Observation/o1']
+    upsert_resource(graph, patient, strict=False)
+    assert _edge_counts(graph) == expected
+    assert not graph.graph['pending']
+
+    upsert_resource(graph, dict(observation, subject={'reference': 'Patient/p2'}), strict=False)
+    assert 'Observation/o1' in graph
+    assert [edge.source_id for edge in graph.graph['pending']['Patient/p2']] == ['Observation/o1']
+    remove_resource(graph, 'Observation/o1')
+    assert not graph.graph['pending']
+    assert graph.number_of_edges() == 0
+
+
+def test_profile(anvil_file_paths):
+    """Ensure load_graph reports phase timings and counts."""
+    from fhir_workshop.profiling import LoadProfile
+
+    for workers in [None, 2]:
+        profile = LoadProfile()
+        graph = load_graph('anvil', anvil_file_paths, expected_resource_count=1, lazy=True, workers=workers, profile=profile)
+        report = profile.report()
+        assert {'read_decode', 'references', 'aliases', 'edges'} <= set(report['phases'])
+        assert report['resource_count'] == graph.number_of_nodes()
+        assert report['edge_count'] == graph.number_of_edges()
+        assert sum(report['resource_types'].values()) == report['resource_count']
+        assert set(report['files']) == set(anvil_file_paths)
+        assert sum(file_report['resource_count'] for file_report in report['files'].values()) == report['resource_count']
+        assert report['peak_memory'] is None
+        assert report['process_peak_memory'] is None or report['process_peak_memory'] > 0
+
+    # peak memory of each load, not of the process so far
+    peaks = []
+    for file_paths in [anvil_file_paths, anvil_file_paths[:1]]:
+        profile = LoadProfile(trace_memory=True)
+        load_graph('anvil', file_paths, expected_resource_count=1, lazy=True, profile=profile)
+        peaks.append(profile.report()['peak_memory'])
+    assert peaks[0] > peaks[1] > 0
@@ -0,0 +1,51 @@
+import json
+
+from fhir_workshop.graph import load_graph, add_resources, remove_resource
+from fhir_workshop.identifiers import IdentifierIndex
+
+IDENTIFIER = {'system': 'https://example.org/subjects', 'value': 'S-1'}
+ALIAS = 'identifier=https://example.org/subjects|S-1'
+
+
+def test_identifier_index():
+    """Ensure collisions are kept and type scoped lookups pick the right node."""
+    index = IdentifierIndex()
+    index.add('Patient/p1', [ALIAS, 'identifier=other|1'])
+    index.add('Specimen/s1', [ALIAS])
+    assert index[ALIAS] == 'Specimen/s1'
+    assert index.collisions == {ALIAS: ['Patient/p1', 'Specimen/s1']}
+    assert index.resolve(f"Patient?{ALIAS}") == 'Patient/p1'
+    assert index.resolve(f"https://example.org/fhir/Specimen?{ALIAS}") == 'Specimen/s1'
+    assert index.resolve(f"Group?{ALIAS}") is None
+    assert index.resolve(ALIAS) == 'Specimen/s1'
+    assert index.resolve('Patient/p1') is None
+
+    index.remove('Specimen/s1', [ALIAS])
+    assert index[ALIAS] == 'Patient/p1'
+    assert not index.collisions
+    assert index.copy() == {ALIAS: 'Patient/p1', 'identifier=other|1': 'Patient/p1'}
+
+
+def test_identifier_references(tmp_path):
+    """Ensure conditional and identifier only references are linked to the resource of the referenced type."""
+    resources = [
+        {'resourceType': 'Observation', 'id': 'o1', 'status': 'final', 'code': {'text': 'x'},
+         'subject': {'reference': f"Patient?{ALIAS}"}},
+        {'resourceType': 'Observation', 'id': 'o2', 'status': 'final', 'code': {'text': 'x'},
+         'specimen': {'identifier': IDENTIFIER}},
+        {'resourceType': 'Patient', 'id': 'p1', 'identifier': [IDENTIFIER, {'system': 'other', 'value': '1'}]},
+        {'resourceType': 'Specimen', 'id': 's1', 'identifier': [IDENTIFIER]},
+    ]
+    file_path = tmp_path / 'resources.ndjson'
+    file_path.write_text('\n'.join(json.dumps(resource) for resource in resources))
+    graph = load_graph('identifiers', [str(file_path)], expected_resource_count=4)
+    assert graph.graph['aliases'].collisions == {ALIAS: ['Patient/p1', 'Specimen/s1']}
+    assert set(graph.successors('Observation/o1')) == {'Patient/p1'}
+    assert set(graph.successors('Observation/o2')) == {'Specimen/s1'}
+    assert graph.nodes['Observation/o1']['resource'].subject.resolved().id == 'p1'
+
+    # a conditional reference waits for a resource of its type
+    remove_resource(graph, 'Patient/p1')
+    assert not list(graph.successors('Observation/o1'))
+    add_resources(graph, [resources[2]])
+    assert set(graph.successors('Observation/o1')) == {'Patient/p1'}
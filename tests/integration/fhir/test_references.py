@@ -0,0 +1,40 @@
+from fhir_workshop.references import find_references
+
+
+def test_nested_references():
+    """Ensure references in backbone elements and extensions at any depth are found."""
+    encounter = {
+        'resourceType': 'Encounter',
+        'id': 'e1',
+        'status': 'finished',
+        'subject': {'reference': 'Patient/p1'},
+        'participant': [{'individual': {'reference': 'Practitioner/pr1'}}],
+        'extension': [{
+            'url': 'http://example.org/parent',
+            'extension': [{'url': 'http://example.org/nested-organization', 'valueReference': {'reference': 'Organization/o1'}}]
+        }],
+        'location': [{'location': {'reference': 'Location/l1', 'extension': [{'url': 'http://example.org/anchor', 'valueReference': {'reference': 'Location/l2'}}]}}],
+        'serviceProvider': {'identifier': {'system': 'http://example.org', 'value': 'o2'}},
+    }
+    assert sorted(find_references(encounter)) == sorted([
+        ('Patient/p1', 'subject'),
+        ('Practitioner/pr1', 'participant.individual'),
+        ('Organization/o1', 'nested-organization'),
+        ('Location/l1', 'location.location'),
+        ('Location/l2', 'anchor'),
+        ('identifier=http://example.org|o2', 'serviceProvider'),
+    ])
+
+
+def test_task_references():
+    """Ensure Task.for and Task.output are found once."""
+    task = {
+        'resourceType': 'Task',
+        'id': 't1',
+        'status': 'completed',
+        'intent': 'order',
+        'for': {'reference': 'Patient/p1'},
+        'output': [{'type': {'text': 'file'}, 'valueReference': {'reference': 'DocumentReference/d1'}}],
+        'contained': [{'resourceType': 'Patient', 'id': 'p2', 'managingOrganization': {'reference': 'Organization/o1'}}],
+    }
+    assert sorted(find_references(task)) == [('DocumentReference/d1', 'output.valueReference'), ('Patient/p1', 'for_fhir')]
@@ -55,3 +55,151 @@ def test_gtex_v8(gtex_v8_file_paths):
     """Ensure that GTEx is marshalled into FHIR resources"""
     _load_resources(gtex_v8_file_paths, expected_resource_count=5079)
 
+
+def test_sniff_formats(tmp_path):
+    """Ensure bundles, lists, single resources and ndjson are all streamed."""
+    import json
+    from fhir_workshop.resources import _sniff
+
+    patients = [{'resourceType': 'Patient', 'id': str(i)} for i in range(3)]
+    payloads = {
+        'bundle.json': json.dumps({'resourceType': 'Bundle', 'total': 3, 'entry': [{'resource': p} for p in patients]}, indent=2),
+        'minified-bundle.json': json.dumps({'resourceType': 'Bundle', 'entry': [{'resource': p} for p in patients]}),
+        'list.json': json.dumps(patients, indent=2),
+        'patients.ndjson': '\n'.join(json.dumps(p) for p in patients) + '\n',
+    }
+    for file_name, payload in payloads.items():
+        path = tmp_path / file_name
+        path.write_text(payload)
+        assert list(_sniff(str(path))) == patients, file_name
+
+    path = tmp_path / 'single.json'
+    path.write_text(json.dumps(patients[0], indent=2))
+    assert list(_sniff(str(path))) == patients[:1]
+
+    # leading blank lines are skipped, not mistaken for an empty file
+    for file_name in ('bundle.json', 'patients.ndjson'):
+        path = tmp_path / f"blank-{file_name}"
+        path.write_text('\n  \n' + payloads[file_name])
+        assert list(_sniff(str(path))) == patients, file_name
+
+
+def test_sniff_minified(tmp_path):
+    """Ensure a minified Bundle, or ndjson of a resource, longer than a read chunk is streamed, not read whole."""
+    import json
+    import tracemalloc
+    from fhir_workshop.resources import _CHUNK_SIZE, _sniff
+
+    patients = [{'resourceType': 'Patient', 'id': str(i), 'name': [{'text': 'x' * 100}]} for i in range(20000)]
+    path = tmp_path / 'bundle.json'
+    path.write_text(json.dumps({'resourceType': 'Bundle', 'entry': [{'resource': p} for p in patients]}, separators=(',', ':')))
+    size = path.stat().st_size
+    assert size > 16 * _CHUNK_SIZE
+    tracemalloc.start()
+    try:
+        count = sum(1 for _ in _sniff(str(path)))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert count == len(patients)
+    assert peak < size / 4
+
+    large = {'resourceType': 'Patient', 'id': 'large', 'name': [{'text': 'x' * 2 * _CHUNK_SIZE}]}
+    path = tmp_path / 'patients.ndjson'
+    path.write_text('\n'.join(json.dumps(p) for p in [large] + patients[:2]) + '\n')
+    assert list(_sniff(str(path))) == [large] + patients[:2]
+
+
+def test_unknown_resource_type(tmp_path):
+    """Ensure classes are cached and unknown resourceTypes are reported."""
+    import pytest
+    from fhir_workshop.resources import resource_class, warm_resource_classes, UnknownResourceType
+
+    warm_resource_classes(['Patient', 'ResearchStudy'])
+    assert resource_class('Patient') is resource_class('Patient')
+    assert resource_class('ResearchStudy').__name__ == 'ResearchStudy'
+
+    path = tmp_path / 'unknown.ndjson'
+    path.write_text('{"resourceType": "Patient", "id": "1"}\n{"resourceType": "NotAResource", "id": "2"}\n')
+    with pytest.raises(UnknownResourceType, match='NotAResource'):
+        list(read_resources(str(path)))
+
+
+def test_decoders(tmp_path):
+    """Ensure every decoder reads the same resources, including what orjson rejects."""
+    import json
+    from fhir_workshop.decoder import DECODERS, use_decoder, dumps
+    from fhir_workshop.resources import _sniff
+
+    patients = [{'resourceType': 'Patient', 'id': str(i), 'name': [{'text': 'Zoë'}], 'multipleBirthInteger': 2 ** 70}
+                for i in range(3)]
+    ndjson = tmp_path / 'patients.ndjson'
+    ndjson.write_bytes(b'\n'.join(dumps(p) for p in patients) + b'\n')
+    bundle = tmp_path / 'bundle.json'
+    bundle.write_text(json.dumps({'resourceType': 'Bundle', 'entry': [{'resource': p} for p in patients]}, indent=2), encoding='utf-8-sig')
+    previous = use_decoder('json')
+    try:
+        for name in DECODERS:
+            use_decoder(name)
+            assert list(_sniff(str(ndjson))) == patients, name
+            assert list(_sniff(str(bundle))) == patients, name
+    finally:
+        use_decoder(previous)
+
+
+def test_read_resources_parallel(kf_file_paths, tmp_path):
+    """Ensure a chunked ndjson file yields the same resources, in order unless unordered is requested."""
+    import os
+    from fhir_workshop.resources import read_resources_parallel, ndjson_chunks
+
+    file_path = [file_path for file_path in kf_file_paths if file_path.endswith('Specimen.ndjson')][0]
+    chunks = ndjson_chunks(file_path, chunk_size=64 * 1024)
+    assert len(chunks) > 2
+    assert chunks[0][0] == 0 and chunks[-1][1] == os.path.getsize(file_path)
+    assert all(end == start for (_, end), (start, _) in zip(chunks, chunks[1:]))
+
+    expected = [resource.as_json() for resource in read_resources(file_path)]
+    resources = [resource.as_json() for resource in read_resources_parallel(file_path, workers=2, chunk_size=64 * 1024)]
+    assert resources == expected
+    resources = [resource.as_json() for resource in read_resources_parallel(file_path, workers=2, chunk_size=64 * 1024, ordered=False)]
+    assert sorted(resources, key=lambda resource: resource['id']) == sorted(expected, key=lambda resource: resource['id'])
+
+    # not ndjson, read sequentially
+    bundle = tmp_path / 'bundle.json'
+    bundle.write_text('{"resourceType": "Bundle", "entry": [\n{"resource": {"resourceType": "Patient", "id": "1"}}\n]}')
+    assert [resource.id for resource in read_resources_parallel(str(bundle), workers=2, chunk_size=8)] == ['1']
+
+
+def test_shallow(dbgap_file_paths):
+    """Ensure shallow reads skip models and bulk validation reports what a strict read would reject."""
+    from fhir_workshop.resources import ResourceView, validate_resources
+
+    views = [view for file_path in dbgap_file_paths for view in read_resources(file_path, shallow=True)]
+    assert len(views) >= 2000
+    assert all(isinstance(view, ResourceView) for view in views)
+    view = next(view for view in views if view.references)
+    model = view.model(strict=False)
+    assert view.node_id == f"{model.resource_type}/{model.id}"
+    assert view.as_json() is view.resource_dict
+
+    failures = validate_resources(views)
+    assert failures and all(failure.node_id.startswith('Observation/') for failure in failures)
+    assert 'status' in failures[0].error
+    # messages include object addresses, compare ids
+    assert [failure.node_id for failure in validate_resources(views, workers=2, batch_size=500)] == [failure.node_id for failure in failures]
+
+    # batches are taken from the input as they are validated, not all at once
+    from concurrent.futures import ThreadPoolExecutor
+    from fhir_workshop.resources import _bounded_map
+    taken = []
+
+    def _items():
+        for i in range(100):
+            taken.append(i)
+            yield i
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = _bounded_map(executor, lambda i: i * 2, _items(), 4)
+        assert next(results) == 0
+        assert len(taken) <= 5
+        assert list(results) == [i * 2 for i in range(1, 100)]
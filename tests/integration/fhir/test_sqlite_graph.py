@@ -0,0 +1,65 @@
+from collections import Counter
+
+from fhir_workshop.graph import load_graph, summarize_graph, find_by_resource_type, find_nearest, find_nearest_batch
+from fhir_workshop.sqlite_graph import SQLiteGraph
+
+
+def test_sqlite_ncpi(ncpi_file_paths, tmp_path):
+    """Ensure the sqlite backend matches the networkx graph."""
+    graph = load_graph('ncpi', ncpi_file_paths, expected_resource_count=12)
+    database_path = str(tmp_path / 'ncpi.sqlite')
+    with load_graph('ncpi', ncpi_file_paths, expected_resource_count=12, backend='sqlite', database_path=database_path) as stored:
+        assert isinstance(stored, SQLiteGraph)
+        assert stored.number_of_nodes() == graph.number_of_nodes()
+        assert Counter(stored.edges()) == Counter(graph.edges(data='name'))
+        assert Counter(stored.edges('Patient/patient-example-1')) == Counter(graph.edges('Patient/patient-example-1', data='name'))
+
+        # navigation
+        assert [name for name, _ in find_by_resource_type(stored, 'Patient')] == [name for name, _ in find_by_resource_type(graph, 'Patient')]
+        research_study = stored.resource('ResearchStudy/research-study-example-1')
+        assert research_study.principalInvestigator.resolved().id == 'practitioner-role-example-1'
+        nearest, distance, path = find_nearest(stored, 'Patient/patient-example-1', 'ResearchStudy')
+        assert distance == find_nearest(graph, 'Patient/patient-example-1', 'ResearchStudy')[1]
+        assert path[0] == 'Patient/patient-example-1' and path[-1] == nearest
+        assert all(graph.has_edge(source, destination) for source, destination in zip(path, path[1:]))
+        assert find_nearest(stored, 'Patient/patient-example-1', 'ResearchStudy', max_depth=distance - 1) == (None, None, None)
+
+        # summary
+        summary, expected_summary = summarize_graph(stored), summarize_graph(graph)
+        assert dict(summary.nodes(data='count')) == dict(expected_summary.nodes(data='count'))
+        assert sorted(summary.edges(data=True), key=str) == sorted(expected_summary.edges(data=True), key=str)
+
+    # re-open without loading
+    with SQLiteGraph(database_path) as stored:
+        assert stored.number_of_edges() == graph.number_of_edges()
+
+
+def test_sqlite_find_nearest_batch(anvil_file_paths, tmp_path):
+    """Ensure the sqlite batched find_nearest matches the networkx graph."""
+    graph = load_graph('anvil', anvil_file_paths, expected_resource_count=1, lazy=True)
+    stored = load_graph('anvil', anvil_file_paths, expected_resource_count=1, backend='sqlite',
+                        database_path=str(tmp_path / 'anvil.sqlite'))
+    patient_ids = graph.nodes_by_resource_type('Patient')
+    for resource_type, edge_names in [('ResearchStudy', None), ('Specimen', ['subject_'])]:
+        expected = find_nearest_batch(graph, patient_ids, resource_type, edge_names=edge_names)
+        nearest = find_nearest_batch(stored, patient_ids, resource_type, edge_names=edge_names)
+        assert [distance for _, distance, _ in nearest.values()] == [distance for _, distance, _ in expected.values()]
+        for patient_id, (target, distance, path) in nearest.items():
+            assert path[0] == patient_id and path[-1] == target
+            assert all(graph.has_edge(source, destination) for source, destination in zip(path, path[1:]))
+    stored.close()
+
+
+def test_sqlite_pending_count(ncpi_file_paths, tmp_path):
+    """Ensure the load profile counts the pending references in the database."""
+    from fhir_workshop.profiling import LoadProfile
+
+    # without the first files, references to them wait for their destination
+    file_paths = ncpi_file_paths[len(ncpi_file_paths) // 2:]
+    profile = LoadProfile()
+    load_graph('ncpi', file_paths, expected_resource_count=1, profile=profile)
+    assert profile.pending_count > 0
+    stored_profile = LoadProfile()
+    with load_graph('ncpi', file_paths, expected_resource_count=1, backend='sqlite',
+                    database_path=str(tmp_path / 'ncpi.sqlite'), profile=stored_profile) as stored:
+        assert stored.pending_count() == stored_profile.pending_count == profile.pending_count